@@ -4,12 +4,16 @@
 #include "itkImageRegionIterator.h"
 
 // Utils
+#include "itkStreamingImageFilter.h"
+#include "itkImageRegionConstIteratorWithIndex.h"
+#include "itkRegionOfInterestImageFilter.h"
+#include "itkPasteImageFilter.h"
 #include "itkRescaleIntensityImageFilter.h"
 #include "itkAbsImageFilter.h"
 #include "itkMaskImageFilter.h"
 
 //Histogram Matching
-#include "itkHistogramMatchingImageFilter.h"
+#include "itkQuantileHistogramMatchingImageFilter.h"
 
 //Substract Image Filter
 #include "itkSubtractImageFilter.h"
@@ -27,6 +31,15 @@
 
 #include "itkPluginUtilities.h"
 
+#include "itkIntTypes.h"
+
+#include <algorithm>
+#include <cmath>
+#include <cstdio>
+#include <cstring>
+#include <fstream>
+#include <vector>
+
 #include "BayesianDTISegmentationCLP.h"
 
 #ifdef _WIN32
@@ -57,6 +70,349 @@ using namespace std;
 namespace
 {
 
+// Run the filters ending at image slab by slab, numberOfDivisions slabs along the
+// slowest axis, and return the buffered result. Only one slab of each voxelwise
+// intermediate image is kept in memory.
+template <class TImage>
+typename TImage::Pointer StreamedImage( TImage* image, unsigned int numberOfDivisions )
+{
+    typedef itk::StreamingImageFilter<TImage, TImage> StreamingType;
+    typename StreamingType::Pointer streamer = StreamingType::New();
+    streamer->SetInput(image);
+    streamer->SetNumberOfStreamDivisions(numberOfDivisions);
+    streamer->Update();
+    typename TImage::Pointer streamed = streamer->GetOutput();
+    streamed->DisconnectPipeline();
+    return streamed;
+}
+
+// Bounding box of the nonzero voxels of a mask, grown by margin voxels and kept inside
+// the image. The whole image is returned when the mask is empty.
+template <class TImage>
+typename TImage::RegionType MaskBoundingBox( const TImage* mask, unsigned int margin )
+{
+    typedef typename TImage::RegionType RegionType;
+    typedef typename TImage::IndexType  IndexType;
+
+    const RegionType largestRegion = mask->GetLargestPossibleRegion();
+    IndexType lower = largestRegion.GetUpperIndex();
+    IndexType upper = largestRegion.GetIndex();
+    bool found = false;
+    itk::ImageRegionConstIteratorWithIndex<TImage> it(mask, largestRegion);
+    for (it.GoToBegin(); !it.IsAtEnd(); ++it) {
+        if (it.Get() != 0) {
+            const IndexType index = it.GetIndex();
+            for (unsigned int d = 0; d < TImage::ImageDimension; d++) {
+                lower[d] = std::min(lower[d], index[d]);
+                upper[d] = std::max(upper[d], index[d]);
+            }
+            found = true;
+        }
+    }
+    if (!found) {
+        return largestRegion;
+    }
+
+    RegionType boundingBox;
+    for (unsigned int d = 0; d < TImage::ImageDimension; d++) {
+        lower[d] = std::max(lower[d] - static_cast<typename IndexType::IndexValueType>(margin), largestRegion.GetIndex()[d]);
+        upper[d] = std::min(upper[d] + static_cast<typename IndexType::IndexValueType>(margin), largestRegion.GetUpperIndex()[d]);
+        boundingBox.SetIndex(d, lower[d]);
+        boundingBox.SetSize(d, upper[d] - lower[d] + 1);
+    }
+    return boundingBox;
+}
+
+// Copy of the region of an image, which keeps its physical position
+template <class TImage>
+typename TImage::Pointer CropImage( TImage* image, const typename TImage::RegionType & region )
+{
+    typedef itk::RegionOfInterestImageFilter<TImage, TImage> CropType;
+    typename CropType::Pointer crop = CropType::New();
+    crop->SetInput(image);
+    crop->SetRegionOfInterest(region);
+    crop->Update();
+    typename TImage::Pointer cropped = crop->GetOutput();
+    cropped->DisconnectPipeline();
+    return cropped;
+}
+
+// Paste a cropped label back in a zero filled image with the grid of reference
+template <class TLabelImage, class TReferenceImage>
+typename TLabelImage::Pointer PasteLabel( TLabelImage* label, const TReferenceImage* reference,
+                                          const typename TLabelImage::RegionType & region )
+{
+    typename TLabelImage::Pointer fullLabel = TLabelImage::New();
+    fullLabel->CopyInformation(reference);
+    fullLabel->SetRegions(reference->GetLargestPossibleRegion());
+    fullLabel->Allocate();
+    fullLabel->FillBuffer(0);
+
+    //The label region is only known once the filter producing it ran
+    label->Update();
+
+    typedef itk::PasteImageFilter<TLabelImage, TLabelImage> PasteType;
+    typename PasteType::Pointer paste = PasteType::New();
+    paste->SetDestinationImage(fullLabel);
+    paste->SetSourceImage(label);
+    paste->SetSourceRegion(label->GetLargestPossibleRegion());
+    paste->SetDestinationIndex(region.GetIndex());
+    paste->Update();
+    typename TLabelImage::Pointer pasted = paste->GetOutput();
+    pasted->DisconnectPipeline();
+    return pasted;
+}
+
+// Compact priors file: the priors voxels that differ from the first voxel (the background),
+// as increasing absolute flat indices and 16 bit quantized components, after a fixed size
+// header. Every array starts on an 8 byte boundary at an offset given by the header, so the
+// file can be memory mapped and the stored voxels of a region are found by a binary search
+// of the indices, without reading the rest of the file.
+//   char[8]   signature "MSLPRI2"
+//   uint32    number of components C, size[3]
+//   double    spacing[3], origin[3], direction[9]
+//   double    background[C], minimum[C], maximum[C]
+//   uint64    number of stored voxels N
+//   uint64    flat indices[N]
+//   uint16    quantized values[N * C], minimum + q * (maximum - minimum) / 65535
+static const char COMPACT_PRIORS_SIGNATURE[8] = "MSLPRI2";
+static const double COMPACT_PRIORS_LEVELS = 65535.0;
+
+template <class T>
+void WriteBinary( std::ostream & stream, const T* values, size_t count )
+{
+    if (count > 0) {
+        stream.write(reinterpret_cast<const char*>(values), count*sizeof(T));
+    }
+    //Pad the array to the next 8 byte boundary
+    const size_t padding = (8 - (count*sizeof(T)) % 8) % 8;
+    const char zeros[8] = {0, 0, 0, 0, 0, 0, 0, 0};
+    stream.write(zeros, padding);
+}
+
+template <class T>
+bool ReadBinary( std::istream & stream, T* values, size_t count )
+{
+    if (count > 0) {
+        stream.read(reinterpret_cast<char*>(values), count*sizeof(T));
+    }
+    char padding[8];
+    stream.read(padding, (8 - (count*sizeof(T)) % 8) % 8);
+    return !stream.fail();
+}
+
+// Position of the first index not lower than value in the count increasing flat indices
+// stored at offset in a compact priors file, found by a binary search of the file
+size_t LowerBoundInFile( std::istream & stream, std::streamoff offset, size_t count, itk::uint64_t value )
+{
+    size_t first = 0;
+    while (count > 0 && stream) {
+        const size_t step = count/2;
+        itk::uint64_t index = 0;
+        stream.seekg(offset + static_cast<std::streamoff>((first + step)*sizeof(itk::uint64_t)));
+        stream.read(reinterpret_cast<char*>(&index), sizeof(index));
+        if (index < value) {
+            first += step + 1;
+            count -= step + 1;
+        }else{
+            count = step;
+        }
+    }
+    return first;
+}
+
+// Write the compact priors file of a priors vector image. Returns false if it can not be written.
+template <class TVectorImage>
+bool WriteCompactPriors( const TVectorImage* priors, const std::string & fileName )
+{
+    typedef typename TVectorImage::InternalPixelType ComponentType;
+    const itk::uint32_t numberOfComponents = priors->GetNumberOfComponentsPerPixel();
+    const typename TVectorImage::RegionType region = priors->GetBufferedRegion();
+    const size_t numberOfVoxels = region.GetNumberOfPixels();
+    const ComponentType* buffer = priors->GetBufferPointer();
+
+    std::vector<double> background(numberOfComponents), minimum(numberOfComponents), maximum(numberOfComponents);
+    for (unsigned int c = 0; c < numberOfComponents; c++) {
+        background[c] = minimum[c] = maximum[c] = static_cast<double>(buffer[c]);
+    }
+    std::vector<itk::uint64_t> indices;
+    for (size_t i = 0; i < numberOfVoxels; i++) {
+        bool isBackground = true;
+        for (unsigned int c = 0; c < numberOfComponents; c++) {
+            const double value = static_cast<double>(buffer[i*numberOfComponents + c]);
+            isBackground = isBackground && value == background[c];
+            minimum[c] = std::min(minimum[c], value);
+            maximum[c] = std::max(maximum[c], value);
+        }
+        if (!isBackground) {
+            indices.push_back(i);
+        }
+    }
+
+    std::vector<itk::uint16_t> values(indices.size()*numberOfComponents);
+    for (size_t v = 0; v < indices.size(); v++) {
+        for (unsigned int c = 0; c < numberOfComponents; c++) {
+            const double range = maximum[c] - minimum[c];
+            const double level = range > 0.0 ? (static_cast<double>(buffer[indices[v]*numberOfComponents + c]) - minimum[c])/range : 0.0;
+            values[v*numberOfComponents + c] = static_cast<itk::uint16_t>(level*COMPACT_PRIORS_LEVELS + 0.5);
+        }
+    }
+
+    itk::uint32_t header[4] = {numberOfComponents, 0, 0, 0};
+    double geometry[15];
+    for (unsigned int d = 0; d < 3; d++) {
+        header[1 + d] = static_cast<itk::uint32_t>(region.GetSize(d));
+        geometry[d] = priors->GetSpacing()[d];
+        geometry[3 + d] = priors->GetOrigin()[d];
+        for (unsigned int e = 0; e < 3; e++) {
+            geometry[6 + 3*d + e] = priors->GetDirection()[d][e];
+        }
+    }
+    const itk::uint64_t numberOfStoredVoxels = indices.size();
+
+    //Written aside and renamed, so concurrent runs never read a partial file
+    const std::string partialFileName = fileName + ".partial";
+    std::ofstream priorsFile(partialFileName.c_str(), std::ios::binary);
+    priorsFile.write(COMPACT_PRIORS_SIGNATURE, 8);
+    WriteBinary(priorsFile, header, 4);
+    WriteBinary(priorsFile, geometry, 15);
+    WriteBinary(priorsFile, &background[0], numberOfComponents);
+    WriteBinary(priorsFile, &minimum[0], numberOfComponents);
+    WriteBinary(priorsFile, &maximum[0], numberOfComponents);
+    WriteBinary(priorsFile, &numberOfStoredVoxels, 1);
+    WriteBinary(priorsFile, indices.empty() ? NULL : &indices[0], indices.size());
+    WriteBinary(priorsFile, values.empty() ? NULL : &values[0], values.size());
+    priorsFile.close();
+    if (!priorsFile) {
+        std::remove(partialFileName.c_str());
+        return false;
+    }
+    std::remove(fileName.c_str());
+    return std::rename(partialFileName.c_str(), fileName.c_str()) == 0;
+}
+
+// Read the region of a compact priors file in a priors vector image, with the grid that
+// CropImage gives to the region. Only the stored voxels between the first and the last voxel
+// of the region are read. Returns a null pointer if the file can not be read or is not on the
+// grid of reference (size, spacing, origin and direction, compared with the ITK default
+// tolerances of the multi input filters).
+template <class TVectorImage, class TReferenceImage>
+typename TVectorImage::Pointer ReadCompactPriors( const std::string & fileName, const TReferenceImage* reference,
+                                                  const typename TReferenceImage::RegionType & region )
+{
+    typedef typename TVectorImage::InternalPixelType ComponentType;
+    typedef typename TReferenceImage::IndexType      IndexType;
+    std::ifstream priorsFile(fileName.c_str(), std::ios::binary);
+    char signature[8];
+    itk::uint32_t header[4];
+    double geometry[15];
+    priorsFile.read(signature, 8);
+    if (!priorsFile || std::memcmp(signature, COMPACT_PRIORS_SIGNATURE, 8) != 0 || !ReadBinary(priorsFile, header, 4) ||
+        !ReadBinary(priorsFile, geometry, 15)) {
+        return NULL;
+    }
+    const typename TReferenceImage::RegionType referenceRegion = reference->GetLargestPossibleRegion();
+    const double coordinateTolerance = 1.0e-6*reference->GetSpacing()[0];
+    const double directionTolerance = 1.0e-6;
+    for (unsigned int d = 0; d < 3; d++) {
+        if (header[1 + d] != referenceRegion.GetSize(d) ||
+            std::fabs(geometry[d] - reference->GetSpacing()[d]) > coordinateTolerance ||
+            std::fabs(geometry[3 + d] - reference->GetOrigin()[d]) > coordinateTolerance) {
+            return NULL;
+        }
+        for (unsigned int e = 0; e < 3; e++) {
+            if (std::fabs(geometry[6 + 3*d + e] - reference->GetDirection()[d][e]) > directionTolerance) {
+                return NULL;
+            }
+        }
+    }
+    if (!referenceRegion.IsInside(region)) {
+        return NULL;
+    }
+
+    const unsigned int numberOfComponents = header[0];
+    if (numberOfComponents == 0) {
+        return NULL;
+    }
+    std::vector<double> background(numberOfComponents), minimum(numberOfComponents), maximum(numberOfComponents);
+    itk::uint64_t numberOfStoredVoxels = 0;
+    if (!ReadBinary(priorsFile, &background[0], numberOfComponents) || !ReadBinary(priorsFile, &minimum[0], numberOfComponents) ||
+        !ReadBinary(priorsFile, &maximum[0], numberOfComponents) || !ReadBinary(priorsFile, &numberOfStoredVoxels, 1)) {
+        return NULL;
+    }
+    const std::streamoff indicesOffset = priorsFile.tellg();
+    const std::streamoff valuesOffset = indicesOffset + static_cast<std::streamoff>(numberOfStoredVoxels*sizeof(itk::uint64_t));
+    priorsFile.seekg(0, std::ios::end);
+    if (!priorsFile || priorsFile.tellg() < valuesOffset +
+        static_cast<std::streamoff>(numberOfStoredVoxels*numberOfComponents*sizeof(itk::uint16_t))) {
+        return NULL;
+    }
+
+    //Stored voxels from the first to the last voxel of the region
+    const IndexType referenceIndex = referenceRegion.GetIndex();
+    const IndexType firstVoxel = region.GetIndex();
+    const IndexType lastVoxel = region.GetUpperIndex();
+    const itk::uint64_t sizeX = referenceRegion.GetSize(0);
+    const itk::uint64_t sizeXY = sizeX*referenceRegion.GetSize(1);
+    const itk::uint64_t firstIndex = (firstVoxel[0] - referenceIndex[0]) + sizeX*(firstVoxel[1] - referenceIndex[1]) +
+                                     sizeXY*(firstVoxel[2] - referenceIndex[2]);
+    const itk::uint64_t lastIndex = (lastVoxel[0] - referenceIndex[0]) + sizeX*(lastVoxel[1] - referenceIndex[1]) +
+                                    sizeXY*(lastVoxel[2] - referenceIndex[2]);
+    const size_t firstStored = LowerBoundInFile(priorsFile, indicesOffset, numberOfStoredVoxels, firstIndex);
+    const size_t endStored = LowerBoundInFile(priorsFile, indicesOffset, numberOfStoredVoxels, lastIndex + 1);
+    std::vector<itk::uint64_t> indices(endStored - firstStored);
+    std::vector<itk::uint16_t> values(indices.size()*numberOfComponents);
+    priorsFile.seekg(indicesOffset + static_cast<std::streamoff>(firstStored*sizeof(itk::uint64_t)));
+    if (!indices.empty()) {
+        priorsFile.read(reinterpret_cast<char*>(&indices[0]), indices.size()*sizeof(itk::uint64_t));
+    }
+    priorsFile.seekg(valuesOffset + static_cast<std::streamoff>(firstStored*numberOfComponents*sizeof(itk::uint16_t)));
+    if (!values.empty()) {
+        priorsFile.read(reinterpret_cast<char*>(&values[0]), values.size()*sizeof(itk::uint16_t));
+    }
+    if (!priorsFile) {
+        return NULL;
+    }
+
+    typename TVectorImage::Pointer priors = TVectorImage::New();
+    typename TVectorImage::RegionType priorsRegion;
+    priorsRegion.SetSize(region.GetSize());
+    typename TVectorImage::PointType origin;
+    reference->TransformIndexToPhysicalPoint(firstVoxel, origin);
+    priors->SetRegions(priorsRegion);
+    priors->SetSpacing(reference->GetSpacing());
+    priors->SetOrigin(origin);
+    priors->SetDirection(reference->GetDirection());
+    priors->SetNumberOfComponentsPerPixel(numberOfComponents);
+    priors->Allocate();
+
+    //Expand the background and the stored voxels inside the region
+    ComponentType* buffer = priors->GetBufferPointer();
+    const size_t numberOfVoxels = priorsRegion.GetNumberOfPixels();
+    for (size_t i = 0; i < numberOfVoxels; i++) {
+        for (unsigned int c = 0; c < numberOfComponents; c++) {
+            buffer[i*numberOfComponents + c] = static_cast<ComponentType>(background[c]);
+        }
+    }
+    const itk::uint64_t regionSizeX = region.GetSize(0);
+    const itk::uint64_t regionSizeXY = regionSizeX*region.GetSize(1);
+    for (size_t v = 0; v < indices.size(); v++) {
+        IndexType voxel;
+        voxel[0] = referenceIndex[0] + static_cast<typename IndexType::IndexValueType>(indices[v] % sizeX);
+        voxel[1] = referenceIndex[1] + static_cast<typename IndexType::IndexValueType>((indices[v] / sizeX) % referenceRegion.GetSize(1));
+        voxel[2] = referenceIndex[2] + static_cast<typename IndexType::IndexValueType>(indices[v] / sizeXY);
+        if (!region.IsInside(voxel)) {
+            continue;
+        }
+        const size_t offset = (voxel[0] - firstVoxel[0]) + regionSizeX*(voxel[1] - firstVoxel[1]) + regionSizeXY*(voxel[2] - firstVoxel[2]);
+        for (unsigned int c = 0; c < numberOfComponents; c++) {
+            buffer[offset*numberOfComponents + c] = static_cast<ComponentType>(
+                minimum[c] + static_cast<double>(values[v*numberOfComponents + c])*(maximum[c] - minimum[c])/COMPACT_PRIORS_LEVELS);
+        }
+    }
+    return priors;
+}
+
 template <class T>
 int DoIt( int argc, char * argv[], T )
 {
@@ -92,18 +448,63 @@ int DoIt( int argc, char * argv[], T )
     typename ReaderType::Pointer maskReader = ReaderType::New();
     typename ReaderType::Pointer wmReader = ReaderType::New();
 
+    //Read the whole white matter mask
+    stringstream wmFile_path;
+    if (mapResolution == "1mm") {
+        wmFile_path<<HOME_DIR<<WHITEMATTERTEMPLATESFOLDER<<PATH_SEPARATOR<<"MNI152_T1_1mm_brain_wm.nii.gz";
+    }else{
+        wmFile_path<<HOME_DIR<<WHITEMATTERTEMPLATESFOLDER<<PATH_SEPARATOR<<"MNI152_T1_2mm_brain_wm.nii.gz";
+    }
+    wmReader->SetFileName(wmFile_path.str().c_str());
+    wmReader->Update();
+
+    //Crop the maps to the white matter bounding box, everything outside it is masked out at the end
+    typename InputImageType::Pointer inputImage = inputReader->GetOutput();
+    typename InputImageType::Pointer referenceImage = referenceReader->GetOutput();
+    typename InputImageType::Pointer wmImage = wmReader->GetOutput();
+    typename InputImageType::RegionType cropRegion = wmImage->GetLargestPossibleRegion();
+    bool cropped = false;
+    if (cropWhiteMatter) {
+        if (inputImage->GetLargestPossibleRegion() != cropRegion || referenceImage->GetLargestPossibleRegion() != cropRegion) {
+            std::cout<<"The input volumes are not on the white matter template grid, they are not cropped"<<std::endl;
+        }else{
+            cropRegion = MaskBoundingBox<InputImageType>(wmImage, 2);
+            std::cout<<"White matter bounding box: index "<<cropRegion.GetIndex()<<" size "<<cropRegion.GetSize()<<std::endl;
+            inputImage = CropImage<InputImageType>(inputImage, cropRegion);
+            referenceImage = CropImage<InputImageType>(referenceImage, cropRegion);
+            wmImage = CropImage<InputImageType>(wmImage, cropRegion);
+            cropped = true;
+        }
+    }
+
     //Histogram matching step
-    typedef itk::HistogramMatchingImageFilter<InputImageType, InputImageType> HistogramMatchType;
+    typedef itk::QuantileHistogramMatchingImageFilter<InputImageType, InputImageType> HistogramMatchType;
     typename HistogramMatchType::Pointer histogramMatch = HistogramMatchType::New();
-    histogramMatch->SetSourceImage(inputReader->GetOutput());
-    histogramMatch->SetReferenceImage(referenceReader->GetOutput());
+    histogramMatch->SetInput(inputImage);
     histogramMatch->SetNumberOfHistogramLevels(128);
     histogramMatch->SetNumberOfMatchPoints(10000);
+    //The reference histogram only depends on the template, its quantiles are computed once and
+    //kept in the referenceQuantiles file
+    if (!referenceQuantiles.empty() &&
+        histogramMatch->ReadReferenceQuantiles(referenceQuantiles, referenceImage->GetBufferedRegion().GetNumberOfPixels())) {
+        std::cout<<"Reference quantiles read from "<<referenceQuantiles<<std::endl;
+    }else{
+        histogramMatch->ComputeReferenceQuantiles(referenceImage);
+        if (!referenceQuantiles.empty()) {
+            if (histogramMatch->WriteReferenceQuantiles(referenceQuantiles)) {
+                std::cout<<"Reference quantiles written in "<<referenceQuantiles<<std::endl;
+            }else{
+                std::cout<<"WARNING: The reference quantiles could not be written in "<<referenceQuantiles<<std::endl;
+            }
+        }
+    }
+    //The matching needs the whole histograms, so it runs once before the streamed filters
+    histogramMatch->Update();
 
     //Image subtraction with the DTI atlas
     typedef itk::SubtractImageFilter<InputImageType,InputImageType, InputImageType> SubtractType;
     typename SubtractType::Pointer subtract = SubtractType::New();
-    subtract->SetInput1(referenceReader->GetOutput());
+    subtract->SetInput1(referenceImage);
     subtract->SetInput2(histogramMatch->GetOutput());
 
     //Cleaning unrelated differences from the difference image
@@ -131,19 +532,27 @@ int DoIt( int argc, char * argv[], T )
         cleanVoxels->SetUpper(static_cast<InputPixelType>(0.0));
         cleanVoxels->SetOutsideValue(static_cast<InputPixelType>(0.0));
     }
-    cleanVoxels->Update();
 
     //Return absolute pixel values image
     typedef itk::AbsImageFilter<InputImageType, InputImageType> AbsoluteImageType;
     typename AbsoluteImageType::Pointer abs = AbsoluteImageType::New();
     abs->SetInput(cleanVoxels->GetOutput());
 
+    //The voxelwise subtraction, threshold and absolute value run slab by slab
+    typename InputImageType::Pointer difference = StreamedImage<InputImageType>(abs->GetOutput(), streamDivisions);
+    histogramMatch->GetOutput()->ReleaseData();
+
     //Rescale pixel intensity to [0,1] range
+    //The rescaling needs the extremes of the whole image, the difference is released once it is done
     typedef itk::RescaleIntensityImageFilter<InputImageType, InputImageType> RescalerType;
     typename RescalerType::Pointer rescaler = RescalerType::New();
     rescaler->SetOutputMinimum(0.0);
     rescaler->SetOutputMaximum(1.0);
-    rescaler->SetInput(abs->GetOutput());
+    rescaler->SetInput(difference);
+    difference->ReleaseDataFlagOn();
+    rescaler->Update();
+    typename InputImageType::Pointer rescaled = rescaler->GetOutput();
+    rescaled->DisconnectPipeline();
 
     //Mask white matter core fiber bundles
     //Read mask image file
@@ -155,17 +564,21 @@ int DoIt( int argc, char * argv[], T )
     }
     maskReader->SetFileName(maskFile_path.str().c_str());
     maskReader->Update();
+    typename InputImageType::Pointer maskImage = maskReader->GetOutput();
+    if (cropped) {
+        maskImage = CropImage<InputImageType>(maskImage, cropRegion);
+    }
 
     //Apply fiber bundles mask
     typedef itk::MaskImageFilter<InputImageType, InputImageType>    MaskFilterType;
     typename MaskFilterType::Pointer mask = MaskFilterType::New();
-    mask->SetInput(rescaler->GetOutput());
-    mask->SetMaskImage(maskReader->GetOutput());
+    mask->SetInput(rescaled);
+    mask->SetMaskImage(maskImage);
 
     //Find Sigmoid optimum parameters
     typedef itk::LogisticContrastEnhancementImageFilter<InputImageType, InputImageType> OptimumSigmoidParametersType;
     typename OptimumSigmoidParametersType::Pointer optSigmoid = OptimumSigmoidParametersType::New();
-    optSigmoid->SetInput(mask->GetOutput());
+    optSigmoid->SetInput(StreamedImage<InputImageType>(mask->GetOutput(), streamDivisions));
     if (thrMethod == "MaxEntropy") {
         optSigmoid->SetThresholdMethod(OptimumSigmoidParametersType::MAXENTROPY);
     }else if (thrMethod == "Otsu") {
@@ -179,39 +592,31 @@ int DoIt( int argc, char * argv[], T )
     }else if (thrMethod == "Yen") {
         optSigmoid->SetThresholdMethod(OptimumSigmoidParametersType::YEN);
     }
-    optSigmoid->Update();
+    //Only the (alpha,beta) parameters are used, the sigmoid is applied on the unmasked image below
+    optSigmoid->ComputeLogisticParameters();
     std::cout<<"Optimum [Alpha,Beta] = [ "<<optSigmoid->GetAlpha()<<" , "<<optSigmoid->GetBeta()<<" ]"<<std::endl;
 
     //Sigmoid lesion enhancement step
     typedef itk::SigmoidImageFilter<InputImageType,InputImageType> SigmoidType;
     typename SigmoidType::Pointer sigmoid = SigmoidType::New();
-    sigmoid->SetInput(rescaler->GetOutput());
+    sigmoid->SetInput(rescaled);
     sigmoid->SetOutputMinimum(0.0);
     sigmoid->SetOutputMaximum(1.0);
     sigmoid->SetAlpha(optSigmoid->GetAlpha());
     sigmoid->SetBeta(optSigmoid->GetBeta());
 
-    //Mask the whole white matter
-    stringstream wmFile_path;
-    if (mapResolution == "1mm") {
-        wmFile_path<<HOME_DIR<<WHITEMATTERTEMPLATESFOLDER<<PATH_SEPARATOR<<"MNI152_T1_1mm_brain_wm.nii.gz";
-    }else{
-        wmFile_path<<HOME_DIR<<WHITEMATTERTEMPLATESFOLDER<<PATH_SEPARATOR<<"MNI152_T1_2mm_brain_wm.nii.gz";
-    }
-    wmReader->SetFileName(wmFile_path.str().c_str());
-    wmReader->Update();
-
     //Apply whole white matter mask
     typedef itk::MaskImageFilter<InputImageType, InputImageType>    MaskFilterType;
     typename MaskFilterType::Pointer maskWM = MaskFilterType::New();
     maskWM->SetInput(sigmoid->GetOutput());
-    maskWM->SetMaskImage(wmReader->GetOutput());
+    maskWM->SetMaskImage(wmImage);
 
     //Bayesian Segmentation Approach
     typedef itk::BayesianClassifierInitializationImageFilter< InputImageType >         BayesianInitializerType;
     typename BayesianInitializerType::Pointer bayesianInitializer = BayesianInitializerType::New();
 
-    bayesianInitializer->SetInput( maskWM->GetOutput() );
+    //The sigmoid enhancement and the white matter mask run slab by slab
+    bayesianInitializer->SetInput( StreamedImage<InputImageType>(maskWM->GetOutput(), streamDivisions) );
     bayesianInitializer->SetNumberOfClasses( 2 ); // Always set to 2 classes: Lesion and non-Lesions probability
     bayesianInitializer->Update();
 
@@ -227,23 +632,51 @@ int DoIt( int argc, char * argv[], T )
         }else {
             priorsTemplate="USP-ICBM-MSLesionPriors-46-2mm.nii.gz";
         }
-        //    Read the MS lesion priors probability image
-        stringstream priors_path;
-        priors_path<<HOME_DIR<<STATISTICALTEMPLATESFOLDER<<PATH_SEPARATOR<<priorsTemplate;
-        typename PriorsReaderType::Pointer priorsReader = PriorsReaderType::New();
-        priorsReader->SetFileName(priors_path.str().c_str());
-        priorsReader->Update();
+        //    Read the MS lesion priors probability image of the classified region, from the compact
+        //    priors file when it was already written for the template grid, otherwise from the priors volume
+        typename VectorInputImageType::Pointer priors;
+        if (!compactPriors.empty()) {
+            priors = ReadCompactPriors<VectorInputImageType, InputImageType>(compactPriors, wmReader->GetOutput(), cropRegion);
+        }
+        if (priors.IsNotNull()) {
+            std::cout<<"Priors read from "<<compactPriors<<std::endl;
+        }else{
+            stringstream priors_path;
+            priors_path<<HOME_DIR<<STATISTICALTEMPLATESFOLDER<<PATH_SEPARATOR<<priorsTemplate;
+            typename PriorsReaderType::Pointer priorsReader = PriorsReaderType::New();
+            priorsReader->SetFileName(priors_path.str().c_str());
+            priorsReader->Update();
+            priors = priorsReader->GetOutput();
+            if (!compactPriors.empty()) {
+                if (WriteCompactPriors<VectorInputImageType>(priors, compactPriors)) {
+                    std::cout<<"Compact priors written in "<<compactPriors<<std::endl;
+                }else{
+                    std::cout<<"WARNING: The compact priors could not be written in "<<compactPriors<<std::endl;
+                }
+            }
+            if (cropped) {
+                priors = CropImage<VectorInputImageType>(priors, cropRegion);
+            }
+        }
 
-        bayesClassifier->SetPriors(priorsReader->GetOutput());
+        bayesClassifier->SetPriors(priors);
     }
+    bayesClassifier->Update();
+
 
+    //Paste the label of the white matter bounding box back in the template grid
+    typedef typename ClassifierFilterType::OutputImageType LabelImageType;
+    typename LabelImageType::Pointer labelImage = bayesClassifier->GetOutput();
+    if (cropped) {
+        labelImage = PasteLabel<LabelImageType, InputImageType>(labelImage, inputReader->GetOutput(), cropRegion);
+    }
 
     // Write the output file
-    typedef itk::ImageFileWriter<ClassifierFilterType::OutputImageType> WriterType;
+    typedef itk::ImageFileWriter<LabelImageType> WriterType;
     typename WriterType::Pointer writer = WriterType::New();
     writer->SetFileName( outputLabel.c_str() );
-    writer->SetInput( bayesClassifier->GetOutput() );
-    writer->SetUseCompression(1);
+    writer->SetInput( labelImage );
+    writer->SetUseCompression(useCompression);
     writer->Update();
 
 
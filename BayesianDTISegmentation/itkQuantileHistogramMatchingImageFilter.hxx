@@ -0,0 +1,269 @@
+#ifndef __itkQuantileHistogramMatchingImageFilter_hxx
+#define __itkQuantileHistogramMatchingImageFilter_hxx
+#include "itkQuantileHistogramMatchingImageFilter.h"
+
+#include <itkImageRegionConstIterator.h>
+#include <itkImageRegionIterator.h>
+#include <itkHistogram.h>
+#include <itkProgressReporter.h>
+
+#include <algorithm>
+#include <cstdio>
+#include <fstream>
+#include <limits>
+
+namespace itk
+{
+//Header of the reference quantiles files
+static const char * const QUANTILE_FILE_SIGNATURE = "QuantileHistogramMatching";
+static const int QUANTILE_FILE_VERSION = 1;
+
+template< typename TInput, typename TOutput, typename THistogramMeasurement >
+QuantileHistogramMatchingImageFilter< TInput, TOutput, THistogramMeasurement >
+::QuantileHistogramMatchingImageFilter()
+{
+    this->m_NumberOfHistogramLevels=256;
+    this->m_NumberOfMatchPoints=1;
+    this->m_ThresholdAtMeanIntensity=true;
+    this->m_NumberOfReferencePixels=0;
+    this->m_ReferenceMinValue=0;
+    this->m_ReferenceMaxValue=0;
+    this->m_SourceMinValue=0;
+    this->m_SourceMaxValue=0;
+    this->m_LowerGradient=0.0;
+    this->m_UpperGradient=0.0;
+}
+
+template< typename TInput, typename TOutput, typename THistogramMeasurement >
+void
+QuantileHistogramMatchingImageFilter< TInput, TOutput, THistogramMeasurement >
+::GenerateInputRequestedRegion()
+{
+    Superclass::GenerateInputRequestedRegion();
+
+    InputImageType * input = const_cast< InputImageType * >( this->GetInput() );
+    if ( input ) {
+        input->SetRequestedRegionToLargestPossibleRegion();
+    }
+}
+
+template< typename TInput, typename TOutput, typename THistogramMeasurement >
+void
+QuantileHistogramMatchingImageFilter< TInput, TOutput, THistogramMeasurement >
+::computeQuantiles(const InputImageType * image, THistogramMeasurement & minValue, THistogramMeasurement & maxValue,
+                   std::vector<double> & quantiles)
+{
+    //Minimum, maximum and mean intensity
+    itk::ImageRegionConstIterator<InputImageType> iterator(image, image->GetBufferedRegion());
+    double sum = 0.0;
+    SizeValueType count = 0;
+    minValue = static_cast<THistogramMeasurement>(iterator.Get());
+    maxValue = minValue;
+    while (!iterator.IsAtEnd()) {
+        const THistogramMeasurement value = static_cast<THistogramMeasurement>(iterator.Get());
+        sum += static_cast<double>(value);
+        if (value < minValue) {
+            minValue = value;
+        }
+        if (value > maxValue) {
+            maxValue = value;
+        }
+        ++iterator;
+        ++count;
+    }
+    const double meanValue = sum/static_cast<double>(count);
+
+    InputPixelType intensityThreshold;
+    if (m_ThresholdAtMeanIntensity) {
+        intensityThreshold = static_cast<InputPixelType>(meanValue);
+    }else{
+        intensityThreshold = static_cast<InputPixelType>(minValue);
+    }
+
+    //Histogram of the intensities between the threshold and the maximum
+    typedef itk::Statistics::Histogram<THistogramMeasurement> HistogramType;
+    typename HistogramType::Pointer histogram = HistogramType::New();
+    typename HistogramType::SizeType size(1);
+    typename HistogramType::MeasurementVectorType lowerBound(1);
+    typename HistogramType::MeasurementVectorType upperBound(1);
+    histogram->SetMeasurementVectorSize(1);
+    size[0] = m_NumberOfHistogramLevels;
+    lowerBound.Fill(static_cast<THistogramMeasurement>(intensityThreshold));
+    upperBound.Fill(maxValue);
+    histogram->Initialize(size, lowerBound, upperBound);
+    histogram->SetToZero();
+
+    typename HistogramType::IndexType index(1);
+    typename HistogramType::MeasurementVectorType measurement(1);
+    const double histogramMinimum = static_cast<THistogramMeasurement>(intensityThreshold);
+    const double histogramMaximum = maxValue;
+    for (iterator.GoToBegin(); !iterator.IsAtEnd(); ++iterator) {
+        const InputPixelType value = iterator.Get();
+        if (static_cast<double>(value) >= histogramMinimum && static_cast<double>(value) <= histogramMaximum) {
+            measurement[0] = value;
+            histogram->GetIndex(measurement, index);
+            histogram->IncreaseFrequencyOfIndex(index, 1);
+        }
+    }
+
+    //Quantile table: intensity threshold, match point quantiles and maximum
+    quantiles.resize(m_NumberOfMatchPoints + 2);
+    quantiles[0] = intensityThreshold;
+    quantiles[m_NumberOfMatchPoints + 1] = maxValue;
+    const double delta = 1.0/(static_cast<double>(m_NumberOfMatchPoints) + 1.0);
+    for (SizeValueType j = 1; j < m_NumberOfMatchPoints + 1; j++) {
+        quantiles[j] = histogram->Quantile(0, static_cast<double>(j)*delta);
+    }
+}
+
+template< typename TInput, typename TOutput, typename THistogramMeasurement >
+void
+QuantileHistogramMatchingImageFilter< TInput, TOutput, THistogramMeasurement >
+::ComputeReferenceQuantiles(const InputImageType * reference)
+{
+    computeQuantiles(reference, m_ReferenceMinValue, m_ReferenceMaxValue, m_ReferenceQuantiles);
+    m_NumberOfReferencePixels = reference->GetBufferedRegion().GetNumberOfPixels();
+    this->Modified();
+}
+
+template< typename TInput, typename TOutput, typename THistogramMeasurement >
+bool
+QuantileHistogramMatchingImageFilter< TInput, TOutput, THistogramMeasurement >
+::ReadReferenceQuantiles(const std::string & fileName, SizeValueType numberOfReferencePixels)
+{
+    std::ifstream quantilesFile(fileName.c_str());
+    std::string signature, key;
+    int version = 0;
+    SizeValueType levels = 0, matchPoints = 0, pixels = 0;
+    bool thresholdAtMean = false;
+    double minValue = 0.0, maxValue = 0.0;
+    quantilesFile>>signature>>version;
+    quantilesFile>>key>>levels>>key>>matchPoints>>key>>thresholdAtMean>>key>>pixels;
+    quantilesFile>>key>>minValue>>key>>maxValue>>key;
+    if (!quantilesFile || signature != QUANTILE_FILE_SIGNATURE || version != QUANTILE_FILE_VERSION ||
+        levels != m_NumberOfHistogramLevels || matchPoints != m_NumberOfMatchPoints ||
+        thresholdAtMean != m_ThresholdAtMeanIntensity || pixels != numberOfReferencePixels) {
+        return false;
+    }
+
+    std::vector<double> quantiles(m_NumberOfMatchPoints + 2);
+    for (SizeValueType j = 0; j < m_NumberOfMatchPoints + 2; j++) {
+        quantilesFile>>quantiles[j];
+    }
+    if (!quantilesFile) {
+        return false;
+    }
+
+    m_NumberOfReferencePixels = pixels;
+    m_ReferenceMinValue = static_cast<THistogramMeasurement>(minValue);
+    m_ReferenceMaxValue = static_cast<THistogramMeasurement>(maxValue);
+    m_ReferenceQuantiles.swap(quantiles);
+    this->Modified();
+    return true;
+}
+
+template< typename TInput, typename TOutput, typename THistogramMeasurement >
+bool
+QuantileHistogramMatchingImageFilter< TInput, TOutput, THistogramMeasurement >
+::WriteReferenceQuantiles(const std::string & fileName) const
+{
+    //Written aside and renamed, so concurrent runs never read a partial file
+    const std::string partialFileName = fileName + ".partial";
+    std::ofstream quantilesFile(partialFileName.c_str());
+    quantilesFile.precision(std::numeric_limits<double>::digits10 + 2);
+    quantilesFile<<QUANTILE_FILE_SIGNATURE<<" "<<QUANTILE_FILE_VERSION<<std::endl;
+    quantilesFile<<"NumberOfHistogramLevels "<<m_NumberOfHistogramLevels<<std::endl;
+    quantilesFile<<"NumberOfMatchPoints "<<m_NumberOfMatchPoints<<std::endl;
+    quantilesFile<<"ThresholdAtMeanIntensity "<<m_ThresholdAtMeanIntensity<<std::endl;
+    quantilesFile<<"NumberOfReferencePixels "<<m_NumberOfReferencePixels<<std::endl;
+    quantilesFile<<"ReferenceMinimum "<<static_cast<double>(m_ReferenceMinValue)<<std::endl;
+    quantilesFile<<"ReferenceMaximum "<<static_cast<double>(m_ReferenceMaxValue)<<std::endl;
+    quantilesFile<<"Quantiles"<<std::endl;
+    for (SizeValueType j = 0; j < m_ReferenceQuantiles.size(); j++) {
+        quantilesFile<<m_ReferenceQuantiles[j]<<std::endl;
+    }
+    quantilesFile.close();
+    if (!quantilesFile) {
+        std::remove(partialFileName.c_str());
+        return false;
+    }
+    std::remove(fileName.c_str());
+    return std::rename(partialFileName.c_str(), fileName.c_str()) == 0;
+}
+
+template< typename TInput, typename TOutput, typename THistogramMeasurement >
+void
+QuantileHistogramMatchingImageFilter< TInput, TOutput, THistogramMeasurement >
+::BeforeThreadedGenerateData()
+{
+    if (m_ReferenceQuantiles.size() != m_NumberOfMatchPoints + 2) {
+        itkExceptionMacro(<<"The reference quantiles were not set for "<<m_NumberOfMatchPoints<<" match points");
+    }
+
+    computeQuantiles(this->GetInput(), m_SourceMinValue, m_SourceMaxValue, m_SourceQuantiles);
+
+    //Gradients of the piecewise linear mapping, as in the itk::HistogramMatchingImageFilter
+    m_Gradients.resize(m_NumberOfMatchPoints + 1);
+    double denominator;
+    for (SizeValueType j = 0; j < m_NumberOfMatchPoints + 1; j++) {
+        denominator = m_SourceQuantiles[j + 1] - m_SourceQuantiles[j];
+        if (denominator != 0) {
+            m_Gradients[j] = (m_ReferenceQuantiles[j + 1] - m_ReferenceQuantiles[j])/denominator;
+        }else{
+            m_Gradients[j] = 0.0;
+        }
+    }
+
+    denominator = m_SourceQuantiles[0] - m_SourceMinValue;
+    if (denominator != 0) {
+        m_LowerGradient = (m_ReferenceQuantiles[0] - m_ReferenceMinValue)/denominator;
+    }else{
+        m_LowerGradient = 0.0;
+    }
+
+    denominator = m_SourceQuantiles[m_NumberOfMatchPoints + 1] - m_SourceMaxValue;
+    if (denominator != 0) {
+        m_UpperGradient = (m_ReferenceQuantiles[m_NumberOfMatchPoints + 1] - m_ReferenceMaxValue)/denominator;
+    }else{
+        m_UpperGradient = 0.0;
+    }
+}
+
+template< typename TInput, typename TOutput, typename THistogramMeasurement >
+void
+QuantileHistogramMatchingImageFilter< TInput, TOutput, THistogramMeasurement >
+::ThreadedGenerateData(const OutputImageRegionType & outputRegionForThread, ThreadIdType threadId)
+{
+    ProgressReporter progress(this, threadId, outputRegionForThread.GetNumberOfPixels());
+
+    itk::ImageRegionConstIterator<TInput> inputIterator(this->GetInput(), outputRegionForThread);
+    itk::ImageRegionIterator<TOutput> outputIterator(this->GetOutput(), outputRegionForThread);
+
+    const SizeValueType numberOfPoints = m_NumberOfMatchPoints + 2;
+    while (!inputIterator.IsAtEnd()) {
+        const double srcValue = static_cast<double>(inputIterator.Get());
+        //First point of the table above the value (the table is sorted, so a binary search
+        //finds the segment the linear scan of the itk::HistogramMatchingImageFilter finds)
+        const SizeValueType j = std::upper_bound(m_SourceQuantiles.begin(), m_SourceQuantiles.end(), srcValue) -
+                                m_SourceQuantiles.begin();
+        double mappedValue;
+        if (j == 0) {
+            //Linear interpolate from min to point[0]
+            mappedValue = m_ReferenceMinValue + (srcValue - m_SourceMinValue)*m_LowerGradient;
+        }else if (j == numberOfPoints) {
+            //Linear interpolate from point[m_NumberOfMatchPoints+1] to max
+            mappedValue = m_ReferenceMaxValue + (srcValue - m_SourceMaxValue)*m_UpperGradient;
+        }else{
+            //Linear interpolate from point[j] and point[j+1]
+            mappedValue = m_ReferenceQuantiles[j - 1] + (srcValue - m_SourceQuantiles[j - 1])*m_Gradients[j - 1];
+        }
+        outputIterator.Set(static_cast<OutputPixelType>(mappedValue));
+        ++inputIterator;
+        ++outputIterator;
+        progress.CompletedPixel();
+    }
+}
+
+} // end namespace itk
+
+#endif
@@ -0,0 +1,423 @@
+#include "itkImageFileWriter.h"
+#include "itkMultiThreader.h"
+#include "itkTimeProbe.h"
+#include "itkVersion.h"
+
+#include "itkHistogramMatchingImageFilter.h"
+#include "itkSubtractImageFilter.h"
+#include "itkAbsImageFilter.h"
+#include "itkRescaleIntensityImageFilter.h"
+#include "itkMaskImageFilter.h"
+#include "itkStatisticsImageFilter.h"
+#include "itkScalarImageKmeansImageFilter.h"
+#include "itkBayesianClassifierInitializationImageFilter.h"
+#include "itkBayesianClassifierImageFilter.h"
+#include "itkLogisticContrastEnhancementImageFilter.h"
+#include "itkTScoreLesionImageFilter.h"
+
+#include "itksys/SystemTools.hxx"
+
+#include "SyntheticDTIVolumes.h"
+
+#include <algorithm>
+#include <cstdlib>
+#include <ctime>
+#include <fstream>
+#include <iostream>
+#include <sstream>
+#include <vector>
+
+/** MSLesionTrack benchmark suite
+ *
+ * Times the key filters of the segmentation CLIs (histogram matching, logistic
+ * contrast enhancement, k-means, Bayesian classifier and T-Score) and the CLIs
+ * themselves on synthetic DTI-like volumes, for each volume grid and number of
+ * threads, and writes the timings as JSON:
+ *
+ *   MSLesionTrackBenchmark results.json [--sizes 2mm,1mm,0.5mm] [--threads 1,2,4]
+ *       [--repetitions 3] [--workFolder folder] [--LSDPBrainSegmentation executable]
+ *       [--ClusteringScalarDiffusionSegmentation executable] [--BayesianDTISegmentation executable]
+ *
+ * The CLIs read their templates from the MSLesionTrack-Data folder of the home
+ * directory, so they are run with HOME pointing to synthetic templates written in
+ * the work folder. The CLIs only accept the 2mm and 1mm grids.
+ */
+
+using namespace MSLesionTrackBenchmark;
+
+namespace
+{
+
+struct BenchmarkResult
+{
+    std::string         benchmark;
+    std::string         grid;
+    unsigned long       voxels;
+    unsigned int        threads;
+    std::vector<double> times;
+};
+
+std::vector<std::string> SplitList(const std::string & list)
+{
+    std::vector<std::string> items;
+    std::stringstream stream(list);
+    std::string item;
+    while (std::getline(stream, item, ',')) {
+        if (!item.empty()) {
+            items.push_back(item);
+        }
+    }
+    return items;
+}
+
+double Median(std::vector<double> values)
+{
+    std::sort(values.begin(), values.end());
+    size_t middle = values.size() / 2;
+    return values.size() % 2 ? values[middle] : 0.5 * (values[middle - 1] + values[middle]);
+}
+
+template <class TImage>
+void WriteImage(const TImage* image, const std::string & fileName)
+{
+    typedef itk::ImageFileWriter<TImage> WriterType;
+    typename WriterType::Pointer writer = WriterType::New();
+    writer->SetFileName(fileName.c_str());
+    writer->SetInput(image);
+    writer->SetUseCompression(1);
+    writer->Update();
+}
+
+/** Rescaled absolute difference to the template inside the white matter, the image
+ *  enhanced and classified by the Clustering and Bayesian CLIs. */
+ImageType::Pointer DifferenceImage(ImageType* map, ImageType* reference, ImageType* wmMask)
+{
+    typedef itk::SubtractImageFilter<ImageType, ImageType, ImageType> SubtractType;
+    SubtractType::Pointer subtract = SubtractType::New();
+    subtract->SetInput1(reference);
+    subtract->SetInput2(map);
+
+    typedef itk::AbsImageFilter<ImageType, ImageType> AbsoluteType;
+    AbsoluteType::Pointer abs = AbsoluteType::New();
+    abs->SetInput(subtract->GetOutput());
+
+    typedef itk::RescaleIntensityImageFilter<ImageType, ImageType> RescalerType;
+    RescalerType::Pointer rescaler = RescalerType::New();
+    rescaler->SetOutputMinimum(0.0);
+    rescaler->SetOutputMaximum(1.0);
+    rescaler->SetInput(abs->GetOutput());
+
+    typedef itk::MaskImageFilter<ImageType, ImageType> MaskFilterType;
+    MaskFilterType::Pointer mask = MaskFilterType::New();
+    mask->SetInput(rescaler->GetOutput());
+    mask->SetMaskImage(wmMask);
+    mask->Update();
+
+    ImageType::Pointer difference = mask->GetOutput();
+    difference->DisconnectPipeline();
+    return difference;
+}
+
+/** Run the key filters once, adding the time of each one to the results. */
+void TimeFilters(ImageType* map, ImageType* reference, ImageType* stdMap, ImageType* difference,
+                 VectorImageType* priors, std::vector<BenchmarkResult*> & results)
+{
+    // Histogram matching of the map to the template, as done by the Clustering and Bayesian CLIs
+    {
+        typedef itk::HistogramMatchingImageFilter<ImageType, ImageType> HistogramMatchType;
+        HistogramMatchType::Pointer histogramMatch = HistogramMatchType::New();
+        histogramMatch->SetSourceImage(map);
+        histogramMatch->SetReferenceImage(reference);
+        histogramMatch->SetNumberOfHistogramLevels(128);
+        histogramMatch->SetNumberOfMatchPoints(10000);
+        itk::TimeProbe probe;
+        probe.Start();
+        histogramMatch->Update();
+        probe.Stop();
+        results[0]->times.push_back(probe.GetTotal());
+    }
+
+    // Sigmoid parameters estimation
+    {
+        typedef itk::LogisticContrastEnhancementImageFilter<ImageType, ImageType> LogisticType;
+        LogisticType::Pointer logistic = LogisticType::New();
+        logistic->SetInput(difference);
+        logistic->SetThresholdMethod(LogisticType::OTSU);
+        itk::TimeProbe probe;
+        probe.Start();
+        logistic->Update();
+        probe.Stop();
+        results[1]->times.push_back(probe.GetTotal());
+    }
+
+    // K-means with the initial means of the Clustering CLI (two classes)
+    {
+        typedef itk::StatisticsImageFilter<ImageType> StatisticsType;
+        StatisticsType::Pointer statistics = StatisticsType::New();
+        statistics->SetInput(difference);
+        statistics->Update();
+
+        typedef itk::ScalarImageKmeansImageFilter<ImageType> KMeansFilterType;
+        KMeansFilterType::Pointer kmeans = KMeansFilterType::New();
+        kmeans->SetInput(difference);
+        double classStep = statistics->GetSigma();
+        kmeans->AddClassWithInitialMean(classStep);
+        kmeans->AddClassWithInitialMean(2.0 * classStep);
+        itk::TimeProbe probe;
+        probe.Start();
+        kmeans->Update();
+        probe.Stop();
+        results[2]->times.push_back(probe.GetTotal());
+    }
+
+    // Bayesian classifier with the lesion priors, as done by the Bayesian CLI
+    {
+        typedef itk::BayesianClassifierInitializationImageFilter<ImageType> BayesianInitializerType;
+        BayesianInitializerType::Pointer initializer = BayesianInitializerType::New();
+        initializer->SetInput(difference);
+        initializer->SetNumberOfClasses(2);
+        itk::TimeProbe initializationProbe;
+        initializationProbe.Start();
+        initializer->Update();
+        initializationProbe.Stop();
+        results[3]->times.push_back(initializationProbe.GetTotal());
+
+        typedef itk::BayesianClassifierImageFilter<VectorImageType, unsigned char, float, float> ClassifierFilterType;
+        ClassifierFilterType::Pointer classifier = ClassifierFilterType::New();
+        classifier->SetInput(initializer->GetOutput());
+        classifier->SetPriors(priors);
+        itk::TimeProbe probe;
+        probe.Start();
+        classifier->Update();
+        probe.Stop();
+        results[4]->times.push_back(probe.GetTotal());
+    }
+
+    // LSDP T-Score
+    {
+        typedef itk::Image<unsigned char, 3> LabelImageType;
+        typedef itk::TScoreLesionImageFilter<ImageType, LabelImageType> TScoreType;
+        TScoreType::Pointer tScore = TScoreType::New();
+        tScore->SetInput(map);
+        tScore->SetMeanImage(reference);
+        tScore->SetStdImage(stdMap);
+        tScore->SetTScoreThreshold(2.5);
+        tScore->SetLesionTail(TScoreType::LOWTAIL);
+        itk::TimeProbe probe;
+        probe.Start();
+        tScore->Update();
+        probe.Stop();
+        results[5]->times.push_back(probe.GetTotal());
+    }
+}
+
+/** Write the synthetic templates read by the CLIs under home/MSLesionTrack-Data. */
+void WriteSyntheticTemplates(const std::string & home, const std::string & resolution, ImageType* reference,
+                             ImageType* stdMap, ImageType* wmMask, VectorImageType* priors)
+{
+    std::string dataFolder = home + "/MSLesionTrack-Data";
+    itksys::SystemTools::MakeDirectory((dataFolder + "/StatisticalBrainSegmentation-Templates").c_str());
+    itksys::SystemTools::MakeDirectory((dataFolder + "/WMTracts-Templates").c_str());
+    itksys::SystemTools::MakeDirectory((dataFolder + "/Structural-Templates").c_str());
+
+    WriteImage(reference, dataFolder + "/StatisticalBrainSegmentation-Templates/USP-ICBM-FAmean-131-" + resolution + ".nii.gz");
+    WriteImage(stdMap, dataFolder + "/StatisticalBrainSegmentation-Templates/USP-ICBM-FAstd-131-" + resolution + ".nii.gz");
+    WriteImage(priors, dataFolder + "/StatisticalBrainSegmentation-Templates/USP-ICBM-MSLesionPriors-46-" + resolution + ".nii.gz");
+    WriteImage(wmMask, dataFolder + "/WMTracts-Templates/JHU-ICBM-labels-" + resolution + "-mask.nii.gz");
+    WriteImage(wmMask, dataFolder + "/Structural-Templates/MNI152_T1_" + resolution + "_brain_wm.nii.gz");
+}
+
+/** Run a CLI command line and return its wall time, or a negative value if it failed. */
+double TimeCommand(const std::string & command)
+{
+    itk::TimeProbe probe;
+    probe.Start();
+    int status = std::system(command.c_str());
+    probe.Stop();
+    if (status != 0) {
+        std::cerr << "Command failed (" << status << "): " << command << std::endl;
+        return -1.0;
+    }
+    return probe.GetTotal();
+}
+
+std::string Quoted(const std::string & text)
+{
+    return "\"" + text + "\"";
+}
+
+void WriteResults(const std::string & fileName, const std::vector<BenchmarkResult> & results,
+                  unsigned int repetitions, unsigned int platformThreads)
+{
+    std::ofstream json(fileName.c_str());
+    json << "{\n";
+    json << "  \"itkVersion\": \"" << itk::Version::GetITKVersion() << "\",\n";
+    json << "  \"date\": " << static_cast<long>(std::time(NULL)) << ",\n";
+    json << "  \"platformThreads\": " << platformThreads << ",\n";
+    json << "  \"repetitions\": " << repetitions << ",\n";
+    json << "  \"results\": [";
+    for (size_t r = 0; r < results.size(); r++) {
+        const BenchmarkResult & result = results[r];
+        json << (r ? ",\n" : "\n") << "    {\"benchmark\": \"" << result.benchmark << "\", \"grid\": \"" << result.grid
+             << "\", \"voxels\": " << result.voxels << ", \"threads\": " << result.threads << ", \"times\": [";
+        for (size_t t = 0; t < result.times.size(); t++) {
+            json << (t ? ", " : "") << result.times[t];
+        }
+        json << "]";
+        if (!result.times.empty()) {
+            json << ", \"min\": " << *std::min_element(result.times.begin(), result.times.end())
+                 << ", \"median\": " << Median(result.times);
+        }
+        json << "}";
+    }
+    json << "\n  ]\n}\n";
+}
+
+} // end of anonymous namespace
+
+int main( int argc, char * argv[] )
+{
+    if (argc < 2) {
+        std::cerr << "Usage: " << argv[0] << " <results.json> [--sizes 2mm,1mm,0.5mm] [--threads 1,2,4]"
+                  << " [--repetitions 3] [--workFolder folder] [--<CLI name> <CLI executable>]" << std::endl;
+        return EXIT_FAILURE;
+    }
+
+    const unsigned int platformThreads = itk::MultiThreader::GetGlobalDefaultNumberOfThreads();
+    std::string resultsFile = argv[1];
+    std::vector<std::string> sizes = SplitList("2mm,1mm,0.5mm");
+    std::vector<std::string> threadList;
+    unsigned int repetitions = 3;
+    std::string workFolder = itksys::SystemTools::GetFilenamePath(itksys::SystemTools::CollapseFullPath(resultsFile));
+    std::vector<std::pair<std::string, std::string> > clis;
+    for (int a = 2; a + 1 < argc; a += 2) {
+        std::string option = argv[a];
+        if (option == "--sizes") {
+            sizes = SplitList(argv[a + 1]);
+        }else if (option == "--threads") {
+            threadList = SplitList(argv[a + 1]);
+        }else if (option == "--repetitions") {
+            repetitions = std::max(1, atoi(argv[a + 1]));
+        }else if (option == "--workFolder") {
+            workFolder = argv[a + 1];
+        }else if (option == "--LSDPBrainSegmentation" || option == "--ClusteringScalarDiffusionSegmentation" ||
+                  option == "--BayesianDTISegmentation") {
+            clis.push_back(std::make_pair(option.substr(2), std::string(argv[a + 1])));
+        }else {
+            std::cerr << "Unknown option: " << option << std::endl;
+            return EXIT_FAILURE;
+        }
+    }
+
+    // By default from a single thread up to all the threads of the platform
+    std::vector<unsigned int> threads;
+    for (size_t t = 0; t < threadList.size(); t++) {
+        threads.push_back(std::max(1, atoi(threadList[t].c_str())));
+    }
+    if (threads.empty()) {
+        for (unsigned int n = 1; n < platformThreads; n *= 2) {
+            threads.push_back(n);
+        }
+        threads.push_back(platformThreads);
+    }
+
+    const char* filterNames[6] = { "HistogramMatchingImageFilter", "LogisticContrastEnhancementImageFilter",
+                                   "ScalarImageKmeansImageFilter", "BayesianClassifierInitializationImageFilter",
+                                   "BayesianClassifierImageFilter", "TScoreLesionImageFilter" };
+    std::vector<BenchmarkResult> results;
+    std::string home = workFolder + "/home";
+    std::string previousHome = itksys::SystemTools::GetEnv("HOME") ? itksys::SystemTools::GetEnv("HOME") : "";
+
+    for (size_t s = 0; s < sizes.size(); s++) {
+        VolumeGrid grid;
+        if (!GridFromName(sizes[s], grid)) {
+            std::cerr << "Unknown volume grid: " << sizes[s] << " (options: 2mm, 1mm, 0.5mm)" << std::endl;
+            return EXIT_FAILURE;
+        }
+        std::cout << "Generating the " << grid.name << " synthetic volumes..." << std::endl;
+        ImageType::Pointer map = SyntheticFAMap(grid, true, 1);
+        ImageType::Pointer reference = SyntheticFAMap(grid, false, 2);
+        ImageType::Pointer stdMap = SyntheticStdMap(grid);
+        ImageType::Pointer wmMask = SyntheticWhiteMatterMask(grid);
+        VectorImageType::Pointer priors = SyntheticLesionPriors(grid);
+        ImageType::Pointer difference = DifferenceImage(map, reference, wmMask);
+
+        for (size_t t = 0; t < threads.size(); t++) {
+            itk::MultiThreader::SetGlobalDefaultNumberOfThreads(threads[t]);
+            std::vector<BenchmarkResult*> filterResults;
+            size_t first = results.size();
+            for (unsigned int f = 0; f < 6; f++) {
+                BenchmarkResult result;
+                result.benchmark = filterNames[f];
+                result.grid = grid.name;
+                result.voxels = NumberOfVoxels(grid);
+                result.threads = threads[t];
+                results.push_back(result);
+            }
+            for (unsigned int f = 0; f < 6; f++) {
+                filterResults.push_back(&results[first + f]);
+            }
+            std::cout << "Timing the filters on " << grid.name << " with " << threads[t] << " threads..." << std::endl;
+            for (unsigned int r = 0; r < repetitions; r++) {
+                TimeFilters(map, reference, stdMap, difference, priors, filterResults);
+            }
+        }
+        itk::MultiThreader::SetGlobalDefaultNumberOfThreads(platformThreads);
+
+        if (clis.empty() || grid.name == "0.5mm") {
+            continue;
+        }
+        // Inputs and templates of the CLIs
+        std::string gridFolder = workFolder + "/" + grid.name;
+        itksys::SystemTools::MakeDirectory(gridFolder.c_str());
+        WriteSyntheticTemplates(home, grid.name, reference, stdMap, wmMask, priors);
+        WriteImage(map.GetPointer(), gridFolder + "/input-FA.nii.gz");
+        WriteImage(reference.GetPointer(), gridFolder + "/reference-FA.nii.gz");
+        itksys::SystemTools::PutEnv(("HOME=" + home).c_str());
+        itksys::SystemTools::PutEnv(("HOMEPATH=" + home).c_str());
+
+        for (size_t c = 0; c < clis.size(); c++) {
+            std::string input = Quoted(gridFolder + "/input-FA.nii.gz");
+            std::string referenceFile = Quoted(gridFolder + "/reference-FA.nii.gz");
+            std::string output = Quoted(gridFolder + "/" + clis[c].first + "-label.nii.gz");
+            std::string command = Quoted(clis[c].second);
+            if (clis[c].first == "LSDPBrainSegmentation") {
+                command += " --diffMap FractionalAnisotropy --diffMapRes " + grid.name +
+                           " --statMethod T-Score --tThr 2.5 " + input + " " + output;
+            }else if (clis[c].first == "ClusteringScalarDiffusionSegmentation") {
+                command += " --dtiMap FractionalAnisotropy --diffMapRes " + grid.name +
+                           " --thrMethod Otsu --nClass 2 " + input + " " + referenceFile + " " + output;
+            }else {
+                command += " --diffMap FractionalAnisotropy --diffMapRes " + grid.name +
+                           " --priors \"Multiple Sclerosis Lesions\" --thrMethod Otsu " + input + " " + referenceFile + " " + output;
+            }
+
+            for (size_t t = 0; t < threads.size(); t++) {
+                std::stringstream threadsVariable;
+                threadsVariable << "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=" << threads[t];
+                itksys::SystemTools::PutEnv(threadsVariable.str().c_str());
+
+                BenchmarkResult result;
+                result.benchmark = clis[c].first;
+                result.grid = grid.name;
+                result.voxels = NumberOfVoxels(grid);
+                result.threads = threads[t];
+                std::cout << "Timing " << clis[c].first << " on " << grid.name << " with " << threads[t] << " threads..." << std::endl;
+                for (unsigned int r = 0; r < repetitions; r++) {
+                    double time = TimeCommand(command);
+                    if (time < 0) {
+                        return EXIT_FAILURE;
+                    }
+                    result.times.push_back(time);
+                }
+                results.push_back(result);
+            }
+        }
+        itksys::SystemTools::PutEnv(("HOME=" + previousHome).c_str());
+        itksys::SystemTools::UnPutEnv("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS");
+    }
+
+    WriteResults(resultsFile, results, repetitions, platformThreads);
+    std::cout << "Benchmark results written in " << resultsFile << std::endl;
+    return EXIT_SUCCESS;
+}
@@ -0,0 +1,199 @@
+#ifndef __SyntheticDTIVolumes_h
+#define __SyntheticDTIVolumes_h
+
+#include "itkImage.h"
+#include "itkVectorImage.h"
+#include "itkImageRegionIteratorWithIndex.h"
+#include "itkMersenneTwisterRandomVariateGenerator.h"
+
+#include <string>
+
+/** Synthetic DTI-like volumes used by the MSLesionTrack benchmarks.
+ *
+ * The volumes follow a simple brain model centered in the field of view: a grey
+ * matter ellipsoid holding a white matter core, where a few spherical lesions are
+ * placed. FA-like maps are sampled on the ICBM template grids (2mm and 1mm) or on a
+ * supersampled grid (0.5mm), so the benchmarks scale as the real data does.
+ */
+namespace MSLesionTrackBenchmark
+{
+
+typedef itk::Image<float, 3>        ImageType;
+typedef itk::VectorImage<float, 3>  VectorImageType;
+
+enum Tissue {
+    BACKGROUND=0,
+    GREYMATTER=1,
+    WHITEMATTER=2,
+    LESION=3
+};
+
+/** Grid of the synthetic volumes, named as the map resolutions of the CLIs. */
+struct VolumeGrid
+{
+    std::string  name;
+    unsigned int size[3];
+    double       spacing;
+};
+
+inline bool GridFromName(const std::string & name, VolumeGrid & grid)
+{
+    // ICBM template grids, the supersampled grid halves the 1mm spacing
+    unsigned int sizes[3][3] = { {91, 109, 91}, {182, 218, 182}, {364, 436, 364} };
+    double spacings[3] = { 2.0, 1.0, 0.5 };
+    const char* names[3] = { "2mm", "1mm", "0.5mm" };
+    for (unsigned int g = 0; g < 3; g++) {
+        if (name == names[g]) {
+            grid.name = name;
+            for (unsigned int d = 0; d < 3; d++) {
+                grid.size[d] = sizes[g][d];
+            }
+            grid.spacing = spacings[g];
+            return true;
+        }
+    }
+    return false;
+}
+
+inline unsigned long NumberOfVoxels(const VolumeGrid & grid)
+{
+    return static_cast<unsigned long>(grid.size[0]) * grid.size[1] * grid.size[2];
+}
+
+/** Tissue of the brain model at a physical point (mm, origin at the volume corner). */
+inline Tissue TissueAt(const ImageType::PointType & point, const VolumeGrid & grid)
+{
+    double center[3];
+    for (unsigned int d = 0; d < 3; d++) {
+        center[d] = 0.5 * grid.size[d] * grid.spacing;
+    }
+    const double brainRadii[3] = { 70.0, 85.0, 65.0 };
+    const double whiteMatterRadii[3] = { 45.0, 60.0, 40.0 };
+    // Lesions as offsets to the center and radius, in mm
+    const double lesions[4][4] = { {20.0, 10.0, 5.0, 8.0}, {-18.0, -15.0, 10.0, 6.0},
+                                   {10.0, -30.0, -12.0, 5.0}, {-25.0, 25.0, -5.0, 4.0} };
+
+    double brainDistance = 0.0, whiteMatterDistance = 0.0;
+    for (unsigned int d = 0; d < 3; d++) {
+        double offset = point[d] - center[d];
+        brainDistance += (offset * offset) / (brainRadii[d] * brainRadii[d]);
+        whiteMatterDistance += (offset * offset) / (whiteMatterRadii[d] * whiteMatterRadii[d]);
+    }
+    if (brainDistance > 1.0) {
+        return BACKGROUND;
+    }
+    if (whiteMatterDistance > 1.0) {
+        return GREYMATTER;
+    }
+    for (unsigned int l = 0; l < 4; l++) {
+        double distance = 0.0;
+        for (unsigned int d = 0; d < 3; d++) {
+            double offset = point[d] - center[d] - lesions[l][d];
+            distance += offset * offset;
+        }
+        if (distance <= lesions[l][3] * lesions[l][3]) {
+            return LESION;
+        }
+    }
+    return WHITEMATTER;
+}
+
+inline ImageType::Pointer CreateImage(const VolumeGrid & grid)
+{
+    ImageType::RegionType region;
+    ImageType::SpacingType spacing;
+    for (unsigned int d = 0; d < 3; d++) {
+        region.SetSize(d, grid.size[d]);
+        spacing[d] = grid.spacing;
+    }
+    ImageType::Pointer image = ImageType::New();
+    image->SetRegions(region);
+    image->SetSpacing(spacing);
+    image->Allocate();
+    image->FillBuffer(0.0);
+    return image;
+}
+
+/** FA-like map with Gaussian noise. Without lesions, it plays the role of the DTI template. */
+inline ImageType::Pointer SyntheticFAMap(const VolumeGrid & grid, bool withLesions, unsigned int seed)
+{
+    typedef itk::Statistics::MersenneTwisterRandomVariateGenerator GeneratorType;
+    GeneratorType::Pointer generator = GeneratorType::New();
+    generator->Initialize(seed);
+
+    const float tissueFA[4] = { 0.0f, 0.2f, 0.45f, 0.2f };
+    ImageType::Pointer image = CreateImage(grid);
+    itk::ImageRegionIteratorWithIndex<ImageType> it(image, image->GetLargestPossibleRegion());
+    ImageType::PointType point;
+    for (it.GoToBegin(); !it.IsAtEnd(); ++it) {
+        image->TransformIndexToPhysicalPoint(it.GetIndex(), point);
+        Tissue tissue = TissueAt(point, grid);
+        if (tissue == LESION && !withLesions) {
+            tissue = WHITEMATTER;
+        }
+        if (tissue != BACKGROUND) {
+            float value = tissueFA[tissue] + static_cast<float>(0.03 * generator->GetNormalVariate());
+            it.Set(value < 0.0f ? 0.0f : (value > 1.0f ? 1.0f : value));
+        }
+    }
+    return image;
+}
+
+/** Standard deviation map of the statistical template: constant inside the brain. */
+inline ImageType::Pointer SyntheticStdMap(const VolumeGrid & grid)
+{
+    ImageType::Pointer image = CreateImage(grid);
+    itk::ImageRegionIteratorWithIndex<ImageType> it(image, image->GetLargestPossibleRegion());
+    ImageType::PointType point;
+    for (it.GoToBegin(); !it.IsAtEnd(); ++it) {
+        image->TransformIndexToPhysicalPoint(it.GetIndex(), point);
+        if (TissueAt(point, grid) != BACKGROUND) {
+            it.Set(0.05f);
+        }
+    }
+    return image;
+}
+
+/** Binary white matter mask (lesions included), used as the WM and fiber bundles masks. */
+inline ImageType::Pointer SyntheticWhiteMatterMask(const VolumeGrid & grid)
+{
+    ImageType::Pointer image = CreateImage(grid);
+    itk::ImageRegionIteratorWithIndex<ImageType> it(image, image->GetLargestPossibleRegion());
+    ImageType::PointType point;
+    for (it.GoToBegin(); !it.IsAtEnd(); ++it) {
+        image->TransformIndexToPhysicalPoint(it.GetIndex(), point);
+        Tissue tissue = TissueAt(point, grid);
+        if (tissue == WHITEMATTER || tissue == LESION) {
+            it.Set(1.0f);
+        }
+    }
+    return image;
+}
+
+/** Two class priors (non-lesion, lesion) as the MS lesion priors template. */
+inline VectorImageType::Pointer SyntheticLesionPriors(const VolumeGrid & grid)
+{
+    ImageType::Pointer reference = CreateImage(grid);
+    VectorImageType::Pointer priors = VectorImageType::New();
+    priors->SetRegions(reference->GetLargestPossibleRegion());
+    priors->SetSpacing(reference->GetSpacing());
+    priors->SetVectorLength(2);
+    priors->Allocate();
+
+    VectorImageType::PixelType prior(2);
+    itk::ImageRegionIteratorWithIndex<VectorImageType> it(priors, priors->GetLargestPossibleRegion());
+    ImageType::PointType point;
+    for (it.GoToBegin(); !it.IsAtEnd(); ++it) {
+        priors->TransformIndexToPhysicalPoint(it.GetIndex(), point);
+        Tissue tissue = TissueAt(point, grid);
+        float lesionPrior = (tissue == WHITEMATTER || tissue == LESION) ? 0.2f : 0.01f;
+        prior[0] = 1.0f - lesionPrior;
+        prior[1] = lesionPrior;
+        it.Set(prior);
+    }
+    return priors;
+}
+
+} // end namespace MSLesionTrackBenchmark
+
+#endif
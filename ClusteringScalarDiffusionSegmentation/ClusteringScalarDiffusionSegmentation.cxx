@@ -2,12 +2,17 @@
 #include "itkStatisticsImageFilter.hxx"
 
 // Utils
+#include "itkStreamingImageFilter.h"
+#include "itkImageRegionConstIteratorWithIndex.h"
+#include "itkImageRegionIterator.h"
+#include "itkRegionOfInterestImageFilter.h"
+#include "itkPasteImageFilter.h"
 #include "itkRescaleIntensityImageFilter.h"
 #include "itkAbsImageFilter.h"
 #include "itkMaskImageFilter.h"
 
 //Histogram Matching
-#include "itkHistogramMatchingImageFilter.h"
+#include "itkQuantileHistogramMatchingImageFilter.h"
 
 //Substract Image Filter
 #include "itkSubtractImageFilter.h"
@@ -30,6 +35,10 @@
 
 #include "itkPluginUtilities.h"
 
+#include <algorithm>
+#include <cmath>
+#include <vector>
+
 #include "ClusteringScalarDiffusionSegmentationCLP.h"
 
 #ifdef _WIN32
@@ -60,6 +69,183 @@ using namespace std;
 namespace
 {
 
+// Run the filters ending at image slab by slab, numberOfDivisions slabs along the
+// slowest axis, and return the buffered result. Only one slab of each voxelwise
+// intermediate image is kept in memory.
+template <class TImage>
+typename TImage::Pointer StreamedImage( TImage* image, unsigned int numberOfDivisions )
+{
+    typedef itk::StreamingImageFilter<TImage, TImage> StreamingType;
+    typename StreamingType::Pointer streamer = StreamingType::New();
+    streamer->SetInput(image);
+    streamer->SetNumberOfStreamDivisions(numberOfDivisions);
+    streamer->Update();
+    typename TImage::Pointer streamed = streamer->GetOutput();
+    streamed->DisconnectPipeline();
+    return streamed;
+}
+
+// Bounding box of the nonzero voxels of a mask, grown by margin voxels and kept inside
+// the image. The whole image is returned when the mask is empty.
+template <class TImage>
+typename TImage::RegionType MaskBoundingBox( const TImage* mask, unsigned int margin )
+{
+    typedef typename TImage::RegionType RegionType;
+    typedef typename TImage::IndexType  IndexType;
+
+    const RegionType largestRegion = mask->GetLargestPossibleRegion();
+    IndexType lower = largestRegion.GetUpperIndex();
+    IndexType upper = largestRegion.GetIndex();
+    bool found = false;
+    itk::ImageRegionConstIteratorWithIndex<TImage> it(mask, largestRegion);
+    for (it.GoToBegin(); !it.IsAtEnd(); ++it) {
+        if (it.Get() != 0) {
+            const IndexType index = it.GetIndex();
+            for (unsigned int d = 0; d < TImage::ImageDimension; d++) {
+                lower[d] = std::min(lower[d], index[d]);
+                upper[d] = std::max(upper[d], index[d]);
+            }
+            found = true;
+        }
+    }
+    if (!found) {
+        return largestRegion;
+    }
+
+    RegionType boundingBox;
+    for (unsigned int d = 0; d < TImage::ImageDimension; d++) {
+        lower[d] = std::max(lower[d] - static_cast<typename IndexType::IndexValueType>(margin), largestRegion.GetIndex()[d]);
+        upper[d] = std::min(upper[d] + static_cast<typename IndexType::IndexValueType>(margin), largestRegion.GetUpperIndex()[d]);
+        boundingBox.SetIndex(d, lower[d]);
+        boundingBox.SetSize(d, upper[d] - lower[d] + 1);
+    }
+    return boundingBox;
+}
+
+// Copy of the region of an image, which keeps its physical position
+template <class TImage>
+typename TImage::Pointer CropImage( TImage* image, const typename TImage::RegionType & region )
+{
+    typedef itk::RegionOfInterestImageFilter<TImage, TImage> CropType;
+    typename CropType::Pointer crop = CropType::New();
+    crop->SetInput(image);
+    crop->SetRegionOfInterest(region);
+    crop->Update();
+    typename TImage::Pointer cropped = crop->GetOutput();
+    cropped->DisconnectPipeline();
+    return cropped;
+}
+
+// Paste a cropped label back in a zero filled image with the grid of reference
+template <class TLabelImage, class TReferenceImage>
+typename TLabelImage::Pointer PasteLabel( TLabelImage* label, const TReferenceImage* reference,
+                                          const typename TLabelImage::RegionType & region )
+{
+    typename TLabelImage::Pointer fullLabel = TLabelImage::New();
+    fullLabel->CopyInformation(reference);
+    fullLabel->SetRegions(reference->GetLargestPossibleRegion());
+    fullLabel->Allocate();
+    fullLabel->FillBuffer(0);
+
+    //The label region is only known once the filter producing it ran
+    label->Update();
+
+    typedef itk::PasteImageFilter<TLabelImage, TLabelImage> PasteType;
+    typename PasteType::Pointer paste = PasteType::New();
+    paste->SetDestinationImage(fullLabel);
+    paste->SetSourceImage(label);
+    paste->SetSourceRegion(label->GetLargestPossibleRegion());
+    paste->SetDestinationIndex(region.GetIndex());
+    paste->Update();
+    typename TLabelImage::Pointer pasted = paste->GetOutput();
+    pasted->DisconnectPipeline();
+    return pasted;
+}
+
+// 1-D k-means with the Lloyd iterations of the itk::ScalarImageKmeansImageFilter, run on a
+// histogram of the image instead of its voxels: each bin keeps the number and the sum of its
+// voxels, is assigned as a whole to the class nearest to its mean and the class means are the
+// exact means of the voxels of their bins. An iteration then costs numberOfBins * classes,
+// whatever the image size. The voxels are labeled with the class of the nearest final mean
+// (the first class on ties), as the itk::ScalarImageKmeansImageFilter does.
+template <class TImage, class TLabelImage>
+typename TLabelImage::Pointer HistogramKmeans( const TImage* image, std::vector<double> & means,
+                                               unsigned int numberOfBins, unsigned int maximumIterations )
+{
+    typedef itk::ImageRegionConstIterator<TImage> IteratorType;
+    const typename TImage::RegionType region = image->GetBufferedRegion();
+
+    double minimum = itk::NumericTraits<double>::max();
+    double maximum = itk::NumericTraits<double>::NonpositiveMin();
+    IteratorType it(image, region);
+    for (it.GoToBegin(); !it.IsAtEnd(); ++it) {
+        const double value = static_cast<double>(it.Get());
+        minimum = std::min(minimum, value);
+        maximum = std::max(maximum, value);
+    }
+
+    std::vector<double> binCounts(numberOfBins, 0.0);
+    std::vector<double> binSums(numberOfBins, 0.0);
+    const double binScale = (maximum > minimum) ? static_cast<double>(numberOfBins)/(maximum - minimum) : 0.0;
+    for (it.GoToBegin(); !it.IsAtEnd(); ++it) {
+        const double value = static_cast<double>(it.Get());
+        const unsigned int bin = std::min(static_cast<unsigned int>((value - minimum)*binScale), numberOfBins - 1);
+        binCounts[bin] += 1.0;
+        binSums[bin] += value;
+    }
+
+    const unsigned int numberOfClasses = means.size();
+    std::vector<double> classCounts(numberOfClasses);
+    std::vector<double> classSums(numberOfClasses);
+    for (unsigned int iteration = 0; iteration < maximumIterations; iteration++) {
+        std::fill(classCounts.begin(), classCounts.end(), 0.0);
+        std::fill(classSums.begin(), classSums.end(), 0.0);
+        for (unsigned int bin = 0; bin < numberOfBins; bin++) {
+            if (binCounts[bin] == 0.0) {
+                continue;
+            }
+            const double binMean = binSums[bin]/binCounts[bin];
+            unsigned int nearest = 0;
+            for (unsigned int k = 1; k < numberOfClasses; k++) {
+                if (std::abs(binMean - means[k]) < std::abs(binMean - means[nearest])) {
+                    nearest = k;
+                }
+            }
+            classCounts[nearest] += binCounts[bin];
+            classSums[nearest] += binSums[bin];
+        }
+
+        //Classes without voxels keep their mean
+        bool changed = false;
+        for (unsigned int k = 0; k < numberOfClasses; k++) {
+            if (classCounts[k] > 0.0 && classSums[k]/classCounts[k] != means[k]) {
+                means[k] = classSums[k]/classCounts[k];
+                changed = true;
+            }
+        }
+        if (!changed) {
+            break;
+        }
+    }
+
+    typename TLabelImage::Pointer labelImage = TLabelImage::New();
+    labelImage->CopyInformation(image);
+    labelImage->SetRegions(region);
+    labelImage->Allocate();
+    itk::ImageRegionIterator<TLabelImage> labelIt(labelImage, region);
+    for (it.GoToBegin(), labelIt.GoToBegin(); !it.IsAtEnd(); ++it, ++labelIt) {
+        const double value = static_cast<double>(it.Get());
+        unsigned int nearest = 0;
+        for (unsigned int k = 1; k < numberOfClasses; k++) {
+            if (std::abs(value - means[k]) < std::abs(value - means[nearest])) {
+                nearest = k;
+            }
+        }
+        labelIt.Set(static_cast<typename TLabelImage::PixelType>(nearest));
+    }
+    return labelImage;
+}
+
 template <class T>
 int DoIt( int argc, char * argv[], T )
 {
@@ -90,18 +276,65 @@ int DoIt( int argc, char * argv[], T )
     typename ReaderType::Pointer maskReader = ReaderType::New();
     typename ReaderType::Pointer wmReader = ReaderType::New();
 
+    //Read the whole white matter mask
+    stringstream wmFile_path;
+    if (mapResolution == "1mm") {
+        wmFile_path<<HOME_DIR<<WHITEMATTERTEMPLATESFOLDER<<PATH_SEPARATOR<<"MNI152_T1_1mm_brain_wm.nii.gz";
+    }else{
+        wmFile_path<<HOME_DIR<<WHITEMATTERTEMPLATESFOLDER<<PATH_SEPARATOR<<"MNI152_T1_2mm_brain_wm.nii.gz";
+    }
+    wmReader->SetFileName(wmFile_path.str().c_str());
+    wmReader->Update();
+    inputReader->Update();
+    referenceReader->Update();
+
+    //Crop the maps to the white matter bounding box, everything outside it is masked out at the end
+    typename InputImageType::Pointer inputImage = inputReader->GetOutput();
+    typename InputImageType::Pointer referenceImage = referenceReader->GetOutput();
+    typename InputImageType::Pointer wmImage = wmReader->GetOutput();
+    typename InputImageType::RegionType cropRegion = wmImage->GetLargestPossibleRegion();
+    bool cropped = false;
+    if (cropWhiteMatter) {
+        if (inputImage->GetLargestPossibleRegion() != cropRegion || referenceImage->GetLargestPossibleRegion() != cropRegion) {
+            std::cout<<"The input volumes are not on the white matter template grid, they are not cropped"<<std::endl;
+        }else{
+            cropRegion = MaskBoundingBox<InputImageType>(wmImage, 2);
+            std::cout<<"White matter bounding box: index "<<cropRegion.GetIndex()<<" size "<<cropRegion.GetSize()<<std::endl;
+            inputImage = CropImage<InputImageType>(inputImage, cropRegion);
+            referenceImage = CropImage<InputImageType>(referenceImage, cropRegion);
+            wmImage = CropImage<InputImageType>(wmImage, cropRegion);
+            cropped = true;
+        }
+    }
+
     //Histogram matching step
-    typedef itk::HistogramMatchingImageFilter<InputImageType, InputImageType> HistogramMatchType;
+    typedef itk::QuantileHistogramMatchingImageFilter<InputImageType, InputImageType> HistogramMatchType;
     typename HistogramMatchType::Pointer histogramMatch = HistogramMatchType::New();
-    histogramMatch->SetSourceImage(inputReader->GetOutput());
-    histogramMatch->SetReferenceImage(referenceReader->GetOutput());
+    histogramMatch->SetInput(inputImage);
     histogramMatch->SetNumberOfHistogramLevels(128);
     histogramMatch->SetNumberOfMatchPoints(10000);
+    //The reference histogram only depends on the template, its quantiles are computed once and
+    //kept in the referenceQuantiles file
+    if (!referenceQuantiles.empty() &&
+        histogramMatch->ReadReferenceQuantiles(referenceQuantiles, referenceImage->GetBufferedRegion().GetNumberOfPixels())) {
+        std::cout<<"Reference quantiles read from "<<referenceQuantiles<<std::endl;
+    }else{
+        histogramMatch->ComputeReferenceQuantiles(referenceImage);
+        if (!referenceQuantiles.empty()) {
+            if (histogramMatch->WriteReferenceQuantiles(referenceQuantiles)) {
+                std::cout<<"Reference quantiles written in "<<referenceQuantiles<<std::endl;
+            }else{
+                std::cout<<"WARNING: The reference quantiles could not be written in "<<referenceQuantiles<<std::endl;
+            }
+        }
+    }
+    //The matching needs the whole histograms, so it runs once before the streamed filters
+    histogramMatch->Update();
 
     //Image subtraction with the DTI atlas
     typedef itk::SubtractImageFilter<InputImageType,InputImageType, InputImageType> SubtractType;
     typename SubtractType::Pointer subtract = SubtractType::New();
-    subtract->SetInput1(referenceReader->GetOutput());
+    subtract->SetInput1(referenceImage);
     subtract->SetInput2(histogramMatch->GetOutput());
 
     //Cleaning unrelated differences from the difference image
@@ -129,19 +362,27 @@ int DoIt( int argc, char * argv[], T )
         cleanVoxels->SetUpper(static_cast<InputPixelType>(0.0));
         cleanVoxels->SetOutsideValue(static_cast<InputPixelType>(0.0));
     }
-    cleanVoxels->Update();
 
     //Return absolute pixel values image
     typedef itk::AbsImageFilter<InputImageType, InputImageType> AbsoluteImageType;
     typename AbsoluteImageType::Pointer abs = AbsoluteImageType::New();
     abs->SetInput(cleanVoxels->GetOutput());
 
+    //The voxelwise subtraction, threshold and absolute value run slab by slab
+    typename InputImageType::Pointer difference = StreamedImage<InputImageType>(abs->GetOutput(), streamDivisions);
+    histogramMatch->GetOutput()->ReleaseData();
+
     //Rescale pixel intensity to [0,1] range
+    //The rescaling needs the extremes of the whole image, the difference is released once it is done
     typedef itk::RescaleIntensityImageFilter<InputImageType, InputImageType> RescalerType;
     typename RescalerType::Pointer rescaler = RescalerType::New();
     rescaler->SetOutputMinimum(0.0);
     rescaler->SetOutputMaximum(1.0);
-    rescaler->SetInput(abs->GetOutput());
+    rescaler->SetInput(difference);
+    difference->ReleaseDataFlagOn();
+    rescaler->Update();
+    typename InputImageType::Pointer rescaled = rescaler->GetOutput();
+    rescaled->DisconnectPipeline();
 
     //Mask white matter core fiber bundles
     //Read mask image file
@@ -153,17 +394,21 @@ int DoIt( int argc, char * argv[], T )
     }
     maskReader->SetFileName(maskFile_path.str().c_str());
     maskReader->Update();
+    typename InputImageType::Pointer maskImage = maskReader->GetOutput();
+    if (cropped) {
+        maskImage = CropImage<InputImageType>(maskImage, cropRegion);
+    }
 
     //Apply fiber bundles mask
     typedef itk::MaskImageFilter<InputImageType, InputImageType>    MaskFilterType;
     typename MaskFilterType::Pointer mask = MaskFilterType::New();
-    mask->SetInput(rescaler->GetOutput());
-    mask->SetMaskImage(maskReader->GetOutput());
+    mask->SetInput(rescaled);
+    mask->SetMaskImage(maskImage);
 
     //Find Sigmoid optimum parameters
     typedef itk::LogisticContrastEnhancementImageFilter<InputImageType, InputImageType> LogisticParametersType;
     typename LogisticParametersType::Pointer optSigmoid = LogisticParametersType::New();
-    optSigmoid->SetInput(mask->GetOutput());
+    optSigmoid->SetInput(StreamedImage<InputImageType>(mask->GetOutput(), streamDivisions));
     if (thrMethod == "MaxEntropy") {
         optSigmoid->SetThresholdMethod(LogisticParametersType::MAXENTROPY);
     }else if (thrMethod == "Otsu") {
@@ -177,57 +422,64 @@ int DoIt( int argc, char * argv[], T )
     }else if (thrMethod == "Yen") {
         optSigmoid->SetThresholdMethod(LogisticParametersType::YEN);
     }
-    optSigmoid->Update();
+    //Only the (alpha,beta) parameters are used, the sigmoid is applied on the unmasked image below
+    optSigmoid->ComputeLogisticParameters();
     std::cout<<"Optimum [Alpha,Beta] = [ "<<optSigmoid->GetAlpha()<<" , "<<optSigmoid->GetBeta()<<" ]"<<std::endl;
 
     //Sigmoid lesion enhancement step
     typedef itk::SigmoidImageFilter<InputImageType,InputImageType> SigmoidType;
     typename SigmoidType::Pointer sigmoid = SigmoidType::New();
-    sigmoid->SetInput(rescaler->GetOutput());
+    sigmoid->SetInput(rescaled);
     sigmoid->SetOutputMinimum(0);
     sigmoid->SetOutputMaximum(1);
     sigmoid->SetAlpha(optSigmoid->GetAlpha());
     sigmoid->SetBeta(optSigmoid->GetBeta());
 
-    //Mask the whole white matter
-    stringstream wmFile_path;
-    if (mapResolution == "1mm") {
-        wmFile_path<<HOME_DIR<<WHITEMATTERTEMPLATESFOLDER<<PATH_SEPARATOR<<"MNI152_T1_1mm_brain_wm.nii.gz";
-    }else{
-        wmFile_path<<HOME_DIR<<WHITEMATTERTEMPLATESFOLDER<<PATH_SEPARATOR<<"MNI152_T1_2mm_brain_wm.nii.gz";
-    }
-    wmReader->SetFileName(wmFile_path.str().c_str());
-    wmReader->Update();
-
     //Apply whole white matter mask
     typedef itk::MaskImageFilter<InputImageType, InputImageType>    MaskFilterType;
     typename MaskFilterType::Pointer maskWM = MaskFilterType::New();
     maskWM->SetInput(sigmoid->GetOutput());
-    maskWM->SetMaskImage(wmReader->GetOutput());
+    maskWM->SetMaskImage(wmImage);
 
     //Lesion segmentation by clustering approach
     //K-Means Segmentation Approach
     typedef itk::ScalarImageKmeansImageFilter< InputImageType > KMeansFilterType;
     typename KMeansFilterType::Pointer kmeansFilter = KMeansFilterType::New();
-    kmeansFilter->SetInput( maskWM->GetOutput() );
     const unsigned int numberOfInitialClasses = numClass;
 
     typedef itk::StatisticsImageFilter<InputImageType> StatisticsType;
     typename StatisticsType::Pointer statImage = StatisticsType::New();
     statImage->SetInput(sigmoid->GetOutput());
     statImage->Update();
+    //The statistics already computed the whole sigmoid image, the white matter mask runs slab by slab
+    typename InputImageType::Pointer maskedSigmoid = StreamedImage<InputImageType>(maskWM->GetOutput(), streamDivisions);
     double classStep=(2.0*statImage->GetSigma())/static_cast<InputPixelType>(numberOfInitialClasses);
     //        double classStep=(statImage->GetMaximum()-statImage->GetMinimum())/static_cast<InputPixelType>(numberOfInitialClasses);
+    std::vector<double> estimatedMeans;
     for( unsigned k=1; k <= numberOfInitialClasses; k++ )
     {
-        kmeansFilter->AddClassWithInitialMean(classStep*k);
+        estimatedMeans.push_back(classStep*k);
         std::cout<<"initClassGuess["<<k<<"]="<<classStep*k<<std::endl;
     }
 
-    kmeansFilter->Update();
+    typename OutputImageType::Pointer labelImage;
+    if (kmeansHistogramBins > 0) {
+        //The iterations run on the histogram of the masked sigmoid image
+        labelImage = HistogramKmeans<InputImageType, OutputImageType>(maskedSigmoid, estimatedMeans, kmeansHistogramBins, 200);
+    }else{
+        kmeansFilter->SetInput( maskedSigmoid );
+        for ( unsigned int i = 0; i < estimatedMeans.size(); ++i )
+        {
+            kmeansFilter->AddClassWithInitialMean(estimatedMeans[i]);
+        }
+        kmeansFilter->Update();
+
+        typename KMeansFilterType::ParametersType finalMeans = kmeansFilter->GetFinalMeans();
+        estimatedMeans.assign(finalMeans.begin(), finalMeans.end());
+        labelImage = kmeansFilter->GetOutput();
+    }
 
-    typename KMeansFilterType::ParametersType estimatedMeans = kmeansFilter->GetFinalMeans();
-    const unsigned int numberOfClasses = estimatedMeans.Size();
+    const unsigned int numberOfClasses = estimatedMeans.size();
     for ( unsigned int i = 0; i < numberOfClasses; ++i )
     {
         std::cout << "cluster[" << i << "] ";
@@ -235,10 +487,15 @@ int DoIt( int argc, char * argv[], T )
     }
 
 
+    //Paste the label of the white matter bounding box back in the template grid
+    if (cropped) {
+        labelImage = PasteLabel<OutputImageType, InputImageType>(labelImage, inputReader->GetOutput(), cropRegion);
+    }
+
     typename WriterType::Pointer writer = WriterType::New();
     writer->SetFileName( outputVolume.c_str() );
-    writer->SetInput( kmeansFilter->GetOutput() );
-    writer->SetUseCompression(1);
+    writer->SetInput( labelImage );
+    writer->SetUseCompression(useCompression);
     writer->Update();
 
 
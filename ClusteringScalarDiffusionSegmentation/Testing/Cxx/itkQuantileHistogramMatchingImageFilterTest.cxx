@@ -0,0 +1,132 @@
+#if defined(_MSC_VER)
+#pragma warning ( disable : 4786 )
+#endif
+
+#include "itkQuantileHistogramMatchingImageFilter.h"
+#include "itkHistogramMatchingImageFilter.h"
+#include "itkImageRegionConstIterator.h"
+#include "itkImageRegionIterator.h"
+
+#include "SyntheticDTIVolumes.h"
+
+// STD includes
+#include <cmath>
+#include <cstdlib>
+#include <iostream>
+#include <string>
+
+namespace
+{
+
+typedef MSLesionTrackBenchmark::ImageType   ImageType;
+
+/** Largest absolute difference between the images. */
+double MaximumDifference(const ImageType* image, const ImageType* baseline)
+{
+    itk::ImageRegionConstIterator<ImageType> imageIt(image, image->GetBufferedRegion());
+    itk::ImageRegionConstIterator<ImageType> baselineIt(baseline, baseline->GetBufferedRegion());
+    double maximumDifference = 0.0;
+    for (; !imageIt.IsAtEnd(); ++imageIt, ++baselineIt) {
+        const double difference = std::fabs(static_cast<double>(imageIt.Get()) - baselineIt.Get());
+        if (difference > maximumDifference) {
+            maximumDifference = difference;
+        }
+    }
+    return maximumDifference;
+}
+
+} // end of anonymous namespace
+
+int main(int argc, char* argv[])
+{
+    if (argc < 2) {
+        std::cerr<<"Usage: "<<argv[0]<<" referenceQuantilesFile"<<std::endl;
+        return EXIT_FAILURE;
+    }
+    const std::string quantilesFileName = argv[1];
+
+    typedef itk::QuantileHistogramMatchingImageFilter<ImageType, ImageType> QuantileMatchType;
+    typedef itk::HistogramMatchingImageFilter<ImageType, ImageType>         HistogramMatchType;
+
+    //Subject with lesions and a brighter contrast than the lesion free template
+    MSLesionTrackBenchmark::VolumeGrid grid;
+    MSLesionTrackBenchmark::GridFromName("2mm", grid);
+    ImageType::Pointer reference = MSLesionTrackBenchmark::SyntheticFAMap(grid, false, 2);
+    ImageType::Pointer source = MSLesionTrackBenchmark::SyntheticFAMap(grid, true, 1);
+    itk::ImageRegionIterator<ImageType> sourceIt(source, source->GetBufferedRegion());
+    for (; !sourceIt.IsAtEnd(); ++sourceIt) {
+        sourceIt.Set(1.5f*sourceIt.Get() + 0.1f);
+    }
+
+    //Settings of the Bayesian and Clustering CLIs
+    const itk::SizeValueType levels = 128;
+    const itk::SizeValueType matchPoints = 10000;
+    const double tolerance = 1.0e-5;
+    int status = EXIT_SUCCESS;
+    try {
+        HistogramMatchType::Pointer histogramMatch = HistogramMatchType::New();
+        histogramMatch->SetSourceImage(source);
+        histogramMatch->SetReferenceImage(reference);
+        histogramMatch->SetNumberOfHistogramLevels(levels);
+        histogramMatch->SetNumberOfMatchPoints(matchPoints);
+        histogramMatch->ThresholdAtMeanIntensityOn();
+        histogramMatch->Update();
+
+        QuantileMatchType::Pointer quantileMatch = QuantileMatchType::New();
+        quantileMatch->SetInput(source);
+        quantileMatch->SetNumberOfHistogramLevels(levels);
+        quantileMatch->SetNumberOfMatchPoints(matchPoints);
+        quantileMatch->ThresholdAtMeanIntensityOn();
+        quantileMatch->ComputeReferenceQuantiles(reference);
+        quantileMatch->Update();
+
+        double difference = MaximumDifference(quantileMatch->GetOutput(), histogramMatch->GetOutput());
+        std::cout<<"Computed quantiles: maximum difference "<<difference<<std::endl;
+        if (difference > tolerance) {
+            std::cerr<<"ERROR: The matching differs from the itk::HistogramMatchingImageFilter"<<std::endl;
+            status = EXIT_FAILURE;
+        }
+
+        //The quantiles read back from the file must give the same matching
+        if (!quantileMatch->WriteReferenceQuantiles(quantilesFileName)) {
+            std::cerr<<"ERROR: The reference quantiles could not be written in "<<quantilesFileName<<std::endl;
+            return EXIT_FAILURE;
+        }
+        const itk::SizeValueType referencePixels = reference->GetBufferedRegion().GetNumberOfPixels();
+        QuantileMatchType::Pointer readMatch = QuantileMatchType::New();
+        readMatch->SetInput(source);
+        readMatch->SetNumberOfHistogramLevels(levels);
+        readMatch->SetNumberOfMatchPoints(matchPoints);
+        if (!readMatch->ReadReferenceQuantiles(quantilesFileName, referencePixels)) {
+            std::cerr<<"ERROR: The reference quantiles could not be read from "<<quantilesFileName<<std::endl;
+            return EXIT_FAILURE;
+        }
+        readMatch->Update();
+
+        difference = MaximumDifference(readMatch->GetOutput(), quantileMatch->GetOutput());
+        std::cout<<"Read quantiles: maximum difference "<<difference<<std::endl;
+        if (difference != 0.0) {
+            std::cerr<<"ERROR: The matching changed with the quantiles read from the file"<<std::endl;
+            status = EXIT_FAILURE;
+        }
+
+        //A file of another reference or of other histogram parameters must be refused
+        QuantileMatchType::Pointer staleMatch = QuantileMatchType::New();
+        staleMatch->SetNumberOfHistogramLevels(levels);
+        staleMatch->SetNumberOfMatchPoints(matchPoints);
+        if (staleMatch->ReadReferenceQuantiles(quantilesFileName, referencePixels + 1)) {
+            std::cerr<<"ERROR: The quantiles of a reference with another number of pixels were read"<<std::endl;
+            status = EXIT_FAILURE;
+        }
+        staleMatch->SetNumberOfHistogramLevels(2*levels);
+        if (staleMatch->ReadReferenceQuantiles(quantilesFileName, referencePixels)) {
+            std::cerr<<"ERROR: The quantiles of other histogram levels were read"<<std::endl;
+            status = EXIT_FAILURE;
+        }
+    } catch (itk::ExceptionObject & error) {
+        std::cerr<<error<<std::endl;
+        return EXIT_FAILURE;
+    }
+
+    return status;
+}
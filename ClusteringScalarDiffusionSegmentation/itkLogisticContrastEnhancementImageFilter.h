@@ -37,6 +37,7 @@ public:
 
     typedef typename InputImageType::PixelType                 InputPixelType;
     typedef typename OutputImageType::PixelType                OutputPixelType;
+    typedef typename OutputImageType::RegionType               OutputImageRegionType;
 
     /** Set the maximum output. */
     itkSetMacro(MaximumOutput, double)
@@ -71,6 +72,10 @@ public:
     itkGetMacro(Tolerance, char)
     itkGetMacro(ThresholdMethod, unsigned char)
 
+    /** Compute the (Alpha,Beta) parameters from the whole input image, without
+     * generating the output. The input must be up to date. */
+    void ComputeLogisticParameters();
+
 #ifdef ITK_USE_CONCEPT_CHECKING
     // Begin concept checking
     itkConceptMacro( InputHasNumericTraitsCheck,
@@ -101,7 +106,11 @@ protected:
     unsigned int m_NumberOfBins;
     unsigned char m_ThresholdMethod;
 
-    void GenerateData();
+    /** The threshold and the maximum are computed on the whole input image. */
+    void GenerateInputRequestedRegion();
+
+    void BeforeThreadedGenerateData();
+    void ThreadedGenerateData(const OutputImageRegionType & outputRegionForThread, ThreadIdType threadId);
 private:
 //    const unsigned short MAX_TOLERANCE = 0.99;
     LogisticContrastEnhancementImageFilter(const Self &); //purposely not implemented
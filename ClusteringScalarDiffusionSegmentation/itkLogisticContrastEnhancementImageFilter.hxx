@@ -4,18 +4,19 @@
 
 
 //Threshold methods
-#include <itkMaximumEntropyThresholdImageFilter.h>
-#include <itkOtsuThresholdImageFilter.h>
-#include <itkIsoDataThresholdImageFilter.h>
-#include <itkRenyiEntropyThresholdImageFilter.h>
-#include <itkMomentsThresholdImageFilter.h>
-#include <itkYenThresholdImageFilter.h>
+#include <itkMaximumEntropyThresholdCalculator.h>
+#include <itkOtsuThresholdCalculator.h>
+#include <itkIsoDataThresholdCalculator.h>
+#include <itkRenyiEntropyThresholdCalculator.h>
+#include <itkMomentsThresholdCalculator.h>
+#include <itkYenThresholdCalculator.h>
 
 
 #include <itkImageRegionConstIterator.h>
 #include <itkImageRegionIterator.h>
-#include <itkStatisticsImageFilter.h>
-#include <itkSigmoidImageFilter.h>
+#include <itkImageToHistogramFilter.h>
+#include <itkMinimumMaximumImageFilter.h>
+#include <itkProgressReporter.h>
 
 #include <math.h>
 
@@ -41,171 +42,143 @@ LogisticContrastEnhancementImageFilter< TInput, TOutput >
 template< typename TInput, typename TOutput >
 void
 LogisticContrastEnhancementImageFilter< TInput, TOutput >
-::GenerateData()
+::GenerateInputRequestedRegion()
+{
+    Superclass::GenerateInputRequestedRegion();
+
+    InputImageType * input = const_cast< InputImageType * >( this->GetInput() );
+    if ( input ) {
+        input->SetRequestedRegionToLargestPossibleRegion();
+    }
+}
+
+template< typename TInput, typename TOutput >
+void
+LogisticContrastEnhancementImageFilter< TInput, TOutput >
+::ComputeLogisticParameters()
 {
     checkTolerance(m_Tolerance);
 
     //Input image
     typename InputImageType::ConstPointer input = this->GetInput();
-    //Output image
-    typename OutputImageType::Pointer output = this->GetOutput();
-    output->SetRegions(input->GetBufferedRegion());
-    output->Allocate();
+
+    //Image minimum and maximum, in a single multithreaded pass
+    typedef itk::MinimumMaximumImageFilter<InputImageType> MinimumMaximumType;
+    typename MinimumMaximumType::Pointer minimumMaximum = MinimumMaximumType::New();
+    minimumMaximum->SetInput(input);
+    minimumMaximum->SetNumberOfThreads(this->GetNumberOfThreads());
+    minimumMaximum->Update();
+    double minimum = static_cast<double>(minimumMaximum->GetMinimum());
+    double maximum = static_cast<double>(minimumMaximum->GetMaximum());
+
+    //Image histogram, shared by all the threshold methods. The bins are set as the threshold
+    //image filters do it (automatic minimum and maximum, with the default marginal scale)
+    typedef itk::Statistics::ImageToHistogramFilter<InputImageType> HistogramFilterType;
+    typedef typename HistogramFilterType::HistogramType HistogramType;
+    typename HistogramFilterType::Pointer histogramFilter = HistogramFilterType::New();
+    typename HistogramFilterType::HistogramSizeType histogramSize(1);
+    histogramSize.Fill(m_NumberOfBins);
+    typename HistogramFilterType::HistogramMeasurementVectorType binMinimum(1);
+    typename HistogramFilterType::HistogramMeasurementVectorType binMaximum(1);
+    binMinimum[0] = minimum;
+    binMaximum[0] = maximum + ((maximum - minimum)/static_cast<double>(m_NumberOfBins))/histogramFilter->GetMarginalScale();
+    histogramFilter->SetInput(input);
+    histogramFilter->SetNumberOfThreads(this->GetNumberOfThreads());
+    histogramFilter->SetHistogramSize(histogramSize);
+    histogramFilter->SetAutoMinimumMaximum(false);
+    histogramFilter->SetHistogramBinMinimum(binMinimum);
+    histogramFilter->SetHistogramBinMaximum(binMaximum);
+    histogramFilter->Update();
 
     //Image threshold
-    typedef itk::MaximumEntropyThresholdImageFilter<InputImageType, InputImageType>  MaxEntropyThresholdType;
-    typedef itk::OtsuThresholdImageFilter<InputImageType, InputImageType>  OstuThresholdType;
-    typedef itk::RenyiEntropyThresholdImageFilter<InputImageType, InputImageType>  RenyiThresholdType;
-    typedef itk::IsoDataThresholdImageFilter<InputImageType, InputImageType>  IsoDataThresholdType;
-    typedef itk::MomentsThresholdImageFilter<InputImageType, InputImageType>  MomentsThresholdType;
-    typedef itk::YenThresholdImageFilter<InputImageType, InputImageType>  YenThresholdType;
-
-    typename MaxEntropyThresholdType::Pointer maxEnThreshold = MaxEntropyThresholdType::New();
-    typename OstuThresholdType::Pointer otsuThreshold = OstuThresholdType::New();
-
-    typename RenyiThresholdType::Pointer renyiThreshold = RenyiThresholdType::New();
-    typename IsoDataThresholdType::Pointer isoDataThreshold = IsoDataThresholdType::New();
-    typename MomentsThresholdType::Pointer momentsThreshold = MomentsThresholdType::New();
-    typename YenThresholdType::Pointer yenThreshold = YenThresholdType::New();
-
-    double thr=0.0;
+    typedef itk::MaximumEntropyThresholdCalculator<HistogramType, InputPixelType>  MaxEntropyThresholdType;
+    typedef itk::OtsuThresholdCalculator<HistogramType, InputPixelType>  OstuThresholdType;
+    typedef itk::RenyiEntropyThresholdCalculator<HistogramType, InputPixelType>  RenyiThresholdType;
+    typedef itk::IsoDataThresholdCalculator<HistogramType, InputPixelType>  IsoDataThresholdType;
+    typedef itk::MomentsThresholdCalculator<HistogramType, InputPixelType>  MomentsThresholdType;
+    typedef itk::YenThresholdCalculator<HistogramType, InputPixelType>  YenThresholdType;
+
+    typedef itk::HistogramThresholdCalculator<HistogramType, InputPixelType>  ThresholdCalculatorType;
+    typename ThresholdCalculatorType::Pointer thresholdCalculator;
     switch (m_ThresholdMethod) {
     case MAXENTROPY:
-        maxEnThreshold->SetInput(input);
-        maxEnThreshold->SetInsideValue(0);
-        maxEnThreshold->SetOutsideValue(1);
-        maxEnThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        maxEnThreshold->Update();
-        thr=maxEnThreshold->GetThreshold();
+        thresholdCalculator = MaxEntropyThresholdType::New();
         break;
     case OTSU:
-        otsuThreshold->SetInput(input);
-        otsuThreshold->SetInsideValue(0);
-        otsuThreshold->SetOutsideValue(1);
-        otsuThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        otsuThreshold->Update();
-        thr=otsuThreshold->GetThreshold();
+        thresholdCalculator = OstuThresholdType::New();
         break;
     case RENYI:
-        renyiThreshold->SetInput(input);
-        renyiThreshold->SetInsideValue(0);
-        renyiThreshold->SetOutsideValue(1);
-        renyiThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        renyiThreshold->Update();
-        thr=renyiThreshold->GetThreshold();
+        thresholdCalculator = RenyiThresholdType::New();
         break;
     case MOMENTS:
-        momentsThreshold->SetInput(input);
-        momentsThreshold->SetInsideValue(0);
-        momentsThreshold->SetOutsideValue(1);
-        momentsThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        momentsThreshold->Update();
-        thr=momentsThreshold->GetThreshold();
+        thresholdCalculator = MomentsThresholdType::New();
         break;
     case ISODATA:
-        isoDataThreshold->SetInput(input);
-        isoDataThreshold->SetInsideValue(0);
-        isoDataThreshold->SetOutsideValue(1);
-        isoDataThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        isoDataThreshold->Update();
-        thr=isoDataThreshold->GetThreshold();
+        thresholdCalculator = IsoDataThresholdType::New();
         break;
     case YEN:
-        yenThreshold->SetInput(input);
-        yenThreshold->SetInsideValue(0);
-        yenThreshold->SetOutsideValue(1);
-        yenThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        yenThreshold->Update();
-        thr=yenThreshold->GetThreshold();
+        thresholdCalculator = YenThresholdType::New();
         break;
     default:
-        std::cout<<"ERROR: The threshold method is not valid! Choose the options available in the ThresholdMethod enumeration."<<std::endl;
-        exit(EXIT_FAILURE);
+        itkExceptionMacro(<<"The threshold method is not valid! Choose the options available in the ThresholdMethod enumeration.");
         break;
     }
+    thresholdCalculator->SetInput(histogramFilter->GetOutput());
+    thresholdCalculator->Update();
+    double thr=static_cast<double>(thresholdCalculator->GetThreshold());
 
     //Set Beta
-    typedef itk::StatisticsImageFilter<InputImageType> StatisticsType;
-    typename StatisticsType::Pointer imageStatistics = StatisticsType::New();
-    imageStatistics->SetInput(input);
-    imageStatistics->Update();
-
     double beta=0.0;
     if (m_FlipObjectArea) {
         beta = thr/2.0;
     }else{
-        beta = ((imageStatistics->GetMaximum()-thr)/2.0)+thr;
+        beta = ((maximum-thr)/2.0)+thr;
     }
 
-
-    //Adjust automatic tolerance
+    //Set Alpha, adjusting the automatic tolerance
+    double alpha=0.0;
     if (m_ManualTolerance) {
-        //Set Alpha
-        double alpha=0.0;
-        if (m_FlipObjectArea) {
-            alpha=((-1)*(thr)+beta)/(log((100.0-static_cast<double>(m_Tolerance))/static_cast<double>(m_Tolerance)));
-        }else{
-            alpha=((-1)*(thr)+beta)/(log((100.0-static_cast<double>(m_Tolerance))/static_cast<double>(m_Tolerance)));
-        }
-
-        //Apply sigmoid on input image
-        typedef itk::SigmoidImageFilter<InputImageType, OutputImageType> SigmoidFilterType;
-        typename SigmoidFilterType::Pointer sigmoid = SigmoidFilterType::New();
-        sigmoid->SetInput(input);
-        sigmoid->SetOutputMinimum(m_MinimumOutput);
-        sigmoid->SetOutputMaximum(m_MaximumOutput);
-        sigmoid->SetAlpha(alpha);
-        sigmoid->SetBeta(beta);
-        sigmoid->Update();
-
-        itk::ImageRegionConstIterator<TInput> sigmoidIterator(sigmoid->GetOutput(), sigmoid->GetOutput()->GetBufferedRegion());
-        itk::ImageRegionIterator<TOutput> outputIterator(output, output->GetBufferedRegion());
-
-        sigmoidIterator.IsAtBegin();
-        outputIterator.IsAtBegin();
-        while (!sigmoidIterator.IsAtEnd()) {
-            outputIterator.Set(sigmoidIterator.Get());
-            ++sigmoidIterator;
-            ++outputIterator;
-        }
-
-        //Output the (alpha,beta) parameters
-        m_Alpha=alpha;
-        m_Beta=beta;
+        alpha=((-1)*(thr)+beta)/(log((100.0-static_cast<double>(m_Tolerance))/static_cast<double>(m_Tolerance)));
     }else{
-
-        //Set Alpha
-        double alpha=0.0;
         if (m_FlipObjectArea) {
-            alpha=((-1)*(imageStatistics->GetMaximum())+beta)/(log(0.99/(1.0-0.99)));
+            alpha=((-1)*(maximum)+beta)/(log(0.99/(1.0-0.99)));
         }else{
-            alpha=((-1)*(imageStatistics->GetMaximum())+beta)/(log((1.0-0.99)/0.99));
+            alpha=((-1)*(maximum)+beta)/(log((1.0-0.99)/0.99));
         }
+    }
 
-        //Apply sigmoid on input image
-        typedef itk::SigmoidImageFilter<InputImageType, OutputImageType> SigmoidFilterType;
-        typename SigmoidFilterType::Pointer sigmoid = SigmoidFilterType::New();
-        sigmoid->SetInput(input);
-        sigmoid->SetOutputMinimum(m_MinimumOutput);
-        sigmoid->SetOutputMaximum(m_MaximumOutput);
-        sigmoid->SetAlpha(alpha);
-        sigmoid->SetBeta(beta);
-        sigmoid->Update();
-
-        itk::ImageRegionConstIterator<TInput> sigmoidIterator(sigmoid->GetOutput(), sigmoid->GetOutput()->GetBufferedRegion());
-        itk::ImageRegionIterator<TOutput> outputIterator(output, output->GetBufferedRegion());
-
-        sigmoidIterator.IsAtBegin();
-        outputIterator.IsAtBegin();
-        while (!sigmoidIterator.IsAtEnd()) {
-            outputIterator.Set(sigmoidIterator.Get());
-            ++sigmoidIterator;
-            ++outputIterator;
-        }
+    //Output the (alpha,beta) parameters
+    m_Alpha=alpha;
+    m_Beta=beta;
+}
 
-        //Output the (alpha,beta) parameters
-        m_Alpha=alpha;
-        m_Beta=beta;
+template< typename TInput, typename TOutput >
+void
+LogisticContrastEnhancementImageFilter< TInput, TOutput >
+::BeforeThreadedGenerateData()
+{
+    ComputeLogisticParameters();
+}
+
+template< typename TInput, typename TOutput >
+void
+LogisticContrastEnhancementImageFilter< TInput, TOutput >
+::ThreadedGenerateData(const OutputImageRegionType & outputRegionForThread, ThreadIdType threadId)
+{
+    //Logistic function applied straight into the output buffer, as in the itk::SigmoidImageFilter
+    ProgressReporter progress(this, threadId, outputRegionForThread.GetNumberOfPixels());
+
+    itk::ImageRegionConstIterator<TInput> inputIterator(this->GetInput(), outputRegionForThread);
+    itk::ImageRegionIterator<TOutput> outputIterator(this->GetOutput(), outputRegionForThread);
+
+    const double outputRange = m_MaximumOutput - m_MinimumOutput;
+    while (!inputIterator.IsAtEnd()) {
+        const double x = (static_cast<double>(inputIterator.Get()) - m_Beta)/m_Alpha;
+        const double e = 1.0/(1.0 + std::exp(-x));
+        outputIterator.Set(static_cast<OutputPixelType>(outputRange*e + m_MinimumOutput));
+        ++inputIterator;
+        ++outputIterator;
+        progress.CompletedPixel();
     }
 }
 
@@ -213,9 +186,9 @@ template<typename TInput, typename TOutput>
 void
 LogisticContrastEnhancementImageFilter<TInput, TOutput>
 ::checkTolerance(char tolerance) {
+    //Raised instead of exiting, so a CLI loaded in the application process does not terminate it
     if (tolerance > 100) {
-        std::cout<<"Tolerance is out of bound. Set in percentual (0 to 100)"<<std::endl;
-        exit(EXIT_FAILURE);
+        itkExceptionMacro(<<"Tolerance is out of bound. Set in percentual (0 to 100)");
     }
 }
 
@@ -0,0 +1,124 @@
+#ifndef __itkQuantileHistogramMatchingImageFilter_h
+#define __itkQuantileHistogramMatchingImageFilter_h
+#include "itkImageToImageFilter.h"
+#include "itkImage.h"
+#include "itkNumericTraits.h"
+
+#include <string>
+#include <vector>
+
+namespace itk
+{
+
+/** \class QuantileHistogramMatchingImageFilter
+ * Histogram matching of the input image to a reference, with the same mapping as the
+ * itk::HistogramMatchingImageFilter. The reference side of the quantile table (minimum,
+ * intensity threshold, maximum and match point quantiles) is set once, computed from the
+ * reference image or read from a sidecar file written earlier, so only the input image
+ * histogram is built on each update.
+ */
+template< typename TInputImage , typename TOutputImage, typename THistogramMeasurement = typename TInputImage::PixelType >
+class ITK_EXPORT QuantileHistogramMatchingImageFilter:
+        public ImageToImageFilter< TInputImage, TOutputImage >
+{
+public:
+    /** Extract dimension from inputs images, where it is assumed there are with the same type. */
+    itkStaticConstMacro(InputImageDimension, unsigned int,
+                        TInputImage::ImageDimension);
+    itkStaticConstMacro(OutputImageDimension, unsigned int,
+                        TOutputImage::ImageDimension);
+
+    /** Convenient typedefs for simplifying declarations. */
+    typedef TInputImage  InputImageType;
+    typedef TOutputImage OutputImageType;
+
+
+    /** Standard class typedefs. */
+    typedef QuantileHistogramMatchingImageFilter                  Self;
+    typedef ImageToImageFilter< TInputImage, TOutputImage >       Superclass;
+    typedef SmartPointer< Self >                                  Pointer;
+    typedef SmartPointer< const Self >                            ConstPointer;
+
+    /** Method for creation through the object factory. */
+    itkNewMacro(Self)
+
+    /** Run-time type information (and related methods). */
+    itkTypeMacro(QuantileHistogramMatchingImageFilter, ImageToImageFilter)
+
+    typedef typename InputImageType::PixelType                 InputPixelType;
+    typedef typename OutputImageType::PixelType                OutputPixelType;
+    typedef typename OutputImageType::RegionType               OutputImageRegionType;
+
+    /** Set the number of histogram levels. The reference quantiles must be set after it. */
+    itkSetMacro(NumberOfHistogramLevels, SizeValueType)
+
+    /** Set the number of match points. The reference quantiles must be set after it. */
+    itkSetMacro(NumberOfMatchPoints, SizeValueType)
+
+    /** Set if the background (voxels below the mean intensity) is left out of the histograms. */
+    itkSetMacro(ThresholdAtMeanIntensity, bool)
+    itkBooleanMacro(ThresholdAtMeanIntensity)
+
+    itkGetMacro(NumberOfHistogramLevels, SizeValueType)
+    itkGetMacro(NumberOfMatchPoints, SizeValueType)
+    itkGetMacro(ThresholdAtMeanIntensity, bool)
+
+    /** Compute the reference quantiles from the reference image. */
+    void ComputeReferenceQuantiles(const InputImageType * reference);
+
+    /** Read the reference quantiles from a file written by WriteReferenceQuantiles. Returns
+     * false, leaving the reference quantiles unchanged, when the file can not be read or was
+     * computed with other histogram parameters or on a reference with another number of pixels. */
+    bool ReadReferenceQuantiles(const std::string & fileName, SizeValueType numberOfReferencePixels);
+
+    /** Write the reference quantiles in a text file, replacing it. Returns false if it can not be written. */
+    bool WriteReferenceQuantiles(const std::string & fileName) const;
+
+#ifdef ITK_USE_CONCEPT_CHECKING
+    // Begin concept checking
+    itkConceptMacro( InputHasNumericTraitsCheck,
+                     ( Concept::HasNumericTraits< InputPixelType > ) );
+    itkConceptMacro( SameDimensionCheck,
+                     ( Concept::SameDimension< InputImageDimension, OutputImageDimension > ) );
+#endif
+
+protected:
+    QuantileHistogramMatchingImageFilter();
+    virtual ~QuantileHistogramMatchingImageFilter() {}
+    SizeValueType m_NumberOfHistogramLevels;
+    SizeValueType m_NumberOfMatchPoints;
+    bool m_ThresholdAtMeanIntensity;
+
+    //Reference side of the quantile table: intensity threshold, match point quantiles and maximum
+    SizeValueType m_NumberOfReferencePixels;
+    THistogramMeasurement m_ReferenceMinValue;
+    THistogramMeasurement m_ReferenceMaxValue;
+    std::vector<double> m_ReferenceQuantiles;
+
+    //Source side of the quantile table and mapping gradients, computed on each update
+    THistogramMeasurement m_SourceMinValue;
+    THistogramMeasurement m_SourceMaxValue;
+    std::vector<double> m_SourceQuantiles;
+    std::vector<double> m_Gradients;
+    double m_LowerGradient;
+    double m_UpperGradient;
+
+    /** The histogram is computed on the whole input image. */
+    void GenerateInputRequestedRegion();
+
+    void BeforeThreadedGenerateData();
+    void ThreadedGenerateData(const OutputImageRegionType & outputRegionForThread, ThreadIdType threadId);
+private:
+    QuantileHistogramMatchingImageFilter(const Self &); //purposely not implemented
+    void operator=(const Self &);  //purposely not implemented
+    void computeQuantiles(const InputImageType * image, THistogramMeasurement & minValue,
+                          THistogramMeasurement & maxValue, std::vector<double> & quantiles);
+};
+
+} // end namespace itk
+
+#ifndef ITK_MANUAL_INSTANTIATION
+#include "itkQuantileHistogramMatchingImageFilter.hxx"
+#endif
+
+#endif
@@ -1,6 +1,10 @@
 import os
 import sys
+import functools
+import numpy
+import subprocess
 import platform
+import signal
 import unittest
 
 from os.path import expanduser
@@ -11,6 +15,18 @@ from numpy.f2py.auxfuncs import throw_error
 from slicer.ScriptedLoadableModule import *
 import logging
 
+from DTILesionTrackLib.batch import CohortBatchRunner, readSubjectManifest, SUBJECT_VOLUME_KEYS
+from DTILesionTrackLib.checkpoint import PipelineCheckpoint, copyVolume, decompressFile
+from DTILesionTrackLib.fusion import fuseLabelVolumes, fusedLesionLabel, FUSION_RULES
+from DTILesionTrackLib.lsdp import segmentLSDPVolumes, segmentJointLSDPVolumes
+from DTILesionTrackLib.nodes import NodeScope
+from DTILesionTrackLib.parameters import completeParameters
+from DTILesionTrackLib.profiling import StageProfiler
+from DTILesionTrackLib.scheduler import StageScheduler
+from DTILesionTrackLib.sparselabels import SPARSE_LABEL_EXTENSION, sparseLabelFromVolume, writeSparseLabel
+from DTILesionTrackLib.templates import templateCache, dataFolder, referenceQuantilesFilePath, compactPriorsFilePath
+from DTILesionTrackLib.stagecache import StageCache, STAGE_CACHE_FOLDER_NAME
+
 #TODO Foram editadas as chamadas do slicer.loadVolumes, mas ainda nao foi testado este script (16/12/2016)
 #
 # DTILesionTrack
@@ -244,6 +260,36 @@ class DTILesionTrackWidget(ScriptedLoadableModuleWidget):
         parametersOutputFormLayout.addRow("Output in ICBM space",
                                           self.setUseICBMSpaceWidget)
 
+        #
+        # Reuse cached pre-processing and registration results
+        #
+        self.setUseStageCacheWidget = ctk.ctkCheckBox()
+        self.setUseStageCacheWidget.setChecked(False)
+        self.setUseStageCacheWidget.setToolTip(
+            "Reuse the pre-processing and registration results computed in previous runs with the same input images and parameters. The results are stored in the StageCache folder of the MSLesionTrack-Data directory.")
+        parametersOutputFormLayout.addRow("Reuse cached registrations",
+                                          self.setUseStageCacheWidget)
+
+        #
+        # Resume an interrupted run
+        #
+        self.setResumeWidget = ctk.ctkCheckBox()
+        self.setResumeWidget.setChecked(False)
+        self.setResumeWidget.setToolTip(
+            "Resume the processing from the last stage completed in the output folder by a previous run with the same input images and parameters.")
+        parametersOutputFormLayout.addRow("Resume from the output folder",
+                                          self.setResumeWidget)
+
+        #
+        # Uncompressed intermediate files
+        #
+        self.setUncompressedScratchWidget = ctk.ctkCheckBox()
+        self.setUncompressedScratchWidget.setChecked(False)
+        self.setUncompressedScratchWidget.setToolTip(
+            "Write the intermediate files of the output folder (registration inputs and outputs, segmentation results and checkpoints) without compression. It is faster on local disks, but takes more disk space. The final lesion label is always compressed.")
+        parametersOutputFormLayout.addRow("Uncompressed intermediate files",
+                                          self.setUncompressedScratchWidget)
+
         #
         # Noise Attenuation Parameters Area
         #
@@ -333,8 +379,9 @@ class DTILesionTrackWidget(ScriptedLoadableModuleWidget):
         self.setSegmentationApproachWidget.addItem("Bayesian")
         self.setSegmentationApproachWidget.addItem("LSDP")
         self.setSegmentationApproachWidget.addItem("SpatialClustering")
+        self.setSegmentationApproachWidget.addItem("JointLSDP")
         self.setSegmentationApproachWidget.setToolTip(
-            "Choose the DTI template where the input images will be registered. Options: Local Statistical Diffusibility Properties (LSDP), Spatial Clustering Outlier, Bayesian ...")
+            "Choose the DTI template where the input images will be registered. Options: Local Statistical Diffusibility Properties (LSDP), Spatial Clustering Outlier, Bayesian and Joint LSDP (all the DTI maps combined in a single T-Score) ...")
         parametersAdvancedFormLayout.addRow("Segmentation Approach ", self.setSegmentationApproachWidget)
 
         #
@@ -372,6 +419,74 @@ class DTILesionTrackWidget(ScriptedLoadableModuleWidget):
         self.setClusterNumberOfClassesWidget.setToolTip("Number of Classes where will be used to agregates the lesion voxel intensity. This parameter is only used when Segmentation Approach if SpatialClustering")
         parametersAdvancedFormLayout.addRow("Number of Classes ", self.setClusterNumberOfClassesWidget)
 
+        #
+        # K-Means Histogram Bins
+        #
+        self.setKmeansHistogramBinsWidget = qt.QSpinBox()
+        self.setKmeansHistogramBinsWidget.setMaximum(65536)
+        self.setKmeansHistogramBinsWidget.setMinimum(0)
+        self.setKmeansHistogramBinsWidget.setValue(0)
+        self.setKmeansHistogramBinsWidget.setToolTip("Number of histogram bins on which the SpatialClustering k-means iterates, instead of iterating on every voxel. A fine histogram (e.g. 4096 bins) gives the voxelwise class means up to the bin width in a fraction of the time, mostly with many classes or 1mm templates. Set 0 to iterate on the voxels.")
+        parametersAdvancedFormLayout.addRow("K-Means Histogram Bins ", self.setKmeansHistogramBinsWidget)
+
+        #
+        # DTI Labels Fusion
+        #
+        self.setLabelFusionRuleWidget = ctk.ctkComboBox()
+        for rule in FUSION_RULES:
+            self.setLabelFusionRuleWidget.addItem(rule)
+        self.setLabelFusionRuleWidget.setToolTip(
+            "Choose how the lesion labels found in each DTI map are combined. Options: Sum (number of maps that detected the lesion), Union (any map) and Majority (more than half of the maps).")
+        parametersAdvancedFormLayout.addRow("DTI Labels Fusion ", self.setLabelFusionRuleWidget)
+
+        #
+        # Crop to White Matter
+        #
+        self.setCropToWhiteMatterWidget = ctk.ctkCheckBox()
+        self.setCropToWhiteMatterWidget.setChecked(False)
+        self.setCropToWhiteMatterWidget.setToolTip("Run the SpatialClustering and Bayesian segmentations and the label smoothing only on the bounding box of the template white matter mask, which is faster. The histogram matching and the intensity statistics are then computed on the bounding box only, so the label may differ slightly.")
+        parametersAdvancedFormLayout.addRow("Crop to White Matter ", self.setCropToWhiteMatterWidget)
+
+        #
+        # Stream Divisions
+        #
+        self.setStreamDivisionsWidget = qt.QSpinBox()
+        self.setStreamDivisionsWidget.setMaximum(256)
+        self.setStreamDivisionsWidget.setMinimum(1)
+        self.setStreamDivisionsWidget.setValue(1)
+        self.setStreamDivisionsWidget.setToolTip("Number of slabs in which the segmentation CLIs process the voxelwise steps. Larger values lower the peak memory (e.g. to run several 1mm jobs on the same machine) without changing the result.")
+        parametersAdvancedFormLayout.addRow("Stream Divisions ", self.setStreamDivisionsWidget)
+
+        #
+        # Concurrent Stages
+        #
+        self.setStageConcurrencyWidget = qt.QSpinBox()
+        self.setStageConcurrencyWidget.setMaximum(8)
+        self.setStageConcurrencyWidget.setMinimum(1)
+        self.setStageConcurrencyWidget.setValue(2)
+        self.setStageConcurrencyWidget.setToolTip("Number of DTI map segmentations that may run at the same time. Each one runs its own CLI module, so more concurrent stages need more memory. The results do not depend on this value.")
+        parametersAdvancedFormLayout.addRow("Concurrent Stages ", self.setStageConcurrencyWidget)
+
+        #
+        # Template Cache Size
+        #
+        self.setTemplateCacheSizeWidget = qt.QSpinBox()
+        self.setTemplateCacheSizeWidget.setMaximum(65536)
+        self.setTemplateCacheSizeWidget.setMinimum(0)
+        self.setTemplateCacheSizeWidget.setSingleStep(256)
+        self.setTemplateCacheSizeWidget.setSuffix(" MB")
+        self.setTemplateCacheSizeWidget.setValue(1024)
+        self.setTemplateCacheSizeWidget.setToolTip("Memory kept by the brain templates loaded across runs. Above it the least recently used templates are removed from the scene and read again when a later run needs them. The templates of the current run are always kept.")
+        parametersAdvancedFormLayout.addRow("Template Cache Size ", self.setTemplateCacheSizeWidget)
+
+        #
+        # Keep Intermediate Nodes
+        #
+        self.setKeepIntermediatesWidget = ctk.ctkCheckBox()
+        self.setKeepIntermediatesWidget.setChecked(False)
+        self.setKeepIntermediatesWidget.setToolTip("Keep in the scene the intermediate volumes, transforms and labels of the run (e.g. to inspect the registrations). By default they are removed as soon as they are no longer needed, so the memory used by the scene does not grow from one run to the next.")
+        parametersAdvancedFormLayout.addRow("Keep Intermediate Nodes ", self.setKeepIntermediatesWidget)
+
         #
         # Apply Button
         #
@@ -407,21 +522,31 @@ class DTILesionTrackWidget(ScriptedLoadableModuleWidget):
                   , self.inputPerDSelector.currentNode()
                   , self.inputVRSelector.currentNode()
                   , self.outputSelector.currentNode()
-                  , self.TemporaryFolderSelector
-                  , self.setApplyBrainExtractedBooleanWidget
-                  , self.setApplyNoiseAttenuationWidget
-                  , self.setUseANTsnWidget
-                  , self.setUseICBMSpaceWidget
-                  , self.setFilteringCondutanceWidget
-                  , self.setFilteringNumberOfIterationWidget
-                  , self.setFilteringQWidget
-                  , self.setInterpolationMethodBooleanWidget
+                  , self.TemporaryFolderSelector.directory
+                  , self.setApplyBrainExtractedBooleanWidget.isChecked()
+                  , self.setApplyNoiseAttenuationWidget.isChecked()
+                  , self.setUseANTsnWidget.isChecked()
+                  , self.setUseICBMSpaceWidget.isChecked()
+                  , self.setFilteringCondutanceWidget.value
+                  , self.setFilteringNumberOfIterationWidget.value
+                  , self.setFilteringQWidget.value
+                  , self.setInterpolationMethodBooleanWidget.currentText
                   , self.setTemplateResolutionBooleanWidget.currentText
                   , self.setDTITemplateWidget.currentText
                   , self.setSegmentationApproachWidget.currentText
-                  , self.setLSDPThresholdQWidget
+                  , self.setLSDPThresholdQWidget.value
                   , self.setThresholdMethodWidget.currentText
-                  , self.setClusterNumberOfClassesWidget
+                  , self.setClusterNumberOfClassesWidget.value
+                  , labelFusionRule=self.setLabelFusionRuleWidget.currentText
+                  , useStageCache=self.setUseStageCacheWidget.isChecked()
+                  , resume=self.setResumeWidget.isChecked()
+                  , uncompressedScratch=self.setUncompressedScratchWidget.isChecked()
+                  , stageConcurrency=self.setStageConcurrencyWidget.value
+                  , cropToWhiteMatter=self.setCropToWhiteMatterWidget.isChecked()
+                  , streamDivisions=self.setStreamDivisionsWidget.value
+                  , kmeansHistogramBins=self.setKmeansHistogramBinsWidget.value
+                  , keepIntermediates="all" if self.setKeepIntermediatesWidget.isChecked() else ""
+                  , templateCacheSize=self.setTemplateCacheSizeWidget.value
                   )
 
 
@@ -467,10 +592,17 @@ class DTILesionTrackLogic(ScriptedLoadableModuleLogic):
             return False
         return True
 
+    # Optional DTI maps: (map name, template map type, segmentation CLI map type)
+    DTI_MAPS = [("MD", "MD", "MeanDiffusivity"), ("RA", "RA", "RelativeAnisotropy"),
+                ("PerD", "PerpDiff", "PerpendicularDiffusivity"), ("VR", "VR", "VolumeRatio")]
+
     def run(self, inputFLAIRVolume, inputT1Volume, inputFAVolume, inputMDVolume, inputRAVolume, inputPerDVolume,
-            inputVRVolume, outputLabelVolume, folderSelector, applyBET, applyNoiseAttenuation, applyQuickANTS, outputICBMSpace,
+            inputVRVolume, outputLabelVolume, outputFolder, applyBET, applyNoiseAttenuation, applyQuickANTS, outputICBMSpace,
             filterCondutance, filterNumInt, filterQ, interpolationMethod,templateDTIResolution, templateDTI,
-            segmentationApproach, lsdpTScoreThreshold, thresholdMethod, clusterNumberOfClasses):
+            segmentationApproach, lsdpTScoreThreshold, thresholdMethod, clusterNumberOfClasses,
+            labelFusionRule="Sum", lsdpInProcess=True, useStageCache=False, stageCacheFolder="", resume=False,
+            uncompressedScratch=False, stageConcurrency=2, cropToWhiteMatter=False, streamDivisions=1,
+            keepIntermediates="", kmeansHistogramBins=0, templateCacheSize=1024):
         """
     Run the actual algorithm
     """
@@ -483,14 +615,377 @@ class DTILesionTrackLogic(ScriptedLoadableModuleLogic):
         #################################################################################################################
         if not os.environ.has_key("ANTSPATH"):
             slicer.util.showStatusMessage("ERROR: ANTs registration toolkit is not installed in your system. Check the ANTSPATH variable.")
-            return True
+            return False
 
-        #################################################################################################################
-        #                   Start the pre-processing step: Brain extraction (optional) and Registration                 #
-        #################################################################################################################
+        # Optional DTI maps informed by the user
+        inputMaps = {"MD": inputMDVolume, "RA": inputRAVolume, "PerD": inputPerDVolume, "VR": inputVRVolume}
+        dtiMaps = [dtiMap for dtiMap in self.DTI_MAPS if inputMaps[dtiMap[0]] != None]
+
+        # Intermediate files are written uncompressed on request, only the final label is always gzipped
+        scratchExtension = "nii" if uncompressedScratch else "nii.gz"
+
+        # Stage manifest in the output folder, used to resume an interrupted run
+        checkpoint = PipelineCheckpoint(outputFolder,
+            {"FLAIR": inputFLAIRVolume, "T1": inputT1Volume, "FA": inputFAVolume, "MD": inputMDVolume,
+             "RA": inputRAVolume, "PerD": inputPerDVolume, "VR": inputVRVolume},
+            {"applyBET": applyBET, "applyNoiseAttenuation": applyNoiseAttenuation, "applyQuickANTS": applyQuickANTS,
+             "outputICBMSpace": outputICBMSpace, "filterCondutance": filterCondutance, "filterNumInt": filterNumInt,
+             "filterQ": filterQ, "interpolationMethod": interpolationMethod,
+             "templateDTIResolution": templateDTIResolution, "templateDTI": templateDTI,
+             "segmentationApproach": segmentationApproach, "lsdpTScoreThreshold": lsdpTScoreThreshold,
+             "thresholdMethod": thresholdMethod, "clusterNumberOfClasses": clusterNumberOfClasses,
+             "labelFusionRule": labelFusionRule, "lsdpInProcess": lsdpInProcess,
+             "uncompressedScratch": uncompressedScratch, "cropToWhiteMatter": cropToWhiteMatter,
+             "kmeansHistogramBins": kmeansHistogramBins},
+            resume, useCompression=not uncompressedScratch)
+
+        # Wall time, CPU time, peak memory and bytes written of each stage, reported in profile.json
+        profiler = StageProfiler(outputFolder)
+
+        # Nodes created by the run are removed from the scene once they are no longer used, except
+        # the groups of intermediates listed in keepIntermediates (see nodes.INTERMEDIATE_GROUPS)
+        nodeScope = NodeScope(keepIntermediates)
+
+        # (process, cache key) of the structural SyN registration running in background
+        structuralSyN = None
+        try:
+            #################################################################################################################
+            #                   Start the pre-processing step: Brain extraction (optional) and Registration                 #
+            #################################################################################################################
+
+            # Results of the preprocessing and registration stages are reused when the inputs did not change
+            stageCache = None
+            if useStageCache:
+                stageCache = StageCache(stageCacheFolder or os.path.join(dataFolder(), STAGE_CACHE_FOLDER_NAME))
+
+            profiler.start("preprocessing")
+            if checkpoint.isCompleted("preprocessing"):
+                checkpoint.restoreVolumes("preprocessing", {"T1": inputT1Volume, "FLAIR": inputFLAIRVolume})
+            else:
+                preprocessingParams = {"applyBET": applyBET, "applyNoiseAttenuation": applyNoiseAttenuation,
+                                       "filterCondutance": filterCondutance, "filterNumInt": filterNumInt, "filterQ": filterQ}
+                if stageCache:
+                    preprocessingKey = stageCache.key("preprocessing", [inputT1Volume, inputFLAIRVolume], preprocessingParams)
+                if stageCache and stageCache.restoreVolumes(preprocessingKey, {"T1": inputT1Volume, "FLAIR": inputFLAIRVolume}):
+                    slicer.util.showStatusMessage("Pre-processing: Using cached T1 and FLAIR pre-processing...")
+                else:
+                    self.preprocessStructuralVolumes(inputT1Volume, inputFLAIRVolume, **preprocessingParams)
+                    if stageCache:
+                        stageCache.storeNodes(preprocessingKey, {"T1": inputT1Volume, "FLAIR": inputFLAIRVolume})
+                checkpoint.complete("preprocessing", nodes={"T1": inputT1Volume, "FLAIR": inputFLAIRVolume})
+
+            profiler.start("templates")
+            slicer.util.showStatusMessage("Step 1/5: Reading brain templates...")
+            if platform.system() is "Windows":
+                home = expanduser("%userprofile%")
+            else:
+                home = expanduser("~")
+
+            # Templates are kept loaded between runs by the session template cache
+            templates = templateCache()
+            templates.beginRun()
+            templates.setMaximumMemorySize(templateCacheSize)
+
+            #Read FA and MNI152 T1 Templates
+            DTITemplateNode = templates.get("FA", templateDTI, templateDTIResolution)
+            T1TemplateBrain = templates.get("T1", templateDTI, templateDTIResolution)
+
+            #Read the templates of the optional DTI maps (MD, RA, Perp Diff and VR)
+            mapTemplates = {}
+            for (mapName, templateMapType, mapType) in dtiMaps:
+                mapTemplates[mapName] = templates.get(templateMapType, templateDTI, templateDTIResolution)
+
+            profiler.start("linearRegistration")
+            slicer.util.showStatusMessage("Step 2/5: Registering input volumes...")
+            if checkpoint.isCompleted("linearRegistration"):
+                registeredNodes = checkpoint.restoreNodes("linearRegistration")
+                inputFLAIRVolume_reg = registeredNodes["FLAIR"]
+                inputFAVolume_reg = registeredNodes["FA"]
+            else:
+                #
+                # Registering the FLAIR image to T1 image.
+                #
+                slicer.util.showStatusMessage("Step 2/5: T1 registration...")
+                (inputFLAIRVolume_reg, registrationFLAIR2T1Transform) = self.cachedLinearRegistration(
+                    stageCache, "FLAIR2T1", inputT1Volume, inputFLAIRVolume, interpolationMethod)
+
+                #
+                # Registering the DTI-FA to T1 image
+                #
+                slicer.util.showStatusMessage("Step 2/5: DTI-FA registration...")
+                (inputFAVolume_reg, registrationDTI2T1Transform) = self.cachedLinearRegistration(
+                    stageCache, "DTI2T1", inputT1Volume, inputFAVolume, interpolationMethod)
+
+                #
+                # Applying the DTI registration transform to the other DTI maps
+                #
+                registeredNodes = {"FLAIR": inputFLAIRVolume_reg, "FLAIR2T1": registrationFLAIR2T1Transform,
+                                   "FA": inputFAVolume_reg, "DTI2T1": registrationDTI2T1Transform}
+                for (mapName, templateMapType, mapType) in dtiMaps:
+                    slicer.util.showStatusMessage("Step 2/5: DTI-" + mapName + " registration...")
+                    registeredNodes[mapName] = self.resampleVolume(inputMaps[mapName], inputT1Volume,
+                                                                   registrationDTI2T1Transform, interpolationMethod)
+                checkpoint.complete("linearRegistration", nodes=registeredNodes)
+            for registeredNode in registeredNodes.values():
+                nodeScope.tag("transforms" if registeredNode.IsA("vtkMRMLTransformNode") else "registered", registeredNode)
+
+            #
+            # The structural SyN registration only needs the registered FLAIR, so it runs in background
+            # along with the DTI template registration and the DTI segmentation
+            #
+            if not checkpoint.hasCompleted("structuralSyN"):
+                structuralSyN = self.startStructuralSyN(outputFolder, stageCache, inputT1Volume, inputFLAIRVolume_reg,
+                                                        T1TemplateBrain, applyQuickANTS, scratchExtension)
+
+            #
+            # Registering the MNI-DTI template to FA native space.
+            #
+            profiler.start("DTISyN")
+            slicer.util.showStatusMessage("Step 2/5: DTI template registration...")
+            if checkpoint.isCompleted("DTISyN"):
+                slicer.util.showStatusMessage("Step 2/5: DTI template registration restored from the checkpoint...")
+            else:
+                if applyQuickANTS:
+                    #Patient FA
+                    patientFAVolume = inputFAVolume_reg
+                else:
+                    #Patient FA
+                    patientFAVolume = inputFAVolume
+
+                if stageCache:
+                    dtiSyNKey = stageCache.key("DTISyN", [patientFAVolume, DTITemplateNode], {"applyQuickANTS": applyQuickANTS,
+                                                                                                "extension": scratchExtension})
+                if stageCache and stageCache.restoreFiles(dtiSyNKey, outputFolder):
+                    slicer.util.showStatusMessage("Step 2/5: Using cached DTI template registration...")
+                else:
+                    #Saving files into tmp folder
+                    slicer.util.saveNode(patientFAVolume, outputFolder + '/patient-FA.' + scratchExtension)
+                    # FA Template
+                    slicer.util.saveNode(DTITemplateNode, outputFolder + '/DTI-Template-FA.' + scratchExtension)
+
+                    # Use ANTs registration, a failed registration is neither cached nor checkpointed
+                    returnCode = self.diffeomorphicRegistration(outputFolder, applyQuickANTS, False, scratchExtension)
+                    if returnCode != 0:
+                        raise RuntimeError("The DTI template registration returned %d" % returnCode)
+                    if stageCache:
+                        stageCache.storeFiles(dtiSyNKey, [outputFolder + '/' + fileName for fileName in
+                                                          self.diffeomorphicRegistrationOutputs("regTemplate", scratchExtension)])
+
+                # The inverse SyN warp and the inverse affine transform are composed once in a single
+                # displacement field, so each DTI map is taken to the template space in one resampling
+                dtiSyNFiles = self.diffeomorphicRegistrationOutputs("regTemplate", scratchExtension)
+                if dtiMaps:
+                    self.composeTransforms(outputFolder, "regTemplateInverseComposite." + scratchExtension, DTITemplateNode,
+                                           ["regTemplate1InverseWarp.nii.gz", ("regTemplate0GenericAffine.mat", True)])
+                    dtiSyNFiles.append("regTemplateInverseComposite." + scratchExtension)
+                checkpoint.complete("DTISyN", files=dtiSyNFiles)
 
+            #Read registered images and tranforms
+            if dtiMaps:
+                (read, regTemplateInverseComposite) = slicer.util.loadTransform(outputFolder + '/regTemplateInverseComposite.' + scratchExtension, True)  # Native space to DTI Template
+            (read, regTemplateInverseWarped) = slicer.util.loadVolume(outputFolder + '/regTemplateInverseWarped.' + scratchExtension, {}, True)  #Patient in ICBM space
+            if dtiMaps:
+                nodeScope.tag("transforms", regTemplateInverseComposite)
+            nodeScope.tag("templateSpace", regTemplateInverseWarped)
+
+            #################################################################################################################
+            # The pre-processing is done. Below are the evaluated the lesion maps based on the chosen Statistical Analaysis #
+            #################################################################################################################
+            #################################################################################################################
+            #                                       Apply the DTI segmentation approach                                     #
+            #################################################################################################################
+            slicer.util.showStatusMessage("Step 3/5: Performing " + segmentationApproach + " segmentation on all data...")
+            mapLabels = []
+            if segmentationApproach == 'JointLSDP':
+                #
+                # All the DTI maps are segmented together, the joint label goes to the output label
+                #
+                mapLabelNodes = {}
+                for (mapName, templateMapType, mapType) in [("FA", "FA", "FractionalAnisotropy")] + dtiMaps:
+                    mapLabelNodes[mapType] = slicer.vtkMRMLLabelMapVolumeNode()
+                    mapLabelNodes[mapType].SetName(mapName + "-lesion-label")
+                    slicer.mrmlScene.AddNode(mapLabelNodes[mapType])
+                    nodeScope.tag("mapLabels", mapLabelNodes[mapType])
+                profiler.start("segmentation-Joint")
+                if checkpoint.isCompleted("segmentation-Joint"):
+                    checkpoint.restoreVolumes("segmentation-Joint", dict(mapLabelNodes, joint=outputLabelVolume))
+                else:
+                    # The maps are resampled to the template space concurrently, then segmented together
+                    mapsInICBMVolumes = {"FractionalAnisotropy": regTemplateInverseWarped}
+                    scheduler = StageScheduler(stageConcurrency)
+                    for (mapName, templateMapType, mapType) in dtiMaps:
+                        scheduler.add("resample-" + mapName,
+                                      functools.partial(self.resampleDTIMapStage, mapName, registeredNodes[mapName],
+                                                        DTITemplateNode, regTemplateInverseComposite,
+                                                        mapsInICBMVolumes, mapType))
+                    scheduler.add("segmentation-Joint",
+                                  lambda: segmentJointLSDPVolumes(mapsInICBMVolumes, outputLabelVolume, mapLabelNodes,
+                                                                  templateDTIResolution, lsdpTScoreThreshold),
+                                  ["resample-" + mapName for (mapName, templateMapType, mapType) in dtiMaps])
+                    scheduler.run()
+                    checkpoint.complete("segmentation-Joint", nodes=dict(mapLabelNodes, joint=outputLabelVolume))
+                    for (mapName, templateMapType, mapType) in dtiMaps:
+                        nodeScope.tag("templateSpace", mapsInICBMVolumes[mapType])
+                        nodeScope.release(mapsInICBMVolumes[mapType])
+            else:
+                #
+                # Each DTI map is segmented independently, so the segmentations not restored from the
+                # checkpoint run as concurrent stages. The checkpoint is queried in the pipeline order.
+                #
+                profiler.start("segmentation")
+                scheduler = StageScheduler(stageConcurrency)
+                segmentationParameters = (segmentationApproach, templateDTIResolution, lsdpTScoreThreshold, thresholdMethod,
+                                          clusterNumberOfClasses, lsdpInProcess, not uncompressedScratch, cropToWhiteMatter,
+                                          streamDivisions, kmeansHistogramBins)
+
+                # FA map: the patient FA was already taken to the template space by the DTI template registration
+                if checkpoint.isCompleted("segmentation-FA"):
+                    checkpoint.restoreVolumes("segmentation-FA", {"label": outputLabelVolume})
+                else:
+                    scheduler.add("segmentation-FA",
+                                  functools.partial(self.segmentDTIMapStage, checkpoint, "FA", "FractionalAnisotropy",
+                                                    regTemplateInverseWarped, None, None, DTITemplateNode,
+                                                    outputLabelVolume, segmentationParameters, nodeScope))
+
+                # Other DTI maps: taken to the template space (composed SyN and affine) before the segmentation
+                for (mapName, templateMapType, mapType) in dtiMaps:
+                    mapsCount=mapsCount+1
+                    mapLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
+                    slicer.mrmlScene.AddNode(mapLabelNode)
+                    nodeScope.tag("mapLabels", mapLabelNode)
+                    if checkpoint.isCompleted("segmentation-" + mapName):
+                        checkpoint.restoreVolumes("segmentation-" + mapName, {"label": mapLabelNode})
+                    else:
+                        scheduler.add("segmentation-" + mapName,
+                                      functools.partial(self.segmentDTIMapStage, checkpoint, mapName, mapType,
+                                                        registeredNodes[mapName], DTITemplateNode,
+                                                        regTemplateInverseComposite, mapTemplates[mapName],
+                                                        mapLabelNode, segmentationParameters, nodeScope))
+                    mapLabels.append(mapLabelNode)
+                scheduler.run()
+
+            profiler.start("labelSmoothing")
+            if checkpoint.isCompleted("labelSmoothing"):
+                checkpoint.restoreVolumes("labelSmoothing", {"label": outputLabelVolume})
+            else:
+                #
+                # Fusion of the DTI maps labels, in memory and in a single pass
+                #
+                if mapLabels:
+                    fuseLabelVolumes([outputLabelVolume] + mapLabels, outputLabelVolume, labelFusionRule)
+                if segmentationApproach == 'JointLSDP':
+                    lesionLabel = 1
+                else:
+                    lesionLabel = fusedLesionLabel(labelFusionRule, mapsCount)
+
+                #
+                # Label Shape Constraints
+                #
+                smoothingRegion = None
+                if cropToWhiteMatter:
+                    smoothingRegion = templates.getWhiteMatterBoundingBox(templateDTIResolution)
+                self.smoothLesionLabel(outputLabelVolume, lesionLabel, smoothingRegion)
+                checkpoint.complete("labelSmoothing", nodes={"label": outputLabelVolume})
+
+            # The DTI maps, their labels and the DTI transforms are not used by the remaining stages
+            nodeScope.release(*mapLabels)
+            if segmentationApproach == 'JointLSDP':
+                nodeScope.release(*mapLabelNodes.values())
+            if dtiMaps:
+                nodeScope.release(regTemplateInverseComposite)
+            nodeScope.release(regTemplateInverseWarped, registeredNodes["FA"], registeredNodes["DTI2T1"],
+                              *[registeredNodes[mapName] for (mapName, templateMapType, mapType) in dtiMaps])
+
+            #################################################################################################################
+            #                                  Apply the T1 and FLAIR segmentation approach                                 #
+            #################################################################################################################
+            slicer.util.showStatusMessage("Step 4/5: T1 and T2-FLAIR lesion segmentation...")
+            #
+            # White Matter evaluation in T1 and FLAIR images - outlier detection
+            #
+            profiler.start("structuralSyN")
+            if checkpoint.isCompleted("structuralSyN"):
+                slicer.util.showStatusMessage("Step 4/5: Structural registration restored from the checkpoint...")
+            else:
+                if structuralSyN is None:
+                    # Recorded by the checkpoint, but computed again since an earlier stage was
+                    structuralSyN = self.startStructuralSyN(outputFolder, stageCache, inputT1Volume, inputFLAIRVolume_reg,
+                                                            T1TemplateBrain, applyQuickANTS, scratchExtension)
+                slicer.util.showStatusMessage("Step 4/5: Waiting for the structural registration...")
+                self.finishStructuralSyN(structuralSyN, outputFolder, stageCache, scratchExtension)
+                checkpoint.complete("structuralSyN", files=self.diffeomorphicRegistrationOutputs("regStruct", scratchExtension))
+            nodeScope.release(inputFLAIRVolume_reg, registeredNodes["FLAIR2T1"])
+
+            profiler.start("structuralSegmentation")
+            if not checkpoint.isCompleted("structuralSegmentation"):
+                # Apply Structural Brain Segmentation
+                os.system("chmod u+x " + home + "/MSLesionTrack-Data/structuralLesionSegmentation.sh")
+                # LST reads uncompressed NIfTI only, the uncompressed scratch mode already writes it. The
+                # compressed file is kept, it is an output of the structuralSyN checkpoint
+                if not uncompressedScratch:
+                    decompressFile(outputFolder + "/regStructInverseWarped.nii.gz")
+                # FSLOUTPUTTYPE sets the extension of the binary label written by fslmaths
+                os.system("FSLOUTPUTTYPE=" + ("NIFTI" if uncompressedScratch else "NIFTI_GZ") + " " +
+                          home +"/MSLesionTrack-Data/structuralLesionSegmentation.sh "+outputFolder+"/regStructInverseWarped.nii")
+                if not os.path.exists(outputFolder + '/struct-lesion-label.' + scratchExtension):
+                    slicer.util.showStatusMessage("ERROR: The T1 and T2-FLAIR lesion segmentation failed. Check the MATLAB LST installation.")
+                    logging.error("structuralLesionSegmentation.sh did not write " + outputFolder + "/struct-lesion-label." + scratchExtension)
+                    profiler.finish("failed")
+                    return False
+                checkpoint.complete("structuralSegmentation", files=["struct-lesion-label." + scratchExtension])
+
+            profiler.start("merge")
+            if checkpoint.isCompleted("merge"):
+                checkpoint.restoreVolumes("merge", {"label": outputLabelVolume})
+            else:
+                #
+                # Merge DTI and T1/FLAIR Labels
+                #
+                slicer.util.showStatusMessage("Step 5/5: Merging DTI/T1/T2-FLAIR lesion map...")
+                # Load structural label
+                (read,structLesionLabel)=slicer.util.loadVolume(outputFolder + '/struct-lesion-label.' + scratchExtension,{},True)  # T1 and T2-FLAIR Lesion Label in ICBM Space
+                nodeScope.tag("structural", structLesionLabel)
+
+                fuseLabelVolumes([outputLabelVolume, structLesionLabel], outputLabelVolume, "Sum")
+                nodeScope.release(structLesionLabel)
+
+                #
+                #  Registering back to native space
+                #
+                if not outputICBMSpace:
+                    slicer.util.showStatusMessage("Opt: Transforming label map to native space...")
+                    # Affine and SyN composed in a single displacement field, applied in one resampling
+                    regStructComposite = self.composeTransforms(outputFolder, "regStructComposite." + scratchExtension, inputT1Volume,
+                                                                ["regStruct0GenericAffine.mat", "regStruct1Warp.nii.gz"])  # T1/FLAIR to native space
+                    nodeScope.tag("transforms", regStructComposite)
+                    nativeLabel = self.resampleWithDisplacementField(outputLabelVolume, inputT1Volume, regStructComposite, "nn")
+                    copyVolume(nativeLabel, outputLabelVolume)
+                    nodeScope.release(nativeLabel, regStructComposite)
+                checkpoint.complete("merge", nodes={"label": outputLabelVolume})
+            profiler.finish()
+
+            slicer.util.showStatusMessage("DTILesionTrack - Processing completed!")
+            return True
+        except Exception:
+            # The report records the stage that raised
+            profiler.finish("failed")
+            raise
+        finally:
+            # A registration still running after a failure would keep writing in the output folder,
+            # and a resumed run would start another one on the same files
+            if structuralSyN is not None and structuralSyN[0] is not None:
+                self.stopDiffeomorphicRegistration(structuralSyN[0])
+            # Delete all the unnecessary nodes, also when a stage failed. The templates stay loaded
+            # for the next run
+            nodeScope.close(keepNodes=templateCache().nodes.values())
+
+    def preprocessStructuralVolumes(self, inputT1Volume, inputFLAIRVolume, applyBET, applyNoiseAttenuation,
+                                    filterCondutance, filterNumInt, filterQ):
+        """Brain extraction (optional), bias field correction and noise attenuation (optional)
+    applied in place on the T1 and FLAIR volumes.
+    """
         # Check if the input images are already brain extracted. If not, apply a brain extraction on both.
-        if applyBET.isChecked():
+        if applyBET:
             slicer.util.showStatusMessage("Pre-processing: Extraction brain from T1 and FLAIR images...")
             #
             # T1 brain extraction
@@ -528,1122 +1023,430 @@ class DTILesionTrackLogic(ScriptedLoadableModuleLogic):
         #
         # T1 and FLAIR pre-processing: noise attenuation
         #
-        if applyNoiseAttenuation.isChecked():
+        if applyNoiseAttenuation:
             slicer.util.showStatusMessage("Pre-processing: T1 noise attenuation...")
             filterParams = {}
             filterParams["inputVolume"] = inputT1Volume.GetID()
             filterParams["outputVolume"] = inputT1Volume.GetID()
-            filterParams["condutance"] = filterCondutance.value
-            filterParams["iterations"] = filterNumInt.value
-            filterParams["q"] = filterQ.value
+            filterParams["condutance"] = filterCondutance
+            filterParams["iterations"] = filterNumInt
+            filterParams["q"] = filterQ
             slicer.cli.run(slicer.modules.aadimagefilter, None, filterParams, wait_for_completion=True)
 
             slicer.util.showStatusMessage("Pre-processing: T2-FLAIR noise attenuation...")
             filterParams = {}
             filterParams["inputVolume"] = inputFLAIRVolume.GetID()
             filterParams["outputVolume"] = inputFLAIRVolume.GetID()
-            filterParams["condutance"] = filterCondutance.value
-            filterParams["iterations"] = filterNumInt.value
-            filterParams["q"] = filterQ.value
+            filterParams["condutance"] = filterCondutance
+            filterParams["iterations"] = filterNumInt
+            filterParams["q"] = filterQ
             slicer.cli.run(slicer.modules.aadimagefilter, None, filterParams, wait_for_completion=True)
 
-        slicer.util.showStatusMessage("Step 1/5: Reading brain templates...")
-        if platform.system() is "Windows":
-            home = expanduser("%userprofile%")
-        else:
-            home = expanduser("~")
 
-        #Read FA Template
-        if platform.system() is "Windows":
-            if (templateDTIResolution == '1mm') & (templateDTI == 'JHU-81'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(
-                    home + '\\MSLesionTrack-Data\\DTI-Templates\\JHU-ICBM-FA-1mm.nii.gz',{},True)
-                (read,T1TemplateBrain)=slicer.util.loadVolume(
-                    home + '\\MSLesionTrack-Data\\Structural-Templates\\MNI152_T1_1mm_brain.nii.gz',{},True)
-            elif (templateDTIResolution == '2mm') & (templateDTI == 'JHU-81'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(
-                    home + '\\MSLesionTrack-Data\\DTI-Templates\\JHU-ICBM-FA-2mm.nii.gz',{},True)
-                (read, T1TemplateBrain) =slicer.util.loadVolume(
-                    home + '\\MSLesionTrack-Data\\Structural-Templates\\MNI152_T1_2mm_brain.nii.gz',{},True)
-            elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-20'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(
-                    home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-FA-20-1mm.nii.gz',{},True)
-                (read, T1TemplateBrain) =slicer.util.loadVolume(
-                    home + '\\MSLesionTrack-Data\\Structural-Templates\\MNI152_T1_1mm_brain.nii.gz',{},True)
-            elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-20'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(
-                    home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-FA-20-2mm.nii.gz',{},True)
-                (read, T1TemplateBrain) =slicer.util.loadVolume(
-                    home + '\\MSLesionTrack-Data\\Structural-Templates\\MNI152_T1_2mm_brain.nii.gz',{},True)
-            elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-131'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(
-                home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-FA-131-1mm.nii.gz',{},True)
-                (read, T1TemplateBrain) =slicer.util.loadVolume(
-                    home + '\\MSLesionTrack-Data\\Structural-Templates\\MNI152_T1_1mm_brain.nii.gz',{},True)
-            elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-131'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(
-                home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-FA-131-2mm.nii.gz',{},True)
-                (read, T1TemplateBrain) =slicer.util.loadVolume(
-                    home + '\\MSLesionTrack-Data\\Structural-Templates\\MNI152_T1_2mm_brain.nii.gz',{},True)
-        else:
-            if (templateDTIResolution == '1mm') & (templateDTI == 'JHU-81'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(home + '/MSLesionTrack-Data/DTI-Templates/JHU-ICBM-FA-1mm.nii.gz',{},True)
-                (read, T1TemplateBrain) =slicer.util.loadVolume(
-                    home + '/MSLesionTrack-Data/Structural-Templates/MNI152_T1_1mm_brain.nii.gz',{},True)
-            elif (templateDTIResolution == '2mm') & (templateDTI == 'JHU-81'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(home + '/MSLesionTrack-Data/DTI-Templates/JHU-ICBM-FA-2mm.nii.gz',{},True)
-                (read, T1TemplateBrain) =slicer.util.loadVolume(
-                    home + '/MSLesionTrack-Data/Structural-Templates/MNI152_T1_2mm_brain.nii.gz',{},True)
-            elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-20'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-FA-20-1mm.nii.gz',{},True)
-                (read, T1TemplateBrain) =slicer.util.loadVolume(
-                    home + '/MSLesionTrack-Data/Structural-Templates/MNI152_T1_1mm_brain.nii.gz',{},True)
-            elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-20'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-FA-20-2mm.nii.gz',{},True)
-                (read, T1TemplateBrain) =slicer.util.loadVolume(
-                    home + '/MSLesionTrack-Data/Structural-Templates/MNI152_T1_2mm_brain.nii.gz',{},True)
-            elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-131'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-FA-131-1mm.nii.gz',{},True)
-                (read, T1TemplateBrain) =slicer.util.loadVolume(
-                    home + '/MSLesionTrack-Data/Structural-Templates/MNI152_T1_1mm_brain.nii.gz',{},True)
-            elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-131'):
-                (read, DTITemplateNode) =slicer.util.loadVolume(
-                home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-FA-131-2mm.nii.gz',{},True)
-                (read, T1TemplateBrain) =slicer.util.loadVolume(
-                    home + '/MSLesionTrack-Data/Structural-Templates/MNI152_T1_2mm_brain.nii.gz',{},True)
-
-        if inputMDVolume != None:
-            #Read MD Template
-            if platform.system() is "Windows":
-                if (templateDTIResolution == '1mm') & (templateDTI == 'USP-20'):
-                    (read, MDTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-MD-20-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-20'):
-                    (read, MDTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-MD-20-2mm.nii.gz',{},True)
-                elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-131'):
-                    (read, MDTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-MD-131-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-131'):
-                    (read, MDTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-MD-131-2mm.nii.gz',{},True)
-            else:
-                if (templateDTIResolution == '1mm') & (templateDTI == 'USP-20'):
-                    (read, MDTemplateNodeName) = slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-MD-20-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-20'):
-                    (read, MDTemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-MD-20-2mm.nii.gz',{},True)
-                elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-131'):
-                    (read, MDTemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-MD-131-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-131'):
-                    (read, MDTemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-MD-131-2mm.nii.gz',{},True)
-
-        if inputRAVolume != None:
-            # Read RA Template
-            if platform.system() is "Windows":
-                if (templateDTIResolution == '1mm') & (templateDTI == 'USP-20'):
-                    (read, RATemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-RA-20-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-20'):
-                    (read, RATemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-RA-20-2mm.nii.gz',{},True)
-                elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-131'):
-                    (read, RATemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-RA-131-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-131'):
-                    (read, RATemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-RA-131-2mm.nii.gz',{},True)
-            else:
-                if (templateDTIResolution == '1mm') & (templateDTI == 'USP-20'):
-                    (read, RATemplateNodeName) =DTITemplate = slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-RA-20-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-20'):
-                    (read, RATemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-RA-20-2mm.nii.gz',{},True)
-                elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-131'):
-                    (read, RATemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-RA-131-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-131'):
-                    (read, RATemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-RA-131-2mm.nii.gz',{},True)
-
-        if inputPerDVolume != None:
-            # Read Perp Diff Template
-            if platform.system() is "Windows":
-                if (templateDTIResolution == '1mm') & (templateDTI == 'USP-20'):
-                    (read, PerpDiffTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-PerpDiff-20-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-20'):
-                    (read, PerpDiffTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-PerpDiff-20-2mm.nii.gz',{},True)
-                elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-131'):
-                    (read, PerpDiffTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-PerpDiff-131-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-131'):
-                    (read, PerpDiffTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-PerpDiff-131-2mm.nii.gz',{},True)
-            else:
-                if (templateDTIResolution == '1mm') & (templateDTI == 'USP-20'):
-                    (read, PerpDiffTemplateNodeName) =DTITemplate = slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-PerpDiff-20-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-20'):
-                    (read, PerpDiffTemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-PerpDiff-20-2mm.nii.gz',{},True)
-                elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-131'):
-                    (read, PerpDiffTemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-PerpDiff-131-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-131'):
-                    (read, PerpDiffTemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-PerpDiff-131-2mm.nii.gz',{},True)
-
-        if inputVRVolume != None:
-            # Read VR Template
-            if platform.system() is "Windows":
-                if (templateDTIResolution == '1mm') & (templateDTI == 'USP-20'):
-                    (read, VRTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-VR-20-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-20'):
-                    (read, VRTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-VR-20-2mm.nii.gz',{},True)
-                elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-131'):
-                    (read, VRTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-VR-131-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-131'):
-                    (read, VRTemplateNodeName) =slicer.util.loadVolume(
-                        home + '\\MSLesionTrack-Data\\DTI-Templates\\USP-ICBM-VR-131-2mm.nii.gz',{},True)
-            else:
-                if (templateDTIResolution == '1mm') & (templateDTI == 'USP-20'):
-                    (read, VRTemplateNodeName) =DTITemplate = slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-VR-20-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-20'):
-                    (read, VRTemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-VR-20-2mm.nii.gz',{},True)
-                elif (templateDTIResolution == '1mm') & (templateDTI == 'USP-131'):
-                    (read, VRTemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-VR-131-1mm.nii.gz',{},True)
-                elif (templateDTIResolution == '2mm') & (templateDTI == 'USP-131'):
-                    (read, VRTemplateNodeName) =slicer.util.loadVolume(
-                        home + '/MSLesionTrack-Data/DTI-Templates/USP-ICBM-VR-131-2mm.nii.gz',{},True)
-
-        slicer.util.showStatusMessage("Step 2/5: Registering input volumes...")
-
-        #
-        # Registering the FLAIR image to T1 image.
-        #
-        slicer.util.showStatusMessage("Step 2/5: T1 registration...")
-        registrationFLAIR2T1Transform = slicer.vtkMRMLLinearTransformNode()
-        slicer.mrmlScene.AddNode(registrationFLAIR2T1Transform)
-        inputFLAIRVolume_reg = slicer.vtkMRMLScalarVolumeNode()
-        slicer.mrmlScene.AddNode(inputFLAIRVolume_reg)
+    def linearRegistration(self, fixedVolume, movingVolume, interpolationMethod):
+        """Rigid BRAINSFit registration of movingVolume to fixedVolume.
+    Returns the registered volume and the linear transform.
+    """
+        registrationTransform = slicer.vtkMRMLLinearTransformNode()
+        slicer.mrmlScene.AddNode(registrationTransform)
+        registeredVolume = slicer.vtkMRMLScalarVolumeNode()
+        slicer.mrmlScene.AddNode(registeredVolume)
         regParams = {}
-        regParams["fixedVolume"] = inputT1Volume.GetID()
-        regParams["movingVolume"] = inputFLAIRVolume.GetID()
+        regParams["fixedVolume"] = fixedVolume.GetID()
+        regParams["movingVolume"] = movingVolume.GetID()
         regParams["samplingPercentage"] = 0.02
         regParams["splineGridSize"] = '14,10,12'
-        regParams["outputVolume"] = inputFLAIRVolume_reg.GetID()
-        regParams["linearTransform"] = registrationFLAIR2T1Transform.GetID()
+        regParams["outputVolume"] = registeredVolume.GetID()
+        regParams["linearTransform"] = registrationTransform.GetID()
         regParams["initializeTransformMode"] = "useMomentsAlign"
         regParams["useRigid"] = True
-        regParams["interpolationMode"] = interpolationMethod.currentText
+        regParams["interpolationMode"] = interpolationMethod
         # regParams["numberOfSamples"] = 200000
 
         slicer.cli.run(slicer.modules.brainsfit, None, regParams, wait_for_completion=True)
 
+        return (registeredVolume, registrationTransform)
 
-        #
-        # Registering the DTI-FA to T1 image
-        #
-        slicer.util.showStatusMessage("Step 2/5: DTI-FA registration...")
-        registrationDTI2T1Transform = slicer.vtkMRMLLinearTransformNode()
-        slicer.mrmlScene.AddNode(registrationDTI2T1Transform)
-        inputFAVolume_reg = slicer.vtkMRMLScalarVolumeNode()
-        slicer.mrmlScene.AddNode(inputFAVolume_reg)
-        regParams = {}
-        regParams["fixedVolume"] = inputT1Volume.GetID()
-        regParams["movingVolume"] = inputFAVolume.GetID()
-        regParams["samplingPercentage"] = 0.02
-        regParams["splineGridSize"] = '14,10,12'
-        regParams["outputVolume"] = inputFAVolume_reg.GetID()
-        regParams["linearTransform"] = registrationDTI2T1Transform.GetID()
-        regParams["initializeTransformMode"] = "useMomentsAlign"
-        regParams["useRigid"] = True
-        regParams["interpolationMode"] = interpolationMethod.currentText
-        # regParams["numberOfSamples"] = 200000
+    def cachedLinearRegistration(self, stageCache, stageName, fixedVolume, movingVolume, interpolationMethod):
+        """Same as linearRegistration, reusing the stage cache result when available."""
+        if stageCache is None:
+            return self.linearRegistration(fixedVolume, movingVolume, interpolationMethod)
 
-        slicer.cli.run(slicer.modules.brainsfit, None, regParams, wait_for_completion=True)
+        key = stageCache.key(stageName, [fixedVolume, movingVolume], {"interpolationMethod": interpolationMethod})
+        cachedNodes = stageCache.loadNodes(key)
+        if cachedNodes is not None:
+            return (cachedNodes["volume"], cachedNodes["transform"])
 
-        #
-        # Registering the MNI-DTI template to FA native space.
-        #
+        (registeredVolume, registrationTransform) = self.linearRegistration(fixedVolume, movingVolume, interpolationMethod)
+        stageCache.storeNodes(key, {"volume": registeredVolume, "transform": registrationTransform})
+        return (registeredVolume, registrationTransform)
 
-        slicer.util.showStatusMessage("Step 2/5: DTI template registration...")
-        if applyQuickANTS.isChecked:
-            #Saving files into tmp folder
-            #Patient FA
-            slicer.util.saveNode(inputFAVolume_reg, folderSelector.directory+'/patient-FA.nii.gz')
-            # FA Template
-            slicer.util.saveNode(DTITemplateNode, folderSelector.directory + '/DTI-Template-FA.nii.gz')
+    def diffeomorphicRegistration(self, outputFolder, useQuick, structural, imageExtension="nii.gz"):
+        """Run the ANTs SyN registration script (diffeomorphicRegistration.sh) on the files
+    saved in outputFolder: patient-FA/DTI-Template-FA or, for the structural registration,
+    patient-FLAIR/MNI-Template-T1. imageExtension (nii.gz or nii) is the extension of these
+    files and of the warped images.
+    """
+        return self.startDiffeomorphicRegistration(outputFolder, useQuick, structural, imageExtension).wait()
 
-            # Use ANTs registration
-            os.system("chmod u+x " + home + "/MSLesionTrack-Data/diffeomorphicRegistration.sh")
+    def startDiffeomorphicRegistration(self, outputFolder, useQuick, structural, imageExtension="nii.gz", logPath=None):
+        """Start diffeomorphicRegistration.sh (see diffeomorphicRegistration) in background and
+    return its subprocess.Popen. The script output goes to logPath when informed.
+    """
+        home = expanduser("~")
+        os.system("chmod u+x " + home + "/MSLesionTrack-Data/diffeomorphicRegistration.sh")
+        if useQuick:
             os.system("chmod u+x " + home + "/MSLesionTrack-Data/antsRegistrationSyNQuick.sh")
-            os.system(home+"/MSLesionTrack-Data/diffeomorphicRegistration.sh "+folderSelector.directory+" Y"+ " N")
-
-            #Read registered images and tranforms
-            (read,regTemplate1Warp)=slicer.util.loadTransform(folderSelector.directory + '/regTemplate1Warp.nii.gz',True)# DTI Template to native space
-            (read, regTemplate1InverseWarp)=slicer.util.loadTransform(folderSelector.directory + '/regTemplate1InverseWarp.nii.gz',True)
-            (read, regTemplate0GenericAffine) =slicer.util.loadTransform(folderSelector.directory + '/regTemplate0GenericAffine.mat',True)# DTI Template to native space
-            (read, regTemplateWarped) =slicer.util.loadVolume(folderSelector.directory + '/regTemplateWarped.nii.gz',{},True)#DTI Template into patient space
-            (read, regTemplateInverseWarped) =slicer.util.loadVolume(folderSelector.directory + '/regTemplateInverseWarped.nii.gz',{},True)#Patient in ICBM space
         else:
-            # Saving files into tmp folder
-            # Patient FA
-            slicer.util.saveNode(inputFAVolume, folderSelector.directory + '/patient-FA.nii.gz')
-            # FA Template
-            slicer.util.saveNode(DTITemplateNode,folderSelector.directory + '/DTI-Template-FA.nii.gz')
-
-            # Use ANTs registration
-            os.system("chmod u+x " + home + "/MSLesionTrack-Data/diffeomorphicRegistration.sh")
             os.system("chmod u+x " + home + "/MSLesionTrack-Data/antsRegistrationSyN.sh")
-            os.system(home + "/MSLesionTrack-Data/diffeomorphicRegistration.sh " + folderSelector.directory+" N"+ " N")
-
-            # Read registered images and tranforms
-            (read, regTemplate1Warp) = slicer.util.loadTransform(folderSelector.directory + '/regTemplate1Warp.nii.gz', True)  # DTI Template to native space
-            (read, regTemplate1InverseWarp) = slicer.util.loadTransform(folderSelector.directory + '/regTemplate1InverseWarp.nii.gz', True)
-            (read, regTemplate0GenericAffine) = slicer.util.loadTransform(folderSelector.directory + '/regTemplate0GenericAffine.mat', True)  # DTI Template to native space
-            (read, regTemplateWarped) = slicer.util.loadVolume(folderSelector.directory + '/regTemplateWarped.nii.gz',{}, True)  # DTI Template into patient space
-            (read, regTemplateInverseWarped) = slicer.util.loadVolume(folderSelector.directory + '/regTemplateInverseWarped.nii.gz', {}, True)  #Patient in ICBM space
-
-        # TODO COREGISTRO COM MD, nao linear, PRECISA SER FEITO NOVAMENTE...so chamar o script ANTs
-        #
-        # Applying registration transform - MD Volume
-        #
-        if inputMDVolume != None:
-            mapsCount=mapsCount+1
-            #
-            # Registering the MD image with the MNI-DTI template.
-            #
-            slicer.util.showStatusMessage("Step 2/4: DTI-MD registration...")
-            inputMDVolume_reg = slicer.vtkMRMLScalarVolumeNode()
-            slicer.mrmlScene.AddNode(inputMDVolume_reg)
-            resampMDParams = {}
-            resampMDParams["inputVolume"] = inputMDVolume.GetID()
-            resampMDParams["referenceVolume"] = inputT1Volume.GetID()
-            resampMDParams["outputVolume"] = inputMDVolume_reg.GetID()
-            resampMDParams["warpTransform"] = registrationDTI2T1Transform.GetID()
-            resampMDParams["interpolationMode"] = interpolationMethod.currentText
-
-            slicer.cli.run(slicer.modules.brainsresample, None, resampMDParams, wait_for_completion=True)
-
-        #
-        # Applying registration transform - RA Volume
-        #
-        if inputRAVolume != None:
-            mapsCount=mapsCount+1
-            #
-            # Registering the RA image with the MNI-DTI template.
-            #
-            slicer.util.showStatusMessage("Step 2/4: DTI-RA registration...")
-            inputRAVolume_reg = slicer.vtkMRMLScalarVolumeNode()
-            slicer.mrmlScene.AddNode(inputRAVolume_reg)
-            resampRAParams = {}
-            resampRAParams["inputVolume"] = inputRAVolume.GetID()
-            resampRAParams["referenceVolume"] = inputT1Volume.GetID()
-            resampRAParams["outputVolume"] = inputRAVolume_reg.GetID()
-            resampRAParams["warpTransform"] = registrationDTI2T1Transform.GetID()
-            resampRAParams["interpolationMode"] = interpolationMethod.currentText
-
-            slicer.cli.run(slicer.modules.brainsresample, None, resampRAParams, wait_for_completion=True)
-
-        #
-        # Applying registration transform - Perpendicular Diffusivity Volume
-        #
-        if inputPerDVolume != None:
-            mapsCount=mapsCount+1
-            #
-            # Registering the Per Diff image with the MNI-DTI template.
-            #
-            slicer.util.showStatusMessage("Step 2/4: DTI-PerpDiff registration...")
-            inputPerDVolume_reg = slicer.vtkMRMLScalarVolumeNode()
-            slicer.mrmlScene.AddNode(inputPerDVolume_reg)
-            resampPerDParams = {}
-            resampPerDParams["inputVolume"] = inputPerDVolume.GetID()
-            resampPerDParams["referenceVolume"] = inputT1Volume.GetID()
-            resampPerDParams["outputVolume"] = inputPerDVolume_reg.GetID()
-            resampPerDParams["warpTransform"] = registrationDTI2T1Transform.GetID()
-            resampPerDParams["interpolationMode"] = interpolationMethod.currentText
-
-            slicer.cli.run(slicer.modules.brainsresample, None, resampPerDParams, wait_for_completion=True)
-
-        #
-        # Applying registration transform - VR Volume
-        #
-        if inputVRVolume != None:
-            mapsCount=mapsCount+1
-            #
-            # Registering the Per Diff image with the MNI-DTI template.
-            #
-            slicer.util.showStatusMessage("Step 2/4: DTI-VR registration...")
-            inputVRVolume_reg = slicer.vtkMRMLScalarVolumeNode()
-            slicer.mrmlScene.AddNode(inputVRVolume_reg)
-            resampVRParams = {}
-            resampVRParams["inputVolume"] = inputVRVolume.GetID()
-            resampVRParams["referenceVolume"] = inputT1Volume.GetID()
-            resampVRParams["outputVolume"] = inputVRVolume_reg.GetID()
-            resampVRParams["warpTransform"] = registrationDTI2T1Transform.GetID()
-            resampVRParams["interpolationMode"] = interpolationMethod.currentText
-
-            slicer.cli.run(slicer.modules.brainsresample, None, resampVRParams, wait_for_completion=True)
-
-
-        #################################################################################################################
-        # The pre-processing is done. Below are the evaluated the lesion maps based on the chosen Statistical Analaysis #
-        #################################################################################################################
-        #################################################################################################################
-        #                                       Apply the DTI segmentation approach                                     #
-        #################################################################################################################
-        if (segmentationApproach == 'LSDP'):
-            slicer.util.showStatusMessage("Step 3/5: Performing LSDP segmentation on all data...")
-            #
-            # Perform the statistical segmentation - FA map
-            #
-            statisticalFASegmentationParams = {}
-            statisticalFASegmentationParams["inputVolume"] = regTemplateInverseWarped.GetID()
-            statisticalFASegmentationParams["mapType"] = "FractionalAnisotropy"
-            statisticalFASegmentationParams["mapResolution"] = templateDTIResolution
-            statisticalFASegmentationParams["statMethod"] = "T-Score"
-            statisticalFASegmentationParams["tThreshold"] = lsdpTScoreThreshold.value
-            statisticalFASegmentationParams["outputLabel"] = outputLabelVolume.GetID()
-
-            slicer.cli.run(slicer.modules.lsdpbrainsegmentation, None, statisticalFASegmentationParams, wait_for_completion=True)
-
-            if inputMDVolume != None:
-                #SyN
-                inputLSDPMDinICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputLSDPMDinICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputMDVolume_reg.GetID()
-                antsParams["outputVolume"] = inputLSDPMDinICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams,  wait_for_completion=True)
-
-                #Affine
-                antsParams={}
-                antsParams["inputVolume"]= inputLSDPMDinICBMVolume.GetID()
-                antsParams["outputVolume"]= inputLSDPMDinICBMVolume.GetID()
-                antsParams["referenceVolume"]= DTITemplateNode.GetID()
-                antsParams["transformationFile"]= regTemplate0GenericAffine
-                antsParams["interpolationType"]="linear"
-                antsParams["inverseITKTransformation"]=True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                #
-                # Perform the statistical segmentation - MD map
-                #
-                outputMDLesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputMDLesionLabelNode)
-                statisticalMDSegmentationParams = {}
-                statisticalMDSegmentationParams["inputVolume"] = inputLSDPMDinICBMVolume.GetID()
-                statisticalMDSegmentationParams["mapType"] = "MeanDiffusivity"
-                statisticalMDSegmentationParams["mapResolution"] = templateDTIResolution
-                statisticalMDSegmentationParams["statMethod"] = "T-Score"
-                statisticalMDSegmentationParams["tThreshold"] = lsdpTScoreThreshold.value
-                statisticalMDSegmentationParams["outputLabel"] = outputMDLesionLabelNode.GetID()
-
-                slicer.cli.run(slicer.modules.lsdpbrainsegmentation, None, statisticalMDSegmentationParams, wait_for_completion=True)
-
-            if inputRAVolume != None:
-                # SyN
-                inputLSDPRAinICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputLSDPRAinICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputRAVolume_reg.GetID()
-                antsParams["outputVolume"] = inputLSDPRAinICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                # Affine
-                antsParams = {}
-                antsParams["inputVolume"] = inputLSDPRAinICBMVolume.GetID()
-                antsParams["outputVolume"] = inputLSDPRAinICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate0GenericAffine
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
+        command = [home + "/MSLesionTrack-Data/diffeomorphicRegistration.sh", outputFolder,
+                   "Y" if useQuick else "N", "Y" if structural else "N", imageExtension]
+        # The script runs in its own process group, so stopDiffeomorphicRegistration also stops ANTs
+        preexec = os.setsid if hasattr(os, "setsid") else None
+        if logPath is None:
+            return subprocess.Popen(command, preexec_fn=preexec)
+        with open(logPath, "w") as logFile:
+            return subprocess.Popen(command, stdout=logFile, stderr=subprocess.STDOUT, preexec_fn=preexec)
+
+    def stopDiffeomorphicRegistration(self, process):
+        """Terminate a registration started by startDiffeomorphicRegistration, along with the
+    ANTs processes it started, and wait for it. Nothing is done if it already finished.
+    """
+        if process.poll() is not None:
+            return
+        logging.info("Stopping the registration running in background")
+        if hasattr(os, "killpg"):
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        else:
+            process.terminate()
+        process.wait()
+
+    def startStructuralSyN(self, outputFolder, stageCache, inputT1Volume, inputFLAIRVolume_reg, T1TemplateBrain,
+                           applyQuickANTS, imageExtension):
+        """Start the structural SyN registration (registered FLAIR to the MNI152 T1 template) in
+    background, unless it is found in the stage cache. Returns the (process, cache key) pair
+    to be informed to finishStructuralSyN; process is None on a cache hit.
+    """
+        structSyNKey = None
+        if stageCache:
+            structSyNKey = stageCache.key("StructSyN", [inputFLAIRVolume_reg, T1TemplateBrain],
+                                          {"applyQuickANTS": applyQuickANTS, "extension": imageExtension})
+            if stageCache.restoreFiles(structSyNKey, outputFolder):
+                slicer.util.showStatusMessage("Step 2/5: Using cached structural registration...")
+                return (None, structSyNKey)
+
+        # Saving files into tmp folder
+        # Patient T1
+        slicer.util.saveNode(inputT1Volume, outputFolder + '/patient-T1.' + imageExtension)
+        # Patient FLAIR
+        slicer.util.saveNode(inputFLAIRVolume_reg, outputFolder + '/patient-FLAIR.' + imageExtension)
+        # MNI Template
+        slicer.util.saveNode(T1TemplateBrain, outputFolder + '/MNI-Template-T1.' + imageExtension)
+
+        # Use ANTs registration, the output goes to a log file as it runs along other stages
+        logging.info("Structural registration started in background, see " + outputFolder + "/regStruct.log")
+        process = self.startDiffeomorphicRegistration(outputFolder, applyQuickANTS, True, imageExtension,
+                                                      os.path.join(outputFolder, "regStruct.log"))
+        return (process, structSyNKey)
+
+    def finishStructuralSyN(self, structuralSyN, outputFolder, stageCache, imageExtension):
+        """Wait for the structural SyN registration started by startStructuralSyN and store its
+    results in the stage cache. Raises RuntimeError if the registration failed.
+    """
+        (process, structSyNKey) = structuralSyN
+        if process is None:
+            return
+        if process.wait() != 0:
+            raise RuntimeError("The structural registration returned %d, see %s/regStruct.log" % (process.returncode, outputFolder))
+        if stageCache:
+            stageCache.storeFiles(structSyNKey, [outputFolder + '/' + fileName for fileName in
+                                                 self.diffeomorphicRegistrationOutputs("regStruct", imageExtension)])
+
+    def diffeomorphicRegistrationOutputs(self, prefix, imageExtension="nii.gz"):
+        """Files written by antsRegistrationSyN for the output prefix (regTemplate or regStruct).
+    The warp fields are always compressed by antsRegistration.
+    """
+        return [prefix + '0GenericAffine.mat', prefix + '1Warp.nii.gz', prefix + '1InverseWarp.nii.gz',
+                prefix + 'Warped.' + imageExtension, prefix + 'InverseWarped.' + imageExtension]
+
+    def resampleVolume(self, inputVolume, referenceVolume, linearTransform, interpolationMethod):
+        """Resample inputVolume on the referenceVolume grid with a BRAINSFit linear transform."""
+        outputVolume = slicer.vtkMRMLScalarVolumeNode()
+        slicer.mrmlScene.AddNode(outputVolume)
+        resampParams = {}
+        resampParams["inputVolume"] = inputVolume.GetID()
+        resampParams["referenceVolume"] = referenceVolume.GetID()
+        resampParams["outputVolume"] = outputVolume.GetID()
+        resampParams["warpTransform"] = linearTransform.GetID()
+        resampParams["interpolationMode"] = interpolationMethod
+
+        slicer.cli.run(slicer.modules.brainsresample, None, resampParams, wait_for_completion=True)
+        return outputVolume
+
+    def composeTransforms(self, outputFolder, outputName, referenceVolume, transforms):
+        """Compose ANTs transforms saved in outputFolder in a single displacement field
+    (outputFolder/outputName) sampled on the referenceVolume grid, and load it in the scene.
+
+    transforms follows the antsApplyTransforms order, i.e. resampling with the composed field
+    is the same as resampling with each transform in turn, from the first to the last one. Use
+    a (fileName, True) tuple to invert a linear transform.
+    """
+        (outputBaseName, outputExtension) = os.path.splitext(outputName)
+        if outputExtension == ".gz":
+            (outputBaseName, niftiExtension) = os.path.splitext(outputBaseName)
+            outputExtension = niftiExtension + outputExtension
+        referencePath = os.path.join(outputFolder, outputBaseName + "-reference" + outputExtension)
+        slicer.util.saveNode(referenceVolume, referencePath)
+        command = [os.path.join(os.environ["ANTSPATH"], "antsApplyTransforms"), "-d", "3", "-r", referencePath,
+                   "-o", "[" + os.path.join(outputFolder, outputName) + ",1]"]
+        for transform in transforms:
+            if isinstance(transform, tuple):
+                command += ["-t", "[" + os.path.join(outputFolder, transform[0]) + "," + ("1" if transform[1] else "0") + "]"]
+            else:
+                command += ["-t", os.path.join(outputFolder, transform)]
+        if subprocess.call(command) != 0:
+            raise RuntimeError("antsApplyTransforms could not compose the transforms into " + outputName)
+        os.remove(referencePath)
+
+        (read, compositeTransform) = slicer.util.loadTransform(os.path.join(outputFolder, outputName), True)
+        if not read:
+            raise IOError("Could not read the composed transform " + outputName)
+        return compositeTransform
+
+    def resampleWithDisplacementField(self, inputVolume, referenceVolume, displacementField, interpolationType):
+        """Resample inputVolume on the referenceVolume grid with a displacement field (e.g. one
+    written by composeTransforms), in a single pass. interpolationType is linear or nn.
+    """
+        (outputVolume, cliNode) = self.startResampleWithDisplacementField(inputVolume, referenceVolume, displacementField,
+                                                                          interpolationType, waitForCompletion=True)
+        return outputVolume
+
+    def startResampleWithDisplacementField(self, inputVolume, referenceVolume, displacementField, interpolationType,
+                                           waitForCompletion=False):
+        """Start resampleWithDisplacementField without waiting for the CLI module by default.
+    Returns the output volume and the CLI module node.
+    """
+        if inputVolume.IsA("vtkMRMLLabelMapVolumeNode"):
+            outputVolume = slicer.vtkMRMLLabelMapVolumeNode()
+        else:
+            outputVolume = slicer.vtkMRMLScalarVolumeNode()
+        slicer.mrmlScene.AddNode(outputVolume)
+
+        antsParams = {}
+        antsParams["inputVolume"] = inputVolume.GetID()
+        antsParams["outputVolume"] = outputVolume.GetID()
+        antsParams["referenceVolume"] = referenceVolume.GetID()
+        antsParams["transformationFile"] = displacementField
+        antsParams["typeOfField"] = "displacement"
+        antsParams["interpolationType"] = interpolationType
+        antsParams["inverseITKTransformation"] = False
+
+        cliNode = slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams,
+                                 wait_for_completion=waitForCompletion)
+        return (outputVolume, cliNode)
+
+    def smoothLesionLabel(self, labelVolume, lesionLabel, region=None):
+        """Smooth the shape of the lesion label with the LabelMapSmoothing module. region is a
+    tuple of slices of the label array (see templates.maskBoundingBox); when informed only
+    that sub-volume is smoothed and pasted back in the label.
+    """
+        smoothedVolume = labelVolume
+        if region is not None:
+            labelArray = slicer.util.arrayFromVolume(labelVolume).copy()
+            smoothedVolume = slicer.vtkMRMLLabelMapVolumeNode()
+            smoothedVolume.SetName(labelVolume.GetName() + "-cropped")
+            slicer.mrmlScene.AddNode(smoothedVolume)
+            # Same grid as the label, with the origin moved to the first voxel of the region (arrays are KJI)
+            ijkToRAS = vtk.vtkMatrix4x4()
+            labelVolume.GetIJKToRASMatrix(ijkToRAS)
+            smoothedVolume.SetIJKToRASMatrix(ijkToRAS)
+            smoothedVolume.SetOrigin(ijkToRAS.MultiplyPoint([region[2].start, region[1].start, region[0].start, 1])[:3])
+            slicer.util.updateVolumeFromArray(smoothedVolume, numpy.ascontiguousarray(labelArray[region]))
 
-                #
-                # Perform the statistical segmentation - RA map
-                #
-                outputRALesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputRALesionLabelNode)
-                statisticalRASegmentationParams = {}
-                statisticalRASegmentationParams["inputVolume"] = inputLSDPRAinICBMVolume.GetID()
-                statisticalRASegmentationParams["mapType"] = "RelativeAnisotropy"
-                statisticalRASegmentationParams["mapResolution"] = templateDTIResolution
-                statisticalRASegmentationParams["statMethod"] = "T-Score"
-                statisticalRASegmentationParams["tThreshold"] = lsdpTScoreThreshold.value
-                statisticalRASegmentationParams["outputLabel"] = outputRALesionLabelNode.GetID()
-
-                slicer.cli.run(slicer.modules.lsdpbrainsegmentation, None, statisticalRASegmentationParams,
-                               wait_for_completion=True)
-
-            if inputPerDVolume != None:
-                # SyN
-                inputLSDPPerDinICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputLSDPPerDinICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputPerDVolume_reg.GetID()
-                antsParams["outputVolume"] = inputLSDPPerDinICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                # Affine
-                antsParams = {}
-                antsParams["inputVolume"] = inputLSDPPerDinICBMVolume.GetID()
-                antsParams["outputVolume"] = inputLSDPPerDinICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate0GenericAffine
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
+        labelShapeParams = {}
+        labelShapeParams["inputVolume"] = smoothedVolume.GetID()
+        labelShapeParams["outputVolume"] = smoothedVolume.GetID()
+        labelShapeParams["labelToSmooth"] = lesionLabel
+        labelShapeParams["numberOfIterations"] = 50
+        labelShapeParams["maxRMSError"] = 0.01
+        labelShapeParams["gaussianSigma"] = 0.5
 
-                #
-                # Perform the statistical segmentation - Perpendicular Diffusivity map
-                #
-                outputPerDLesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputPerDLesionLabelNode)
-                statisticalPerDSegmentationParams = {}
-                statisticalPerDSegmentationParams["inputVolume"] = inputLSDPPerDinICBMVolume.GetID()
-                statisticalPerDSegmentationParams["mapType"] = "PerpendicularDiffusivity"
-                statisticalPerDSegmentationParams["mapResolution"] = templateDTIResolution
-                statisticalPerDSegmentationParams["statMethod"] = "T-Score"
-                statisticalPerDSegmentationParams["tThreshold"] = lsdpTScoreThreshold.value
-                statisticalPerDSegmentationParams["outputLabel"] = outputPerDLesionLabelNode.GetID()
-
-                slicer.cli.run(slicer.modules.lsdpbrainsegmentation, None, statisticalPerDSegmentationParams,
-                               wait_for_completion=True)
-
-            if inputVRVolume != None:
-                # SyN
-                inputLSDPVRinICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputLSDPVRinICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputVRVolume_reg.GetID()
-                antsParams["outputVolume"] = inputLSDPVRinICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = interpolationMethod.currentText
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                # Affine
-                antsParams = {}
-                antsParams["inputVolume"] = inputLSDPVRinICBMVolume.GetID()
-                antsParams["outputVolume"] = inputLSDPVRinICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate0GenericAffine
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
+        slicer.cli.run(slicer.modules.labelmapsmoothing, None, labelShapeParams, wait_for_completion=True)
 
-                #
-                # Perform the statistical segmentation - VR map
-                #
-                outputVRLesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputVRLesionLabelNode)
-                statisticalVRSegmentationParams = {}
-                statisticalVRSegmentationParams["inputVolume"] = inputLSDPVRinICBMVolume.GetID()
-                statisticalVRSegmentationParams["mapType"] = "VolumeRatio"
-                statisticalVRSegmentationParams["mapResolution"] = templateDTIResolution
-                statisticalVRSegmentationParams["statMethod"] = "T-Score"
-                statisticalVRSegmentationParams["tThreshold"] = lsdpTScoreThreshold.value
-                statisticalVRSegmentationParams["outputLabel"] = outputVRLesionLabelNode.GetID()
-
-                slicer.cli.run(slicer.modules.lsdpbrainsegmentation, None, statisticalVRSegmentationParams,
-                               wait_for_completion=True)
-
-            if mapsCount > 1:
-                    finalLesioLabelParameters = {}
-
-                    if inputMDVolume != None:
-                        finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                        finalLesioLabelParameters["inputVolume2"] = outputMDLesionLabelNode.GetID()
-                        finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                        finalLesioLabelParameters["order"] = 0
-
-                        slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters,
-                                       wait_for_completion=True)
-                    if inputRAVolume != None:
-                        finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                        finalLesioLabelParameters["inputVolume2"] = outputRALesionLabelNode.GetID()
-                        finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                        finalLesioLabelParameters["order"] = 0
-
-                        slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters,
-                                       wait_for_completion=True)
-                    if inputPerDVolume != None:
-                        finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                        finalLesioLabelParameters["inputVolume2"] = outputPerDLesionLabelNode.GetID()
-                        finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                        finalLesioLabelParameters["order"] = 0
-
-                        slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters,
-                                       wait_for_completion=True)
-                    if inputVRVolume != None:
-                        finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                        finalLesioLabelParameters["inputVolume2"] = outputVRLesionLabelNode.GetID()
-                        finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                        finalLesioLabelParameters["order"] = 0
-
-                        slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters,
-                                       wait_for_completion=True)
+        if region is not None:
+            labelArray[region] = slicer.util.arrayFromVolume(smoothedVolume)
+            slicer.util.updateVolumeFromArray(labelVolume, labelArray)
+            slicer.mrmlScene.RemoveNode(smoothedVolume)
+
+    def resampleDTIMapStage(self, mapName, inputVolume, referenceVolume, displacementField, mapsInICBMVolumes, mapType):
+        """Scheduler stage taking a DTI map to the template space, stored in mapsInICBMVolumes[mapType]."""
+        slicer.util.showStatusMessage("Step 3/5: DTI-" + mapName + " to template space...")
+        (mapsInICBMVolumes[mapType], cliNode) = self.startResampleWithDisplacementField(
+            inputVolume, referenceVolume, displacementField, "linear")
+        yield cliNode
+
+    def segmentDTIMapStage(self, checkpoint, mapName, mapType, inputVolume, referenceVolume, displacementField,
+                           templateVolume, outputLabel, segmentationParameters, nodeScope=None):
+        """Scheduler stage segmenting a DTI map (see segmentDTIMap). Without displacementField,
+    inputVolume is already in the template space, otherwise it is resampled on referenceVolume
+    first, and the resampled map is released from nodeScope after the segmentation.
+    segmentationParameters are the segmentDTIMap parameters after outputLabel.
+    """
+        slicer.util.showStatusMessage("Step 3/5: DTI-" + mapName + " segmentation...")
+        if displacementField is not None:
+            (inputVolume, cliNode) = self.startResampleWithDisplacementField(inputVolume, referenceVolume,
+                                                                             displacementField, "linear")
+            yield cliNode
+        (segmentationApproach, templateDTIResolution, lsdpTScoreThreshold, thresholdMethod, clusterNumberOfClasses,
+         lsdpInProcess, useCompression, cropWhiteMatter, streamDivisions, kmeansHistogramBins) = segmentationParameters
+        yield self.startSegmentDTIMap(segmentationApproach, mapType, inputVolume, templateVolume, outputLabel,
+                                      templateDTIResolution, lsdpTScoreThreshold, thresholdMethod,
+                                      clusterNumberOfClasses, lsdpInProcess, useCompression, cropWhiteMatter,
+                                      streamDivisions, kmeansHistogramBins)
+        checkpoint.complete("segmentation-" + mapName, nodes={"label": outputLabel})
+        if displacementField is not None and nodeScope is not None:
+            nodeScope.tag("templateSpace", inputVolume)
+            nodeScope.release(inputVolume)
+
+    def segmentDTIMap(self, segmentationApproach, mapType, inputVolume, templateVolume, outputLabel,
+                      templateDTIResolution, lsdpTScoreThreshold, thresholdMethod, clusterNumberOfClasses,
+                      lsdpInProcess=True, useCompression=True, cropWhiteMatter=False, streamDivisions=1,
+                      kmeansHistogramBins=0):
+        """Segment the lesions of a DTI map in the template space with the chosen approach
+    (LSDP, SpatialClustering or Bayesian). mapType is the map name used by the segmentation
+    CLIs, e.g. FractionalAnisotropy. With lsdpInProcess the LSDP T-Score is computed in
+    memory instead of running the LSDPBrainSegmentation CLI. useCompression is passed to the
+    CLIs, which otherwise write their output label uncompressed. With cropWhiteMatter the
+    SpatialClustering and Bayesian CLIs only process the white matter bounding box.
+    streamDivisions is the number of slabs in which the CLIs run their voxelwise steps. With
+    kmeansHistogramBins the SpatialClustering k-means iterates on a histogram of that many bins.
+    """
+        self.startSegmentDTIMap(segmentationApproach, mapType, inputVolume, templateVolume, outputLabel,
+                                templateDTIResolution, lsdpTScoreThreshold, thresholdMethod, clusterNumberOfClasses,
+                                lsdpInProcess, useCompression, cropWhiteMatter, streamDivisions, kmeansHistogramBins,
+                                waitForCompletion=True)
+
+    def startSegmentDTIMap(self, segmentationApproach, mapType, inputVolume, templateVolume, outputLabel,
+                           templateDTIResolution, lsdpTScoreThreshold, thresholdMethod, clusterNumberOfClasses,
+                           lsdpInProcess=True, useCompression=True, cropWhiteMatter=False, streamDivisions=1,
+                           kmeansHistogramBins=0, waitForCompletion=False):
+        """Start segmentDTIMap without waiting for the segmentation CLI module by default.
+    Returns the CLI module node, or None when the segmentation was computed in memory.
+    """
+        cliNode = None
+        if segmentationApproach == 'LSDP' and lsdpInProcess:
+            segmentLSDPVolumes({mapType: inputVolume}, {mapType: outputLabel}, templateDTIResolution, lsdpTScoreThreshold)
+        elif segmentationApproach == 'LSDP':
+            statisticalSegmentationParams = {}
+            statisticalSegmentationParams["inputVolume"] = inputVolume.GetID()
+            statisticalSegmentationParams["mapType"] = mapType
+            statisticalSegmentationParams["mapResolution"] = templateDTIResolution
+            statisticalSegmentationParams["statMethod"] = "T-Score"
+            statisticalSegmentationParams["tThreshold"] = lsdpTScoreThreshold
+            statisticalSegmentationParams["outputLabel"] = outputLabel.GetID()
+            statisticalSegmentationParams["useCompression"] = useCompression
+            statisticalSegmentationParams["streamDivisions"] = streamDivisions
+
+            cliNode = slicer.cli.run(slicer.modules.lsdpbrainsegmentation, None, statisticalSegmentationParams,
+                                     wait_for_completion=waitForCompletion)
         elif segmentationApproach == 'SpatialClustering':
-            slicer.util.showStatusMessage("Step 3/5: Performing Spatial Clustering segmentation on all data...")
-
             clusterParams = {}
-            clusterParams["inputVolume"] = regTemplateInverseWarped.GetID()
-            clusterParams["referenceVolume"] = DTITemplateNode.GetID()
-            clusterParams["outputVolume"] = outputLabelVolume.GetID()
-            clusterParams["dtiMap"] = "FractionalAnisotropy"
+            clusterParams["inputVolume"] = inputVolume.GetID()
+            clusterParams["referenceVolume"] = templateVolume.GetID()
+            clusterParams["outputVolume"] = outputLabel.GetID()
+            clusterParams["dtiMap"] = mapType
             clusterParams["mapResolution"] = templateDTIResolution
             clusterParams["thrMethod"] = thresholdMethod
-            clusterParams["numClass"] = clusterNumberOfClasses.value
-
-            slicer.cli.run(slicer.modules.clusteringscalardiffusionsegmentation, None, clusterParams, wait_for_completion=True)
-
-            if inputMDVolume != None:
-                # SyN
-                inputMDICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputMDICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputMDVolume_reg.GetID()
-                antsParams["outputVolume"] = inputMDICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                # Affine
-                antsParams = {}
-                antsParams["inputVolume"] = inputMDICBMVolume.GetID()
-                antsParams["outputVolume"] = inputMDICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate0GenericAffine
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                outputMDLesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputMDLesionLabelNode)
-                clusterParams = {}
-                clusterParams["inputVolume"] = inputMDICBMVolume.GetID()
-                clusterParams["referenceVolume"] = MDTemplateNodeName.GetID()
-                clusterParams["outputVolume"] = outputMDLesionLabelNode.GetID()
-                clusterParams["dtiMap"] = "MeanDiffusivity"
-                clusterParams["mapResolution"] = templateDTIResolution
-                clusterParams["thrMethod"] = thresholdMethod
-                clusterParams["numClass"] = clusterNumberOfClasses.value
-
-                slicer.cli.run(slicer.modules.clusteringscalardiffusionsegmentation, None, clusterParams, wait_for_completion=True)
-            if inputRAVolume != None:
-                # SyN
-                inputRAICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputRAICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputRAVolume_reg.GetID()
-                antsParams["outputVolume"] = inputRAICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                # Affine
-                antsParams = {}
-                antsParams["inputVolume"] = inputRAICBMVolume.GetID()
-                antsParams["outputVolume"] = inputRAICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate0GenericAffine
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                outputRALesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputRALesionLabelNode)
-                clusterParams = {}
-                clusterParams["inputVolume"] = inputRAICBMVolume.GetID()
-                clusterParams["referenceVolume"] = RATemplateNodeName.GetID()
-                clusterParams["outputVolume"] = outputRALesionLabelNode.GetID()
-                clusterParams["dtiMap"] = "RelativeAnisotropy"
-                clusterParams["mapResolution"] = templateDTIResolution
-                clusterParams["thrMethod"] = thresholdMethod
-                clusterParams["numClass"] = clusterNumberOfClasses.value
-
-                slicer.cli.run(slicer.modules.clusteringscalardiffusionsegmentation, None, clusterParams,
-                               wait_for_completion=True)
-            if inputPerDVolume != None:
-                # SyN
-                inputPerDICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputPerDICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputPerDVolume_reg.GetID()
-                antsParams["outputVolume"] = inputPerDICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                # Affine
-                antsParams = {}
-                antsParams["inputVolume"] = inputPerDICBMVolume.GetID()
-                antsParams["outputVolume"] = inputPerDICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate0GenericAffine
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                outputPerDLesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputPerDLesionLabelNode)
-                clusterParams = {}
-                clusterParams["inputVolume"] = inputPerDICBMVolume.GetID()
-                clusterParams["referenceVolume"] = PerpDiffTemplateNodeName.GetID()
-                clusterParams["outputVolume"] = outputPerDLesionLabelNode.GetID()
-                clusterParams["dtiMap"] = "PerpendicularDiffusivity"
-                clusterParams["mapResolution"] = templateDTIResolution
-                clusterParams["thrMethod"] = thresholdMethod
-                clusterParams["numClass"] = clusterNumberOfClasses.value
-
-                slicer.cli.run(slicer.modules.clusteringscalardiffusionsegmentation, None, clusterParams,
-                               wait_for_completion=True)
-            if inputVRVolume != None:
-                # SyN
-                inputVRICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputVRICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputVRVolume_reg.GetID()
-                antsParams["outputVolume"] = inputVRICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                # Affine
-                antsParams = {}
-                antsParams["inputVolume"] = inputVRICBMVolume.GetID()
-                antsParams["outputVolume"] = inputVRICBMVolume.GetID()
-                antsParams["referenceVolume"] = DTITemplateNode.GetID()
-                antsParams["transformationFile"] = regTemplate0GenericAffine
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                outputVRLesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputVRLesionLabelNode)
-                clusterParams = {}
-                clusterParams["inputVolume"] = inputVRICBMVolume.GetID()
-                clusterParams["referenceVolume"] = VRTemplateNodeName.GetID()
-                clusterParams["outputVolume"] = outputVRLesionLabelNode.GetID()
-                clusterParams["dtiMap"] = "VolumeRatio"
-                clusterParams["mapResolution"] = templateDTIResolution
-                clusterParams["thrMethod"] = thresholdMethod
-                clusterParams["numClass"] = clusterNumberOfClasses.value
-
-                slicer.cli.run(slicer.modules.clusteringscalardiffusionsegmentation, None, clusterParams,
-                               wait_for_completion=True)
-
-            if mapsCount > 1:
-                finalLesioLabelParameters = {}
-
-                if inputMDVolume != None:
-                    finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["inputVolume2"] = outputMDLesionLabelNode.GetID()
-                    finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["order"] = 0
-
-                    slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters,
-                                   wait_for_completion=True)
-                if inputRAVolume != None:
-                    finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["inputVolume2"] = outputRALesionLabelNode.GetID()
-                    finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["order"] = 0
-
-                    slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters,
-                                   wait_for_completion=True)
-                if inputPerDVolume != None:
-                    finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["inputVolume2"] = outputPerDLesionLabelNode.GetID()
-                    finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["order"] = 0
-
-                    slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters,
-                                   wait_for_completion=True)
-                if inputVRVolume != None:
-                    finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["inputVolume2"] = outputVRLesionLabelNode.GetID()
-                    finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["order"] = 0
-
-                    slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters,
-                                   wait_for_completion=True)
+            clusterParams["numClass"] = clusterNumberOfClasses
+            clusterParams["useCompression"] = useCompression
+            clusterParams["cropWhiteMatter"] = cropWhiteMatter
+            clusterParams["referenceQuantiles"] = referenceQuantilesFilePath(templateVolume, cropWhiteMatter)
+            clusterParams["streamDivisions"] = streamDivisions
+            clusterParams["kmeansHistogramBins"] = kmeansHistogramBins
+
+            cliNode = slicer.cli.run(slicer.modules.clusteringscalardiffusionsegmentation, None, clusterParams,
+                                     wait_for_completion=waitForCompletion)
         elif segmentationApproach == 'Bayesian':
-            slicer.util.showStatusMessage("Step 3/5: Performing Bayesian segmentation on all data...")
-            #
-            #Perform Bayesian segmentation in FA map
-            #
             bayesParams = {}
-            bayesParams["inputVolume"] = regTemplateInverseWarped.GetID()
-            bayesParams["referenceVolume"] = DTITemplateNode.GetID()
-            bayesParams["mapType"] = "FractionalAnisotropy"
+            bayesParams["inputVolume"] = inputVolume.GetID()
+            bayesParams["referenceVolume"] = templateVolume.GetID()
+            bayesParams["mapType"] = mapType
             bayesParams["priorsImage"] = "Multiple Sclerosis Lesions"
             bayesParams["mapResolution"] = templateDTIResolution
+            bayesParams["compactPriors"] = compactPriorsFilePath(templateDTIResolution)
             bayesParams["thrMethod"] = thresholdMethod
-            bayesParams["outputLabel"] = outputLabelVolume.GetID()
-
-            slicer.cli.run(slicer.modules.bayesiandtisegmentation, None, bayesParams, wait_for_completion=True)
-
-            if inputMDVolume != None:
-                # SyN
-                inputBayesMDinICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputBayesMDinICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputMDVolume_reg.GetID()
-                antsParams["outputVolume"] = inputBayesMDinICBMVolume.GetID()
-                antsParams["referenceVolume"] = MDTemplateNodeName.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                # Affine
-                antsParams = {}
-                antsParams["inputVolume"] = inputBayesMDinICBMVolume.GetID()
-                antsParams["outputVolume"] = inputBayesMDinICBMVolume.GetID()
-                antsParams["referenceVolume"] = MDTemplateNodeName.GetID()
-                antsParams["transformationFile"] = regTemplate0GenericAffine
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                #
-                # Perform Bayesian segmentation in MD map
-                #
-                outputMDLesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputMDLesionLabelNode)
-                bayesParams = {}
-                bayesParams["inputVolume"] = inputBayesMDinICBMVolume.GetID()
-                bayesParams["referenceVolume"] = MDTemplateNodeName.GetID()
-                bayesParams["mapType"] = "MeanDiffusivity"
-                bayesParams["priorsImage"] = "Multiple Sclerosis Lesions"
-                bayesParams["mapResolution"] = templateDTIResolution
-                bayesParams["thrMethod"] = thresholdMethod
-                bayesParams["outputLabel"] = outputMDLesionLabelNode.GetID()
-
-                slicer.cli.run(slicer.modules.bayesiandtisegmentation, None, bayesParams, wait_for_completion=True)
-            if inputRAVolume != None:
-                # SyN
-                inputBayesRAinICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputBayesRAinICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputRAVolume_reg.GetID()
-                antsParams["outputVolume"] = inputBayesRAinICBMVolume.GetID()
-                antsParams["referenceVolume"] = RATemplateNodeName.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                # Affine
-                antsParams = {}
-                antsParams["inputVolume"] = inputBayesRAinICBMVolume.GetID()
-                antsParams["outputVolume"] = inputBayesRAinICBMVolume.GetID()
-                antsParams["referenceVolume"] = RATemplateNodeName.GetID()
-                antsParams["transformationFile"] = regTemplate0GenericAffine
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                #
-                # Perform Bayesian segmentation in RA map
-                #
-                outputRALesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputRALesionLabelNode)
-                bayesParams = {}
-                bayesParams["inputVolume"] = inputBayesRAinICBMVolume.GetID()
-                bayesParams["referenceVolume"] = RATemplateNodeName.GetID()
-                bayesParams["mapType"] = "RelativeAnisotropy"
-                bayesParams["priorsImage"] = "Multiple Sclerosis Lesions"
-                bayesParams["mapResolution"] = templateDTIResolution
-                bayesParams["thrMethod"] = thresholdMethod
-                bayesParams["outputLabel"] = outputRALesionLabelNode.GetID()
-
-                slicer.cli.run(slicer.modules.bayesiandtisegmentation, None, bayesParams, wait_for_completion=True)
-            if inputPerDVolume != None:
-                # SyN
-                inputBayesPerDinICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputBayesPerDinICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputPerDVolume_reg.GetID()
-                antsParams["outputVolume"] = inputBayesPerDinICBMVolume.GetID()
-                antsParams["referenceVolume"] = PerpDiffTemplateNodeName.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                # Affine
-                antsParams = {}
-                antsParams["inputVolume"] = inputBayesPerDinICBMVolume.GetID()
-                antsParams["outputVolume"] = inputBayesPerDinICBMVolume.GetID()
-                antsParams["referenceVolume"] = PerpDiffTemplateNodeName.GetID()
-                antsParams["transformationFile"] = regTemplate0GenericAffine
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                #
-                # Perform Bayesian segmentation in Perp Diff map
-                #
-                outputPerDLesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputPerDLesionLabelNode)
-                bayesParams = {}
-                bayesParams["inputVolume"] = inputBayesPerDinICBMVolume.GetID()
-                bayesParams["referenceVolume"] = PerpDiffTemplateNodeName.GetID()
-                bayesParams["mapType"] = "PerpendicularDiffusivity"
-                bayesParams["priorsImage"] = "Multiple Sclerosis Lesions"
-                bayesParams["mapResolution"] = templateDTIResolution
-                bayesParams["thrMethod"] = thresholdMethod
-                bayesParams["outputLabel"] = outputPerDLesionLabelNode.GetID()
-
-                slicer.cli.run(slicer.modules.bayesiandtisegmentation, None, bayesParams, wait_for_completion=True)
-            if inputVRVolume != None:
-                # # SyN
-                inputBayesVRinICBMVolume = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(inputBayesVRinICBMVolume)
-                antsParams = {}
-                antsParams["inputVolume"] = inputVRVolume_reg.GetID()
-                antsParams["outputVolume"] = inputBayesVRinICBMVolume.GetID()
-                antsParams["referenceVolume"] = VRTemplateNodeName.GetID()
-                antsParams["transformationFile"] = regTemplate1InverseWarp
-                antsParams["typeOfField"] = "displacement"
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = False
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                # Affine
-                antsParams = {}
-                antsParams["inputVolume"] = inputBayesVRinICBMVolume.GetID()
-                antsParams["outputVolume"] = inputBayesVRinICBMVolume.GetID()
-                antsParams["referenceVolume"] = VRTemplateNodeName.GetID()
-                antsParams["transformationFile"] = regTemplate0GenericAffine
-                antsParams["interpolationType"] = "linear"
-                antsParams["inverseITKTransformation"] = True
-
-                slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-                #
-                # Perform Bayesian segmentation in VR map
-                #
-                outputVRLesionLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(outputVRLesionLabelNode)
-                bayesParams = {}
-                bayesParams["inputVolume"] = inputBayesVRinICBMVolume.GetID()
-                bayesParams["referenceVolume"] = VRTemplateNodeName.GetID()
-                bayesParams["mapType"] = "VolumeRatio"
-                bayesParams["priorsImage"] = "Multiple Sclerosis Lesions"
-                bayesParams["mapResolution"] = templateDTIResolution
-                bayesParams["thrMethod"] = thresholdMethod
-                bayesParams["outputLabel"] = outputVRLesionLabelNode.GetID()
-
-                slicer.cli.run(slicer.modules.bayesiandtisegmentation, None, bayesParams, wait_for_completion=True)
-
-            if mapsCount > 1:
-                finalLesioLabelParameters = {}
-
-                if inputMDVolume != None:
-                    finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["inputVolume2"] = outputMDLesionLabelNode.GetID()
-                    finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["order"] = 0
-
-                    slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters, wait_for_completion=True)
-                if inputRAVolume != None:
-                    finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["inputVolume2"] = outputRALesionLabelNode.GetID()
-                    finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["order"] = 0
-
-                    slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters, wait_for_completion=True)
-                if inputPerDVolume != None:
-                    finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["inputVolume2"] = outputPerDLesionLabelNode.GetID()
-                    finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["order"] = 0
-
-                    slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters, wait_for_completion=True)
-                if inputVRVolume != None:
-                    finalLesioLabelParameters["inputVolume1"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["inputVolume2"] = outputVRLesionLabelNode.GetID()
-                    finalLesioLabelParameters["outputVolume"] = outputLabelVolume.GetID()
-                    finalLesioLabelParameters["order"] = 0
-
-                    slicer.cli.run(slicer.modules.addscalarvolumes, None, finalLesioLabelParameters, wait_for_completion=True)
-
-        #
-        # Label Shape Constraints
-        #
-        labelShapeParams = {}
-        labelShapeParams["inputVolume"] = outputLabelVolume.GetID()
-        labelShapeParams["outputVolume"] = outputLabelVolume.GetID()
-        labelShapeParams["labelToSmooth"] = mapsCount
-        labelShapeParams["numberOfIterations"] = 50
-        labelShapeParams["maxRMSError"] = 0.01
-        labelShapeParams["gaussianSigma"] = 0.5
-
-        slicer.cli.run(slicer.modules.labelmapsmoothing, None, labelShapeParams, wait_for_completion=True)
-
-        #################################################################################################################
-        #                                  Apply the T1 and FLAIR segmentation approach                                 #
-        #################################################################################################################
-        slicer.util.showStatusMessage("Step 4/5: T1 and T2-FLAIR lesion segmentation...")
-        #
-        # White Matter evaluation in T1 and FLAIR images - outlier detection
-        #
-        if applyQuickANTS.isChecked:
-            # Saving files into tmp folder
-            # Patient T1
-            slicer.util.saveNode(inputT1Volume, folderSelector.directory + '/patient-T1.nii.gz')
-            # Patient FLAIR
-            slicer.util.saveNode(inputFLAIRVolume_reg, folderSelector.directory + '/patient-FLAIR.nii.gz')
-            # MNI Template
-            slicer.util.saveNode(T1TemplateBrain,folderSelector.directory + '/MNI-Template-T1.nii.gz')
-
-            # Use ANTs registration
-            os.system("chmod u+x " + home + "/MSLesionTrack-Data/diffeomorphicRegistration.sh")
-            os.system("chmod u+x " + home + "/MSLesionTrack-Data/antsRegistrationSyNQuick.sh")
-            os.system(home + "/MSLesionTrack-Data/diffeomorphicRegistration.sh " + folderSelector.directory + " Y" + " Y")
+            bayesParams["outputLabel"] = outputLabel.GetID()
+            bayesParams["useCompression"] = useCompression
+            bayesParams["cropWhiteMatter"] = cropWhiteMatter
+            bayesParams["referenceQuantiles"] = referenceQuantilesFilePath(templateVolume, cropWhiteMatter)
+            bayesParams["streamDivisions"] = streamDivisions
+
+            cliNode = slicer.cli.run(slicer.modules.bayesiandtisegmentation, None, bayesParams,
+                                     wait_for_completion=waitForCompletion)
         else:
-            # Saving files into tmp folder
-            # Patient T1
-            slicer.util.saveNode(inputT1Volume, folderSelector.directory + '/patient-T1.nii.gz')
-            # Patient FLAIR
-            slicer.util.saveNode(inputFLAIRVolume_reg, folderSelector.directory + '/patient-FLAIR.nii.gz')
-            # MNI Template
-            slicer.util.saveNode(T1TemplateBrain,folderSelector.directory + '/MNI-Template-T1.nii.gz')
-
-            # Use ANTs registration
-            os.system("chmod u+x " + home + "/MSLesionTrack-Data/diffeomorphicRegistration.sh")
-            os.system("chmod u+x " + home + "/MSLesionTrack-Data/antsRegistrationSyNQuick.sh")
-            os.system(home + "/MSLesionTrack-Data/diffeomorphicRegistration.sh " + folderSelector.directory + " N" + " Y")
-
-        # Apply Structural Brain Segmentation
-        os.system("chmod u+x " + home + "/MSLesionTrack-Data/structuralLesionSegmentation.sh")
-        os.system("gunzip "+ folderSelector.directory +"/regStructInverseWarped.nii.gz")
-        os.system(home +"/MSLesionTrack-Data/structuralLesionSegmentation.sh "+folderSelector.directory+"/regStructInverseWarped.nii")
-
-        #
-        # Merge DTI and T1/FLAIR Labels
-        #
-        slicer.util.showStatusMessage("Step 5/5: Merging DTI/T1/T2-FLAIR lesion map...")
-        # Load structural label
-        (read,structLesionLabel)=slicer.util.loadVolume(folderSelector.directory + '/struct-lesion-label.nii.gz',{},True)  # T1 and T2-FLAIR Lesion Label in ICBM Space
-
-        mergeLabels= {}
-        mergeLabels["inputVolume1"] = outputLabelVolume.GetID()
-        mergeLabels["inputVolume2"] = structLesionLabel.GetID()
-        mergeLabels["outputVolume"] = outputLabelVolume.GetID()
-        mergeLabels["order"] = 0
-
-        slicer.cli.run(slicer.modules.addscalarvolumes, None, mergeLabels, wait_for_completion=True)
-
-        #
-        #  Registering back to native space
-        #
-        if not outputICBMSpace.isChecked():
-            slicer.util.showStatusMessage("Opt: Transforming label map to native space...")
-            # Read registered images and tranforms
-            (read,regStruct1Warp)=slicer.util.loadTransform(folderSelector.directory + '/regStruct1Warp.nii.gz',True)  # T1/FLAIR to native space
-            (read,regStruct0GenericAffine)=slicer.util.loadTransform(folderSelector.directory + '/regStruct0GenericAffine.mat',True)  # T1/FLAIR to native space
-
-            # Affine
-            antsParams = {}
-            antsParams["inputVolume"] = outputLabelVolume.GetID()
-            antsParams["outputVolume"] = outputLabelVolume.GetID()
-            antsParams["referenceVolume"] = inputT1Volume.GetID()
-            antsParams["transformationFile"] = regStruct0GenericAffine
-            antsParams["interpolationType"] = "nn"
-            antsParams["inverseITKTransformation"] = False
-
-            slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-            # SyN
-            antsParams = {}
-            antsParams["inputVolume"] = outputLabelVolume.GetID()
-            antsParams["outputVolume"] = outputLabelVolume.GetID()
-            antsParams["referenceVolume"] = inputT1Volume.GetID()
-            antsParams["transformationFile"] = regStruct1Warp
-            antsParams["typeOfField"] = "displacement"
-            antsParams["interpolationType"] = "nn"
-            antsParams["inverseITKTransformation"] = False
-
-            slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, antsParams, wait_for_completion=True)
-
-        slicer.util.showStatusMessage("DTILesionTrack - Processing completed!")
-
-        #Delete all the unnecessary nodes
-
-        return True
+            raise ValueError("Unknown segmentation approach: " + str(segmentationApproach))
+        return cliNode
+
+    def runSubject(self, subject, workFolder, parameters=None):
+        """Load the subject volumes (dictionary with the FLAIR, T1, FA, MD, RA, PerD
+    and VR file paths) in the scene, run the pipeline with the informed parameters
+    and save the lesion label in the work folder (also as a sparse label, see
+    sparselabels). The subject volumes are removed from the scene afterwards.
+    Returns the output label path.
+    """
+        parameters = completeParameters(parameters)
+        if not os.path.isdir(workFolder):
+            os.makedirs(workFolder)
+
+        subjectScope = NodeScope()
+        try:
+            return self._runSubject(subject, workFolder, parameters)
+        finally:
+            subjectScope.close(keepNodes=templateCache().nodes.values())
+
+    def _runSubject(self, subject, workFolder, parameters):
+
+        volumes = {}
+        for key in SUBJECT_VOLUME_KEYS:
+            volumes[key] = None
+            if subject.get(key):
+                (read, volumes[key]) = slicer.util.loadVolume(subject[key], {}, True)
+                if not read:
+                    raise IOError("Could not read the " + key + " volume: " + subject[key])
+
+        outputLabelVolume = slicer.vtkMRMLLabelMapVolumeNode()
+        outputLabelVolume.SetName(subject.get("id", "DTILesionTrack") + "-lesion-label")
+        slicer.mrmlScene.AddNode(outputLabelVolume)
+
+        if not self.run(volumes["FLAIR"], volumes["T1"], volumes["FA"], volumes["MD"], volumes["RA"], volumes["PerD"],
+                        volumes["VR"], outputLabelVolume, workFolder, **parameters):
+            raise RuntimeError("The DTILesionTrack pipeline did not complete, see the log for details")
+
+        outputLabelPath = os.path.join(workFolder, "lesion-label.nii.gz")
+        slicer.util.saveNode(outputLabelVolume, outputLabelPath)
+        # Sparse copy of the label, much smaller for cohort archives and fast to merge
+        writeSparseLabel(sparseLabelFromVolume(outputLabelVolume),
+                         os.path.join(workFolder, "lesion-label" + SPARSE_LABEL_EXTENSION))
+        return outputLabelPath
+
+    def runCohort(self, manifestPath, outputDirectory, numberOfWorkers=1, parameters=None):
+        """Process all the subjects listed in a cohort manifest (see readSubjectManifest)
+    using numberOfWorkers Slicer processes in parallel. Each subject gets its own work
+    folder inside the output directory and a summary is written at the end.
+    """
+        subjects = readSubjectManifest(manifestPath)
+        completeParameters(parameters)
+        runner = CohortBatchRunner(slicer.app.launcherExecutableFilePath, numberOfWorkers)
+        slicer.util.showStatusMessage("Processing %d subjects with %d workers..." % (len(subjects), runner.numberOfWorkers))
+        results = runner.run(subjects, outputDirectory, parameters)
+        failed = [result["id"] for result in results if result["status"] != "completed"]
+        if failed:
+            logging.warning("DTILesionTrack failed for the subjects: " + ", ".join(failed))
+        slicer.util.showStatusMessage("DTILesionTrack - Cohort processing completed: %d/%d subjects" % (len(results) - len(failed), len(results)))
+        return results
 
 
 class DTILesionTrackTest(ScriptedLoadableModuleTest):
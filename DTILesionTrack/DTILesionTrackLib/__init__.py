@@ -0,0 +1 @@
+"""Helper package for the DTILesionTrack scripted module."""
@@ -0,0 +1,182 @@
+#
+# DTILesionTrack cohort batch processing
+#
+
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import threading
+import time
+
+from DTILesionTrackLib.profiling import readProfile
+
+# Volumes that can be informed for each subject in a cohort manifest. The
+# FLAIR, T1 and FA volumes are mandatory, the remaining DTI maps are optional.
+SUBJECT_VOLUME_KEYS = ["FLAIR", "T1", "FA", "MD", "RA", "PerD", "VR"]
+REQUIRED_VOLUME_KEYS = ["FLAIR", "T1", "FA"]
+
+JOB_FILE_NAME = "job.json"
+RESULT_FILE_NAME = "result.json"
+LOG_FILE_NAME = "worker.log"
+SUMMARY_FILE_NAME = "summary"
+STAGE_SUMMARY_FILE_NAME = "summary-stages.csv"
+
+# Script executed by each worker process (see headless.py)
+HEADLESS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "headless.py")
+
+
+def readSubjectManifest(manifestPath):
+    """Read a cohort manifest and return the list of subjects.
+
+  The manifest can be a CSV file with a header line (id,FLAIR,T1,FA,MD,RA,PerD,VR)
+  or a JSON file with a list of subjects, each one a dictionary with the same keys.
+  Empty entries of the optional DTI maps are ignored.
+  """
+    if manifestPath.lower().endswith(".json"):
+        with open(manifestPath) as manifestFile:
+            entries = json.load(manifestFile)
+        if isinstance(entries, dict):
+            entries = entries["subjects"]
+    else:
+        with open(manifestPath) as manifestFile:
+            entries = [row for row in csv.DictReader(manifestFile)]
+
+    manifestFolder = os.path.dirname(os.path.abspath(manifestPath))
+    return [normalizeSubject(entry, manifestFolder, index) for index, entry in enumerate(entries)]
+
+
+def normalizeSubject(entry, baseFolder, index=0):
+    """Return the subject described by entry with the volume paths resolved
+  relative to baseFolder. Raises ValueError if a mandatory volume is missing.
+  """
+    subject = {"id": str(entry.get("id") or "subject-%03d" % (index + 1))}
+    for key in SUBJECT_VOLUME_KEYS:
+        path = (entry.get(key) or "").strip()
+        if path:
+            subject[key] = os.path.join(baseFolder, os.path.expanduser(path))
+    missing = [key for key in REQUIRED_VOLUME_KEYS if key not in subject]
+    if missing:
+        raise ValueError("Subject " + subject["id"] + " is missing the volumes: " + ", ".join(missing))
+    return subject
+
+
+class CohortBatchRunner(object):
+    """Run the DTILesionTrack pipeline over a cohort of subjects.
+
+  Every subject is processed by its own Slicer process, started without the main
+  window and running the headless entry point on a job parameter file, so each
+  worker has an independent MRML scene and work folder. At most numberOfWorkers
+  processes are running at the same time.
+  """
+
+    def __init__(self, slicerExecutable, numberOfWorkers=1, threadsPerWorker=None):
+        self.slicerExecutable = slicerExecutable
+        self.numberOfWorkers = max(1, int(numberOfWorkers))
+        if threadsPerWorker is None:
+            threadsPerWorker = max(1, multiprocessing.cpu_count() // self.numberOfWorkers)
+        self.threadsPerWorker = threadsPerWorker
+
+    def run(self, subjects, outputDirectory, parameters=None):
+        """Process all the subjects and write the cohort summary (JSON and CSV)
+    in the output directory. Returns the list of per-subject results.
+    """
+        if not os.path.isdir(outputDirectory):
+            os.makedirs(outputDirectory)
+
+        pending = list(subjects)
+        results = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    subject = pending.pop(0)
+                result = self.runSubject(subject, outputDirectory, parameters)
+                with lock:
+                    results.append(result)
+                    logging.info("Subject %s %s (%d/%d)" % (result["id"], result["status"], len(results), len(subjects)))
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.numberOfWorkers, len(subjects)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        order = dict((subject["id"], index) for index, subject in enumerate(subjects))
+        results.sort(key=lambda result: order[result["id"]])
+        self.writeSummary(results, outputDirectory)
+        return results
+
+    def runSubject(self, subject, outputDirectory, parameters=None):
+        """Start a worker process for one subject and wait until it finishes."""
+        workFolder = os.path.join(outputDirectory, subject["id"])
+        if not os.path.isdir(workFolder):
+            os.makedirs(workFolder)
+
+        jobFile = os.path.join(workFolder, JOB_FILE_NAME)
+        with open(jobFile, "w") as job:
+            json.dump({"subject": subject, "outputFolder": workFolder, "parameters": parameters or {}}, job, indent=2)
+
+        resultFile = os.path.join(workFolder, RESULT_FILE_NAME)
+        if os.path.exists(resultFile):
+            os.remove(resultFile)
+
+        command = [self.slicerExecutable, "--no-splash", "--no-main-window",
+                   "--python-script", HEADLESS_SCRIPT, jobFile]
+        environment = dict(os.environ)
+        environment["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(self.threadsPerWorker)
+
+        logPath = os.path.join(workFolder, LOG_FILE_NAME)
+        startTime = time.time()
+        with open(logPath, "w") as logFile:
+            returnCode = subprocess.call(command, stdout=logFile, stderr=subprocess.STDOUT, env=environment)
+
+        result = {"id": subject["id"], "workFolder": workFolder, "log": logPath}
+        if os.path.exists(resultFile):
+            with open(resultFile) as workerResult:
+                result.update(json.load(workerResult))
+        result["returnCode"] = returnCode
+        result["elapsedTime"] = time.time() - startTime
+        profile = readProfile(workFolder)
+        if profile is not None:
+            result["profile"] = profile
+        if returnCode != 0 or result.get("status") != "completed":
+            result["status"] = "failed"
+        return result
+
+    def writeSummary(self, results, outputDirectory):
+        """Write the cohort summary as summary.json and summary.csv, and the wall time
+    of each pipeline stage per subject (from the profile reports) in summary-stages.csv.
+    """
+        summaryPath = os.path.join(outputDirectory, SUMMARY_FILE_NAME)
+        with open(summaryPath + ".json", "w") as summaryFile:
+            json.dump(results, summaryFile, indent=2)
+
+        columns = ["id", "status", "elapsedTime", "returnCode", "outputLabel", "error", "workFolder"]
+        profileColumns = ["cpuTime", "childCPUTime", "childPeakRSS", "peakRSS", "bytesWritten", "slowestStage"]
+        with open(summaryPath + ".csv", "w") as summaryFile:
+            writer = csv.writer(summaryFile)
+            writer.writerow(columns + profileColumns)
+            for result in results:
+                total = result.get("profile", {}).get("total", {})
+                writer.writerow([result.get(column, "") for column in columns] +
+                                ["" if total.get(column) is None else total[column] for column in profileColumns])
+
+        # Stages in the order they run, the optional DTI maps only appear for some subjects
+        stageNames = []
+        for result in results:
+            for stage in result.get("profile", {}).get("stages", []):
+                if stage["name"] not in stageNames:
+                    stageNames.append(stage["name"])
+        with open(os.path.join(outputDirectory, STAGE_SUMMARY_FILE_NAME), "w") as stageFile:
+            writer = csv.writer(stageFile)
+            writer.writerow(["id"] + stageNames)
+            for result in results:
+                wallTimes = dict((stage["name"], stage["wallTime"]) for stage in result.get("profile", {}).get("stages", []))
+                writer.writerow([result["id"]] + ["%.1f" % wallTimes[name] if name in wallTimes else "" for name in stageNames])
+        return summaryPath + ".json"
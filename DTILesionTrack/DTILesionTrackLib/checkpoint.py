@@ -0,0 +1,196 @@
+#
+# DTILesionTrack pipeline checkpoints
+#
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+
+import vtk
+import slicer
+
+from DTILesionTrackLib.sparselabels import (SPARSE_LABEL_EXTENSION, readSparseLabel, sparseLabelFromVolume,
+                                             writeSparseLabel)
+from DTILesionTrackLib.stagecache import volumeDigest
+
+# Stage manifest written in the work folder
+CHECKPOINT_FILE_NAME = "checkpoint.json"
+# Folder, inside the work folder, where the stage output nodes are saved
+CHECKPOINT_FOLDER_NAME = "Checkpoints"
+
+
+def copyVolume(sourceNode, targetNode):
+    """Copy the voxels and the geometry of sourceNode into targetNode."""
+    imageData = vtk.vtkImageData()
+    imageData.DeepCopy(sourceNode.GetImageData())
+    ijkToRAS = vtk.vtkMatrix4x4()
+    sourceNode.GetIJKToRASMatrix(ijkToRAS)
+    targetNode.SetIJKToRASMatrix(ijkToRAS)
+    targetNode.SetAndObserveImageData(imageData)
+
+
+def decompressFile(compressedPath):
+    """Write the uncompressed copy of a .gz file next to it and return its path. Unlike gunzip,
+  the compressed file is kept, as it may be the recorded output of a completed stage.
+  """
+    uncompressedPath = compressedPath[:-len(".gz")]
+    with open(uncompressedPath, "wb") as uncompressed:
+        compressed = gzip.open(compressedPath, "rb")
+        try:
+            shutil.copyfileobj(compressed, uncompressed)
+        finally:
+            compressed.close()
+    return uncompressedPath
+
+
+class PipelineCheckpoint(object):
+    """Record the pipeline stages completed in a work folder.
+
+  After each stage its outputs are saved in the work folder and the stage is
+  appended to checkpoint.json. When resuming a run with the same input volumes
+  and parameters, the stages completed by the previous run are restored from the
+  saved outputs; the pipeline runs normally from the first stage that was not
+  completed, and the stages recorded after it are discarded.
+
+  Stages must be queried with isCompleted() in the order the pipeline runs them.
+  With useCompression False the stage output nodes are saved uncompressed. Label
+  map nodes are saved as sparse labels (see sparselabels), which are much smaller
+  than the dense volumes.
+  """
+
+    def __init__(self, workFolder, inputNodes, parameters, resume=False, useCompression=True):
+        self.workFolder = workFolder
+        self.useCompression = useCompression
+        self.manifestPath = os.path.join(workFolder, CHECKPOINT_FILE_NAME)
+        self.inputs = dict((name, volumeDigest(node)) for name, node in inputNodes.items() if node is not None)
+        # Round trip, so the parameters compare equal to the ones read from the manifest
+        self.parameters = json.loads(json.dumps(parameters, sort_keys=True))
+        self.stages = []
+        self.resuming = False
+
+        if resume:
+            previous = self._readManifest()
+            if previous is None:
+                logging.info("No checkpoint found in " + workFolder + ", starting from the first stage")
+            elif previous.get("inputs") != self.inputs or previous.get("parameters") != self.parameters:
+                logging.warning("The checkpoint in " + workFolder +
+                                " was written for different input volumes or parameters, starting from the first stage")
+            else:
+                self.stages = previous.get("stages", [])
+                self.resuming = True
+        self._writeManifest()
+
+    def isCompleted(self, stageName):
+        """Return True if the stage was completed by the resumed run and can be restored."""
+        if not self.resuming:
+            return False
+        for index, stage in enumerate(self.stages):
+            if stage["name"] == stageName:
+                if all(os.path.exists(os.path.join(self.workFolder, fileName)) for fileName in self._stageFiles(stage)):
+                    logging.info("Resuming: stage " + stageName + " restored from the checkpoint")
+                    return True
+                break
+        else:
+            index = len(self.stages)
+        # From this stage on everything is computed again
+        self.resuming = False
+        del self.stages[index:]
+        self._writeManifest()
+        return False
+
+    def hasCompleted(self, stageName):
+        """Return True if the resumed run recorded the stage and its outputs are found. Unlike
+    isCompleted, it does not change the checkpoint, so it can be queried before the stages
+    that run first, e.g. to start a stage in background.
+    """
+        if not self.resuming:
+            return False
+        for stage in self.stages:
+            if stage["name"] == stageName:
+                return all(os.path.exists(os.path.join(self.workFolder, fileName)) for fileName in self._stageFiles(stage))
+        return False
+
+    def complete(self, stageName, files=None, nodes=None):
+        """Record a completed stage. files are stage outputs already written in the work folder
+    (relative paths) and nodes a dictionary name -> volume or transform node to be saved.
+    """
+        savedNodes = {}
+        if nodes:
+            stageFolder = os.path.join(self.workFolder, CHECKPOINT_FOLDER_NAME, stageName)
+            if not os.path.isdir(stageFolder):
+                os.makedirs(stageFolder)
+            for name, node in nodes.items():
+                if node.IsA("vtkMRMLLabelMapVolumeNode"):
+                    fileName = os.path.join(CHECKPOINT_FOLDER_NAME, stageName, name + SPARSE_LABEL_EXTENSION)
+                    writeSparseLabel(sparseLabelFromVolume(node), os.path.join(self.workFolder, fileName),
+                                     self.useCompression)
+                else:
+                    fileName = os.path.join(CHECKPOINT_FOLDER_NAME, stageName,
+                                            name + (".h5" if node.IsA("vtkMRMLTransformNode") else ".nrrd"))
+                    if not slicer.util.saveNode(node, os.path.join(self.workFolder, fileName),
+                                                {"useCompression": 1 if self.useCompression else 0}):
+                        logging.warning("Could not save the checkpoint of stage " + stageName)
+                        return
+                savedNodes[name] = fileName
+
+        self.stages = [stage for stage in self.stages if stage["name"] != stageName]
+        self.stages.append({"name": stageName, "files": list(files or []), "nodes": savedNodes,
+                            "completed": time.time()})
+        self._writeManifest()
+
+    def restoreNodes(self, stageName):
+        """Load the output nodes saved by a completed stage. Returns a dictionary name -> node."""
+        stage = [stage for stage in self.stages if stage["name"] == stageName][0]
+        nodes = {}
+        for name, fileName in stage["nodes"].items():
+            filePath = os.path.join(self.workFolder, fileName)
+            if fileName.endswith(SPARSE_LABEL_EXTENSION):
+                nodes[name] = readSparseLabel(filePath).toVolume()
+                continue
+            if fileName.endswith(".h5"):
+                (read, node) = slicer.util.loadTransform(filePath, True)
+            else:
+                (read, node) = slicer.util.loadVolume(filePath, {}, True)
+            if not read:
+                raise IOError("Could not read the checkpoint file " + filePath)
+            nodes[name] = node
+        return nodes
+
+    def restoreVolumes(self, stageName, volumeNodes):
+        """Copy the volumes saved by a completed stage into the informed nodes
+    (dictionary name -> volume node).
+    """
+        restoredNodes = self.restoreNodes(stageName)
+        for name, volumeNode in volumeNodes.items():
+            copyVolume(restoredNodes[name], volumeNode)
+        for node in restoredNodes.values():
+            slicer.mrmlScene.RemoveNode(node)
+
+    def _stageFiles(self, stage):
+        return list(stage.get("files", [])) + list(stage.get("nodes", {}).values())
+
+    def _readManifest(self):
+        if not os.path.exists(self.manifestPath):
+            return None
+        try:
+            with open(self.manifestPath) as manifest:
+                return json.load(manifest)
+        except ValueError:
+            logging.warning("Ignoring the unreadable checkpoint " + self.manifestPath)
+            return None
+
+    def _writeManifest(self):
+        # Written aside and renamed, so a preempted job never leaves a truncated manifest
+        temporaryPath = self.manifestPath + ".tmp"
+        with open(temporaryPath, "w") as manifest:
+            json.dump({"inputs": self.inputs, "parameters": self.parameters, "stages": self.stages},
+                      manifest, indent=2)
+        try:
+            os.rename(temporaryPath, self.manifestPath)
+        except OSError:
+            # Windows does not replace existing files on rename
+            os.remove(self.manifestPath)
+            os.rename(temporaryPath, self.manifestPath)
@@ -0,0 +1,101 @@
+#
+# DTILesionTrack label fusion
+#
+
+import numpy
+import vtk
+import slicer
+
+from DTILesionTrackLib.nodes import removeNode
+
+# Rules used to fuse the lesion labels of the DTI maps:
+#   Sum      - voxelwise sum of the labels, i.e. the number of maps that flag the voxel
+#   Union    - lesion (1) where at least one map flags the voxel
+#   Majority - lesion (1) where more than half of the maps flag the voxel
+FUSION_RULES = ["Sum", "Union", "Majority"]
+
+
+def fuseLabelArrays(labelArrays, rule="Sum"):
+    """Fuse label arrays with the same shape in a single pass, following one of the FUSION_RULES.
+  Returns an array with the dtype of the first label array.
+  """
+    if rule not in FUSION_RULES:
+        raise ValueError("Unknown label fusion rule: " + str(rule) + " (options: " + ", ".join(FUSION_RULES) + ")")
+    if not labelArrays:
+        raise ValueError("No label to fuse")
+
+    outputType = labelArrays[0].dtype
+    if rule == "Sum":
+        fused = numpy.zeros(labelArrays[0].shape, numpy.int32)
+        for labelArray in labelArrays:
+            fused += labelArray
+        return fused.astype(outputType)
+
+    votes = numpy.zeros(labelArrays[0].shape, numpy.uint8)
+    for labelArray in labelArrays:
+        votes += labelArray > 0
+    if rule == "Union":
+        return (votes > 0).astype(outputType)
+    return (2 * votes > len(labelArrays)).astype(outputType)
+
+
+def fusedLesionLabel(rule, numberOfLabels):
+    """Label value that marks the voxels flagged by every map in the fused label."""
+    if rule == "Sum":
+        return numberOfLabels
+    return 1
+
+
+def sameGeometry(volumeNode1, volumeNode2):
+    """Return True if both volumes share the same dimensions and IJK to RAS matrix."""
+    if volumeNode1.GetImageData().GetDimensions() != volumeNode2.GetImageData().GetDimensions():
+        return False
+    matrix1 = vtk.vtkMatrix4x4()
+    matrix2 = vtk.vtkMatrix4x4()
+    volumeNode1.GetIJKToRASMatrix(matrix1)
+    volumeNode2.GetIJKToRASMatrix(matrix2)
+    return all(abs(matrix1.GetElement(i, j) - matrix2.GetElement(i, j)) < 1e-6 for i in range(4) for j in range(4))
+
+
+def fuseLabelVolumes(labelNodes, outputNode, rule="Sum"):
+    """Fuse the label volumes into outputNode (which may be one of the inputs) in memory.
+
+  Labels defined on a grid other than the one of the first label are resampled
+  on it (nearest neighbor) before the fusion. The resampled copies are removed
+  from the scene afterwards.
+  """
+    referenceNode = labelNodes[0]
+    labelArrays = []
+    resampledNodes = []
+    try:
+        for labelNode in labelNodes:
+            if labelNode is not referenceNode and not sameGeometry(referenceNode, labelNode):
+                labelNode = resampleLabel(labelNode, referenceNode)
+                resampledNodes.append(labelNode)
+            labelArrays.append(slicer.util.arrayFromVolume(labelNode))
+
+        fused = fuseLabelArrays(labelArrays, rule)
+    finally:
+        for resampledNode in resampledNodes:
+            removeNode(resampledNode)
+    if outputNode is not referenceNode:
+        ijkToRAS = vtk.vtkMatrix4x4()
+        referenceNode.GetIJKToRASMatrix(ijkToRAS)
+        outputNode.SetIJKToRASMatrix(ijkToRAS)
+    slicer.util.updateVolumeFromArray(outputNode, fused)
+    return outputNode
+
+
+def resampleLabel(labelNode, referenceNode):
+    """Return a copy of labelNode resampled (nearest neighbor) on the referenceNode grid."""
+    resampledNode = slicer.vtkMRMLLabelMapVolumeNode()
+    slicer.mrmlScene.AddNode(resampledNode)
+    resampleParams = {}
+    resampleParams["inputVolume"] = labelNode.GetID()
+    resampleParams["referenceVolume"] = referenceNode.GetID()
+    resampleParams["outputVolume"] = resampledNode.GetID()
+    resampleParams["interpolationType"] = "nn"
+
+    cliNode = slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, resampleParams, wait_for_completion=True)
+    removeNode(cliNode)
+    return resampledNode
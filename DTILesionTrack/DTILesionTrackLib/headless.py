@@ -0,0 +1,61 @@
+#
+# DTILesionTrack headless entry point
+#
+# Runs the DTILesionTrack pipeline described in a JSON/YAML parameter file
+# (see parameters.readParameterFile) without building the module widget:
+#
+#   Slicer --no-splash --no-main-window --python-script <path>/DTILesionTrackLib/headless.py parameters.json
+#
+# The result (status and output label path) is written in result.json inside
+# the output folder and the process exits with a non zero status on failure.
+#
+
+import json
+import logging
+import os
+import sys
+
+from DTILesionTrackLib.batch import RESULT_FILE_NAME
+from DTILesionTrackLib.parameters import readParameterFile
+
+
+def runParameterFile(parameterFile):
+    """Run the pipeline described in parameterFile and return the result dictionary."""
+    return runDescription(readParameterFile(parameterFile))
+
+
+def runDescription(description, logic=None):
+    """Run the pipeline on a run description (see parameters.readParameterFile), write
+  result.json in its output folder and return the result dictionary.
+  """
+    import DTILesionTrack
+
+    subject = description["subject"]
+    outputFolder = description["outputFolder"]
+    result = {"id": subject["id"], "status": "failed"}
+    try:
+        if logic is None:
+            logic = DTILesionTrack.DTILesionTrackLogic()
+        result["outputLabel"] = logic.runSubject(subject, outputFolder, description["parameters"])
+        result["status"] = "completed"
+    except Exception as e:
+        logging.exception("DTILesionTrack failed for subject " + subject["id"])
+        result["error"] = str(e)
+
+    if not os.path.isdir(outputFolder):
+        os.makedirs(outputFolder)
+    with open(os.path.join(outputFolder, RESULT_FILE_NAME), "w") as resultFile:
+        json.dump(result, resultFile, indent=2)
+    return result
+
+
+def main(argv):
+    if len(argv) != 1:
+        sys.stderr.write("Usage: Slicer --no-main-window --python-script headless.py <parameters.json|.yml>\n")
+        return 2
+    result = runParameterFile(argv[0])
+    return 0 if result["status"] == "completed" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,160 @@
+#
+# DTILesionTrack in-process LSDP segmentation
+#
+# Same voxel-wise T-Score inference as the LSDPBrainSegmentation CLI, computed
+# with NumPy on volumes already loaded in the scene.
+#
+
+import numpy
+import vtk
+import slicer
+
+from DTILesionTrackLib.templates import templateCache
+
+# Tail of the T-Score distribution where a lesion is expected for each DTI map
+# (LocalDecision in LSDPBrainSegmentation.cxx): lesions lower the anisotropy and
+# raise the diffusivity.
+LOW_TAIL_MAP_TYPES = ["FractionalAnisotropy", "RelativeAnisotropy"]
+HIGH_TAIL_MAP_TYPES = ["MeanDiffusivity", "PerpendicularDiffusivity", "VolumeRatio"]
+
+# Name of each DTI map in the statistical template files
+STATISTICAL_TEMPLATE_NAMES = {
+    "FractionalAnisotropy": "FA",
+    "MeanDiffusivity": "MD",
+    "RelativeAnisotropy": "RA",
+    "PerpendicularDiffusivity": "PerpDiff",
+    "VolumeRatio": "VR",
+}
+
+
+def directionalTScore(mapArray, meanArray, stdArray, mapType):
+    """Return the T-Score (x - mean)/std of a DTI map array, signed so that positive values
+  point to the lesion tail of the map type. Voxels where the template mean is zero are NaN.
+  """
+    if mapArray.shape != meanArray.shape or mapArray.shape != stdArray.shape:
+        raise ValueError("The " + mapType + " map and the statistical templates must have the same dimensions")
+    if mapType not in LOW_TAIL_MAP_TYPES and mapType not in HIGH_TAIL_MAP_TYPES:
+        raise ValueError("Unknown DTI map type: " + str(mapType))
+
+    mean = meanArray.astype(numpy.float32, copy=False)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        tScore = (mapArray.astype(numpy.float32, copy=False) - mean) / stdArray.astype(numpy.float32, copy=False)
+    if mapType in LOW_TAIL_MAP_TYPES:
+        tScore = numpy.negative(tScore, out=tScore)
+    tScore[mean == 0] = numpy.nan
+    return tScore
+
+
+def tScoreLabel(mapArray, meanArray, stdArray, tThreshold, mapType, wmMaskArray=None):
+    """Return the LSDP lesion label (uint8 array) of a DTI map array in the template space.
+
+  Voxels where the template mean is zero are skipped, the T-Score (x - mean)/std is
+  thresholded on the tail of the map type and the result is restricted to the white
+  matter mask, as done by the LSDPBrainSegmentation CLI.
+  """
+    with numpy.errstate(invalid="ignore"):
+        lesion = directionalTScore(mapArray, meanArray, stdArray, mapType) >= tThreshold
+    if wmMaskArray is not None:
+        lesion &= wmMaskArray != 0
+    return lesion.astype(numpy.uint8)
+
+
+def lsdpLabels(mapArrays, statisticalArrays, tThreshold, wmMaskArray=None):
+    """Segment several DTI maps in one call.
+
+  mapArrays is a dictionary map type -> map array and statisticalArrays a dictionary
+  map type -> (mean array, std array). Returns a dictionary map type -> label array.
+  """
+    labels = {}
+    for mapType, mapArray in mapArrays.items():
+        (meanArray, stdArray) = statisticalArrays[mapType]
+        labels[mapType] = tScoreLabel(mapArray, meanArray, stdArray, tThreshold, mapType, wmMaskArray)
+    return labels
+
+
+def jointLSDPLabels(mapArrays, statisticalArrays, tThreshold, wmMaskArray=None, slabSize=16):
+    """Joint (multivariate) LSDP segmentation of all the informed DTI maps.
+
+  The directional T-Scores of the maps are combined per voxel with the Stouffer rule,
+  sum(t) / sqrt(n), where n is the number of maps with a valid T-Score in the voxel,
+  and the joint score is thresholded with the same tThreshold. Arguments are the ones of
+  lsdpLabels. The volumes are processed in slabs of slabSize slices, so the temporary
+  arrays stay small. Returns the joint label and the dictionary of per-map labels.
+  """
+    shape = list(mapArrays.values())[0].shape
+    jointLabel = numpy.zeros(shape, numpy.uint8)
+    labels = dict((mapType, numpy.zeros(shape, numpy.uint8)) for mapType in mapArrays)
+
+    for start in range(0, shape[0], slabSize):
+        slab = slice(start, start + slabSize)
+        scoreSum = numpy.zeros((min(slabSize, shape[0] - start),) + shape[1:], numpy.float32)
+        validMaps = numpy.zeros(scoreSum.shape, numpy.uint8)
+        for mapType, mapArray in mapArrays.items():
+            (meanArray, stdArray) = statisticalArrays[mapType]
+            tScore = directionalTScore(mapArray[slab], meanArray[slab], stdArray[slab], mapType)
+            valid = numpy.isfinite(tScore)
+            with numpy.errstate(invalid="ignore"):
+                labels[mapType][slab] = tScore >= tThreshold
+            scoreSum += numpy.where(valid, tScore, 0)
+            validMaps += valid
+
+        jointScore = scoreSum / numpy.sqrt(numpy.maximum(validMaps, 1))
+        jointLabel[slab] = (validMaps > 0) & (jointScore >= tThreshold)
+        if wmMaskArray is not None:
+            wmSlab = wmMaskArray[slab] != 0
+            jointLabel[slab] &= wmSlab
+            for mapType in labels:
+                labels[mapType][slab] &= wmSlab
+    return (jointLabel, labels)
+
+
+def inputArrays(inputVolumes, mapResolution):
+    """Return the map arrays, the statistical template arrays and the white matter mask
+  array used to segment the inputVolumes (dictionary map type -> volume node). The
+  templates come from the session template cache, so they are read from disk only once.
+  """
+    templates = templateCache()
+    mapArrays = {}
+    statisticalArrays = {}
+    for mapType, inputVolume in inputVolumes.items():
+        templateName = STATISTICAL_TEMPLATE_NAMES[mapType]
+        mapArrays[mapType] = slicer.util.arrayFromVolume(inputVolume)
+        statisticalArrays[mapType] = (
+            slicer.util.arrayFromVolume(templates.getStatistical(templateName, "mean", mapResolution)),
+            slicer.util.arrayFromVolume(templates.getStatistical(templateName, "std", mapResolution)))
+    wmMaskArray = slicer.util.arrayFromVolume(templates.getWhiteMatterMask(mapResolution))
+    return (mapArrays, statisticalArrays, wmMaskArray)
+
+
+def segmentLSDPVolumes(inputVolumes, outputLabels, mapResolution, tThreshold):
+    """Run the LSDP segmentation on DTI map volumes registered to the template space.
+
+  inputVolumes and outputLabels are dictionaries map type -> volume node.
+  """
+    (mapArrays, statisticalArrays, wmMaskArray) = inputArrays(inputVolumes, mapResolution)
+
+    labels = lsdpLabels(mapArrays, statisticalArrays, tThreshold, wmMaskArray)
+    for mapType, outputLabel in outputLabels.items():
+        ijkToRAS = vtk.vtkMatrix4x4()
+        inputVolumes[mapType].GetIJKToRASMatrix(ijkToRAS)
+        outputLabel.SetIJKToRASMatrix(ijkToRAS)
+        slicer.util.updateVolumeFromArray(outputLabel, labels[mapType])
+    return outputLabels
+
+
+def segmentJointLSDPVolumes(inputVolumes, jointLabel, outputLabels, mapResolution, tThreshold):
+    """Run the joint LSDP segmentation (see jointLSDPLabels) on DTI map volumes registered to
+  the template space. inputVolumes and outputLabels are dictionaries map type -> volume node;
+  jointLabel receives the joint label.
+  """
+    (mapArrays, statisticalArrays, wmMaskArray) = inputArrays(inputVolumes, mapResolution)
+
+    (jointArray, labels) = jointLSDPLabels(mapArrays, statisticalArrays, tThreshold, wmMaskArray)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    list(inputVolumes.values())[0].GetIJKToRASMatrix(ijkToRAS)
+    for mapType, outputLabel in outputLabels.items():
+        outputLabel.SetIJKToRASMatrix(ijkToRAS)
+        slicer.util.updateVolumeFromArray(outputLabel, labels[mapType])
+    jointLabel.SetIJKToRASMatrix(ijkToRAS)
+    slicer.util.updateVolumeFromArray(jointLabel, jointArray)
+    return jointLabel
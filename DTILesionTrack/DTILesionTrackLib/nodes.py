@@ -0,0 +1,129 @@
+#
+# DTILesionTrack intermediate nodes
+#
+
+import logging
+
+import slicer
+
+# Classes of the nodes a pipeline run creates and that hold memory: data nodes and
+# the parameter nodes of the CLI modules it runs
+TRACKED_NODE_CLASSES = ["vtkMRMLVolumeNode", "vtkMRMLTransformNode", "vtkMRMLCommandLineModuleNode"]
+
+# Groups of intermediate nodes that can be kept in the scene after a run:
+#   registered    - input volumes linearly registered to the T1 volume
+#   templateSpace - DTI maps taken to the DTI template space
+#   transforms    - linear transforms and composed displacement fields
+#   mapLabels     - lesion labels of each DTI map, before the fusion
+#   structural    - T1 and T2-FLAIR lesion label
+INTERMEDIATE_GROUPS = ["registered", "templateSpace", "transforms", "mapLabels", "structural"]
+
+
+def parseIntermediateGroups(groups):
+    """Return the list of intermediate groups informed as a comma separated string (or a
+  list). "all" stands for all the INTERMEDIATE_GROUPS.
+  """
+    if not isinstance(groups, (list, tuple)):
+        groups = [group.strip() for group in (groups or "").split(",") if group.strip()]
+    if "all" in groups:
+        return list(INTERMEDIATE_GROUPS)
+    for group in groups:
+        if group not in INTERMEDIATE_GROUPS:
+            raise ValueError("Unknown intermediate group: " + str(group) +
+                             " (options: all, " + ", ".join(INTERMEDIATE_GROUPS) + ")")
+    return list(groups)
+
+
+def sceneNodes(className):
+    """Return the nodes of a class (subclasses included) present in the scene."""
+    collection = slicer.mrmlScene.GetNodesByClass(className)
+    nodes = [collection.GetItemAsObject(index) for index in range(collection.GetNumberOfItems())]
+    collection.UnRegister(slicer.mrmlScene)
+    return nodes
+
+
+def removeNode(node):
+    """Remove a node from the scene along with its display and storage nodes."""
+    if node is None or not slicer.mrmlScene.IsNodePresent(node):
+        return
+    if node.IsA("vtkMRMLDisplayableNode"):
+        for index in reversed(range(node.GetNumberOfDisplayNodes())):
+            displayNode = node.GetNthDisplayNode(index)
+            if displayNode is not None:
+                slicer.mrmlScene.RemoveNode(displayNode)
+    if node.IsA("vtkMRMLStorableNode"):
+        for index in reversed(range(node.GetNumberOfStorageNodes())):
+            storageNode = node.GetNthStorageNode(index)
+            if storageNode is not None:
+                slicer.mrmlScene.RemoveNode(storageNode)
+    slicer.mrmlScene.RemoveNode(node)
+
+
+class NodeScope(object):
+    """Remove from the scene the intermediate nodes created by a pipeline run.
+
+  Every node of the TRACKED_NODE_CLASSES added to the scene after the scope was
+  created is owned by it: release() removes owned nodes as soon as the stages that
+  use them are done, and close() removes the remaining ones at the end of the run.
+  Nodes already in the scene (e.g. the input and output volumes) are never removed.
+
+  Nodes can be tagged with one of the INTERMEDIATE_GROUPS; the nodes of the groups
+  in keepGroups, and the nodes passed to keep(), stay in the scene.
+  """
+
+    def __init__(self, keepGroups=()):
+        self.keepGroups = set(parseIntermediateGroups(keepGroups))
+        self.initialNodeIDs = set(node.GetID() for className in TRACKED_NODE_CLASSES
+                                  for node in sceneNodes(className))
+        self.nodeGroups = {}
+        self.keptNodeIDs = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exceptionValue, traceback):
+        self.close()
+        return False
+
+    def tag(self, group, *nodes):
+        """Tag nodes with an intermediate group."""
+        if group not in INTERMEDIATE_GROUPS:
+            raise ValueError("Unknown intermediate group: " + str(group))
+        for node in nodes:
+            if node is not None:
+                self.nodeGroups[node.GetID()] = group
+
+    def keep(self, *nodes):
+        """Keep nodes in the scene after the run."""
+        for node in nodes:
+            if node is not None:
+                self.keptNodeIDs.add(node.GetID())
+
+    def isKept(self, node):
+        """Return True if the node is not owned by the scope or must be kept in the scene."""
+        nodeID = node.GetID()
+        return (nodeID is None or nodeID in self.initialNodeIDs or nodeID in self.keptNodeIDs or
+                self.nodeGroups.get(nodeID) in self.keepGroups)
+
+    def release(self, *nodes):
+        """Remove nodes no longer used by the run, unless they must be kept."""
+        for node in nodes:
+            if node is not None and slicer.mrmlScene.IsNodePresent(node) and not self.isKept(node):
+                self.nodeGroups.pop(node.GetID(), None)
+                removeNode(node)
+
+    def close(self, keepNodes=()):
+        """Remove all the owned nodes still in the scene, except keepNodes and the kept ones.
+    Returns the number of nodes removed.
+    """
+        keepNodeIDs = set(node.GetID() for node in keepNodes)
+        removed = 0
+        for className in TRACKED_NODE_CLASSES:
+            for node in sceneNodes(className):
+                if node.GetID() in keepNodeIDs or self.isKept(node):
+                    continue
+                removeNode(node)
+                removed += 1
+        self.nodeGroups = {}
+        logging.info("%d intermediate nodes removed from the scene" % removed)
+        return removed
@@ -0,0 +1,115 @@
+#
+# DTILesionTrack processing parameters
+#
+
+import json
+import os
+
+from DTILesionTrackLib.batch import normalizeSubject
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Values used when a parameter is not informed. They follow the defaults shown
+# in the DTILesionTrackWidget form.
+DEFAULT_PARAMETERS = {
+    "applyBET": False,
+    "applyNoiseAttenuation": False,
+    "applyQuickANTS": True,
+    "outputICBMSpace": True,
+    "filterCondutance": 5,
+    "filterNumInt": 5,
+    "filterQ": 1.2,
+    "interpolationMethod": "Linear",
+    "templateDTIResolution": "1mm",
+    "templateDTI": "USP-20",
+    "segmentationApproach": "Bayesian",
+    "lsdpTScoreThreshold": 2.5,
+    "thresholdMethod": "Otsu",
+    "clusterNumberOfClasses": 2,
+    "labelFusionRule": "Sum",
+    "lsdpInProcess": True,
+    "useStageCache": False,
+    "stageCacheFolder": "",
+    "resume": False,
+    "uncompressedScratch": False,
+    "stageConcurrency": 2,
+    "cropToWhiteMatter": False,
+    "streamDivisions": 1,
+    "keepIntermediates": "",
+    "templateCacheSize": 1024,
+    "kmeansHistogramBins": 0,
+}
+
+# Options accepted by the enumerated parameters
+PARAMETER_CHOICES = {
+    "interpolationMethod": ["Linear", "BSpline", "NearestNeighbor"],
+    "templateDTIResolution": ["1mm", "2mm"],
+    "templateDTI": ["USP-20", "USP-131", "JHU-81"],
+    "segmentationApproach": ["Bayesian", "LSDP", "SpatialClustering", "JointLSDP"],
+    "thresholdMethod": ["Otsu", "MaxEntropy", "Yen", "IsoData", "Moments", "Renyi"],
+    "labelFusionRule": ["Sum", "Union", "Majority"],
+}
+
+
+def completeParameters(parameters=None):
+    """Return a copy of the informed parameters where the missing entries are
+  filled with the DEFAULT_PARAMETERS values.
+  """
+    completed = dict(DEFAULT_PARAMETERS)
+    if parameters:
+        for name in parameters:
+            if name not in DEFAULT_PARAMETERS:
+                raise ValueError("Unknown DTILesionTrack parameter: " + str(name))
+            completed[name] = parameters[name]
+    for name, choices in PARAMETER_CHOICES.items():
+        if completed[name] not in choices:
+            raise ValueError("Invalid value for " + name + ": " + str(completed[name]) +
+                             " (options: " + ", ".join(choices) + ")")
+    for name, default in DEFAULT_PARAMETERS.items():
+        if isinstance(default, bool):
+            if not isinstance(completed[name], bool):
+                raise ValueError("Parameter " + name + " must be true or false")
+        elif isinstance(default, (int, float)):
+            completed[name] = type(default)(completed[name])
+    return completed
+
+
+def readParameterFile(parameterFile):
+    """Read a headless run description from a JSON or YAML file.
+
+  The file must inform the subject volumes, the output folder and, optionally,
+  the processing parameters (missing ones use DEFAULT_PARAMETERS):
+
+    subject:
+      id: patient01
+      FLAIR: patient01/flair.nii.gz
+      T1: patient01/t1.nii.gz
+      FA: patient01/fa.nii.gz
+    outputFolder: patient01/DTILesionTrack
+    parameters:
+      segmentationApproach: LSDP
+      templateDTIResolution: 2mm
+
+  Relative paths are resolved from the parameter file folder.
+  """
+    with open(parameterFile) as description:
+        if parameterFile.lower().endswith((".yml", ".yaml")):
+            if yaml is None:
+                raise ImportError("PyYAML is required to read " + parameterFile + ". Use a JSON parameter file instead.")
+            description = yaml.safe_load(description)
+        else:
+            description = json.load(description)
+
+    baseFolder = os.path.dirname(os.path.abspath(parameterFile))
+    if not description.get("subject"):
+        raise ValueError("The parameter file does not inform the subject volumes: " + parameterFile)
+    if not description.get("outputFolder"):
+        raise ValueError("The parameter file does not inform the output folder: " + parameterFile)
+    return {
+        "subject": normalizeSubject(description["subject"], baseFolder),
+        "outputFolder": os.path.join(baseFolder, os.path.expanduser(description["outputFolder"])),
+        "parameters": completeParameters(description.get("parameters")),
+    }
@@ -0,0 +1,158 @@
+#
+# DTILesionTrack stage profiling
+#
+
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak memory is not reported there
+    resource = None
+
+# Report written in the work folder of each run
+PROFILE_FILE_NAME = "profile.json"
+
+
+def peakRSS(who):
+    """Return the peak resident set size, in bytes, of the current process (who is
+  resource.RUSAGE_SELF) or of its finished child processes (resource.RUSAGE_CHILDREN).
+  Returns None where it is not available.
+  """
+    if resource is None:
+        return None
+    maxRSS = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return maxRSS if sys.platform == "darwin" else maxRSS * 1024
+
+
+def folderFiles(folder):
+    """Return a dictionary relative path -> (size, modification time) of the files in folder."""
+    files = {}
+    for root, dirNames, fileNames in os.walk(folder):
+        for fileName in fileNames:
+            filePath = os.path.join(root, fileName)
+            try:
+                status = os.stat(filePath)
+            except OSError:
+                continue
+            files[os.path.relpath(filePath, folder)] = (status.st_size, status.st_mtime)
+    return files
+
+
+def bytesWritten(filesBefore, filesAfter):
+    """Size of the files created or modified between two folderFiles snapshots."""
+    return sum(size for path, (size, modified) in filesAfter.items()
+               if filesBefore.get(path) != (size, modified))
+
+
+class StageProfiler(object):
+    """Record the resources used by each stage of a pipeline run.
+
+  For every stage the wall time, the CPU time of the Slicer process and of its
+  finished child processes (CLI modules, ANTs, FSL), the peak resident memory of
+  the child processes and the bytes written in the work folder are recorded. The
+  report is written in profile.json inside the work folder after each stage, so
+  it is also available for runs that did not complete.
+
+  Stages are sequential: start() ends the running stage and finish() the last one.
+  The child peak memory is a process-wide maximum, so a stage only reports it when
+  it raised the maximum reached by the previous stages (None otherwise).
+  """
+
+    def __init__(self, workFolder):
+        self.workFolder = workFolder
+        self.reportPath = os.path.join(workFolder, PROFILE_FILE_NAME)
+        self.stages = []
+        self.status = "running"
+        self.failedStage = None
+        self.startTime = time.time()
+        self._stage = None
+        self._writeReport()
+
+    def start(self, stageName):
+        """Start measuring a stage, ending the running one."""
+        self._endStage()
+        self._stage = {"name": stageName, "started": time.time(), "times": os.times(),
+                       "childPeakRSS": peakRSS(resource.RUSAGE_CHILDREN) if resource else None,
+                       "files": folderFiles(self.workFolder)}
+
+    def finish(self, status="completed"):
+        """End the running stage and write the final report. When the run did not complete,
+    the running stage is reported as failedStage.
+    """
+        if status != "completed" and self._stage is not None:
+            self.failedStage = self._stage["name"]
+        self._endStage()
+        self.status = status
+        self._writeReport()
+
+    def totals(self):
+        """Return the totals of the run: wall time, CPU times, peak memories and bytes written."""
+        return summarizeStages(self.stages, time.time() - self.startTime)
+
+    def _endStage(self):
+        if self._stage is None:
+            return
+        stage = self._stage
+        self._stage = None
+        times = os.times()
+        childPeakRSS = peakRSS(resource.RUSAGE_CHILDREN) if resource else None
+        self.stages.append({
+            "name": stage["name"],
+            "wallTime": time.time() - stage["started"],
+            "cpuTime": (times[0] - stage["times"][0]) + (times[1] - stage["times"][1]),
+            "childCPUTime": (times[2] - stage["times"][2]) + (times[3] - stage["times"][3]),
+            "childPeakRSS": childPeakRSS if childPeakRSS is not None and childPeakRSS > stage["childPeakRSS"] else None,
+            "peakRSS": peakRSS(resource.RUSAGE_SELF) if resource else None,
+            "bytesWritten": bytesWritten(stage["files"], folderFiles(self.workFolder)),
+        })
+        self._writeReport()
+
+    def _writeReport(self):
+        # Written aside and renamed, so readers never see a truncated report
+        temporaryPath = self.reportPath + ".tmp"
+        with open(temporaryPath, "w") as report:
+            json.dump({"status": self.status, "failedStage": self.failedStage, "started": self.startTime,
+                       "stages": self.stages, "total": self.totals()}, report, indent=2)
+        try:
+            os.rename(temporaryPath, self.reportPath)
+        except OSError:
+            # Windows does not replace existing files on rename
+            os.remove(self.reportPath)
+            os.rename(temporaryPath, self.reportPath)
+
+
+def summarizeStages(stages, wallTime=None):
+    """Totals of a list of stage records (see StageProfiler). slowestStage is the name
+  of the stage with the longest wall time.
+  """
+    def maximum(key):
+        values = [stage[key] for stage in stages if stage.get(key) is not None]
+        return max(values) if values else None
+
+    slowest = max(stages, key=lambda stage: stage["wallTime"]) if stages else None
+    return {
+        "wallTime": wallTime if wallTime is not None else sum(stage["wallTime"] for stage in stages),
+        "cpuTime": sum(stage["cpuTime"] for stage in stages),
+        "childCPUTime": sum(stage["childCPUTime"] for stage in stages),
+        "childPeakRSS": maximum("childPeakRSS"),
+        "peakRSS": maximum("peakRSS"),
+        "bytesWritten": sum(stage["bytesWritten"] for stage in stages),
+        "slowestStage": slowest["name"] if slowest else None,
+    }
+
+
+def readProfile(workFolder):
+    """Return the profile report written in workFolder, or None if there is none."""
+    reportPath = os.path.join(workFolder, PROFILE_FILE_NAME)
+    if not os.path.exists(reportPath):
+        return None
+    try:
+        with open(reportPath) as report:
+            return json.load(report)
+    except ValueError:
+        return None
@@ -0,0 +1,118 @@
+#
+# DTILesionTrack stage scheduler
+#
+
+import inspect
+import logging
+import time
+
+import slicer
+
+# Interval between two checks of the running CLI modules, in seconds
+POLLING_INTERVAL = 0.05
+
+
+def isRunning(cliNode):
+    """Return True while a CLI module node started by slicer.cli.run is scheduled or running."""
+    return (cliNode.GetStatus() & cliNode.BusyMask) != 0
+
+
+def checkCompleted(cliNode):
+    """Raise RuntimeError if a finished CLI module node did not complete successfully."""
+    if cliNode.GetStatusString() != "Completed":
+        raise RuntimeError(cliNode.GetModuleTitle() + " " + cliNode.GetStatusString().lower())
+
+
+def waitForCLINodes(cliNodes):
+    """Wait until the CLI module nodes (started with wait_for_completion=False) finished,
+  keeping the application responsive. Raises RuntimeError if one of them failed.
+  """
+    while any(isRunning(cliNode) for cliNode in cliNodes):
+        slicer.app.processEvents()
+        time.sleep(POLLING_INTERVAL)
+    for cliNode in cliNodes:
+        checkCompleted(cliNode)
+
+
+class StageScheduler(object):
+    """Run pipeline stages as soon as the stages they depend on are done, running up to
+  maxConcurrentStages stages at the same time.
+
+  A stage is a function called without arguments. When it is a generator function, it
+  yields the CLI module nodes it started (slicer.cli.run with wait_for_completion=False),
+  one node or a list, and it is resumed once they finished. All the stages run on the
+  main thread, so they can use the MRML scene; the concurrency comes from the CLI
+  modules, which run outside the Python interpreter. Stages are started in the order
+  they were added among the ones that are ready.
+  """
+
+    def __init__(self, maxConcurrentStages=1):
+        self.maxConcurrentStages = max(1, int(maxConcurrentStages))
+        self.stages = []
+
+    def add(self, name, function, dependencies=()):
+        """Add a stage. dependencies are the names of the stages that must be done before it;
+    dependencies that were not added (e.g. stages restored from a checkpoint) are ignored.
+    """
+        if name in [stage[0] for stage in self.stages]:
+            raise ValueError("Stage " + name + " was already added")
+        self.stages.append((name, function, list(dependencies)))
+
+    def run(self):
+        """Run all the stages. If a stage fails, the CLI modules still running are cancelled
+    and the exception is raised again.
+    """
+        names = [stage[0] for stage in self.stages]
+        pending = [(name, function, [dependency for dependency in dependencies if dependency in names])
+                   for (name, function, dependencies) in self.stages]
+        running = {}
+        done = set()
+        try:
+            while pending or running:
+                for stage in list(pending):
+                    if len(running) >= self.maxConcurrentStages:
+                        break
+                    (name, function, dependencies) = stage
+                    if all(dependency in done for dependency in dependencies):
+                        pending.remove(stage)
+                        logging.info("Stage " + name + " started")
+                        result = function()
+                        if inspect.isgenerator(result):
+                            running[name] = (result, [])
+                            self._resume(name, running, done)
+                        else:
+                            done.add(name)
+                if pending and not running and not any(all(dependency in done for dependency in stage[2])
+                                                       for stage in pending):
+                    raise ValueError("Circular dependency among the stages " + ", ".join(stage[0] for stage in pending))
+
+                waiting = True
+                for name in list(running):
+                    cliNodes = running[name][1]
+                    if not any(isRunning(cliNode) for cliNode in cliNodes):
+                        for cliNode in cliNodes:
+                            checkCompleted(cliNode)
+                        self._resume(name, running, done)
+                        waiting = False
+                if running and waiting:
+                    slicer.app.processEvents()
+                    time.sleep(POLLING_INTERVAL)
+        except Exception:
+            for (generator, cliNodes) in running.values():
+                for cliNode in cliNodes:
+                    if isRunning(cliNode):
+                        slicer.cli.cancel(cliNode)
+            raise
+
+    def _resume(self, name, running, done):
+        generator = running[name][0]
+        try:
+            cliNodes = next(generator)
+        except StopIteration:
+            del running[name]
+            done.add(name)
+            logging.info("Stage " + name + " done")
+            return
+        if not isinstance(cliNodes, (list, tuple)):
+            cliNodes = [cliNodes]
+        running[name] = (generator, [cliNode for cliNode in cliNodes if cliNode is not None])
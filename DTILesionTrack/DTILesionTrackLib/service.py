@@ -0,0 +1,220 @@
+#
+# DTILesionTrack worker service
+#
+# Keeps a Slicer process running, with the brain templates loaded, and runs the jobs
+# submitted to a spool folder one after the other, so the Slicer startup, the module
+# loading and the template reading are paid once instead of once per subject:
+#
+#   Slicer --no-splash --no-main-window --python-script <path>/DTILesionTrackLib/service.py <spoolFolder> [preload.json]
+#
+# preload.json informs the processing parameters (as in the parameters section of a
+# headless parameter file) whose templates are loaded at startup. Jobs are submitted
+# with submitJob, from any process, and several workers can serve the same spool folder.
+# Creating a file named stop in the spool folder ends all its workers once their running
+# jobs are done; remove it before starting workers again.
+#
+
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+import slicer
+
+from DTILesionTrackLib.batch import normalizeSubject
+from DTILesionTrackLib.headless import runDescription
+from DTILesionTrackLib.lsdp import STATISTICAL_TEMPLATE_NAMES
+from DTILesionTrackLib.parameters import completeParameters
+from DTILesionTrackLib.profiling import readProfile
+from DTILesionTrackLib.templates import templateCache, TEMPLATE_MAP_TYPES
+
+# Spool folder layout: jobs waiting in incoming are claimed by a worker, which moves
+# them to running, and the job results (with the stage report) are written in done
+INCOMING_FOLDER_NAME = "incoming"
+RUNNING_FOLDER_NAME = "running"
+DONE_FOLDER_NAME = "done"
+STOP_FILE_NAME = "stop"
+
+# Interval between two checks of the incoming jobs, in seconds
+POLLING_INTERVAL = 1.0
+
+
+def spoolFolders(spoolFolder):
+    """Return the incoming, running and done folders of a spool folder, creating them."""
+    folders = [os.path.join(spoolFolder, name) for name in (INCOMING_FOLDER_NAME, RUNNING_FOLDER_NAME, DONE_FOLDER_NAME)]
+    for folder in folders:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+    return folders
+
+
+def writeJSON(path, content):
+    """Write a JSON file through a partial file and a rename, so readers polling the
+  folder never find it half written.
+  """
+    with open(path + ".partial", "w") as partialFile:
+        json.dump(content, partialFile, indent=2)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + ".partial", path)
+
+
+def submitJob(spoolFolder, subject, outputFolder, parameters=None, jobId=None):
+    """Submit a job to the workers serving spoolFolder and return its id. subject and
+  parameters are the ones DTILesionTrackLogic.runSubject takes; the subject volumes
+  and the output folder can be relative to the current folder.
+  """
+    jobId = jobId or time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+    description = {
+        "subject": normalizeSubject(subject, os.getcwd()),
+        "outputFolder": os.path.abspath(os.path.expanduser(outputFolder)),
+        "parameters": completeParameters(parameters),
+    }
+    incomingFolder = spoolFolders(spoolFolder)[0]
+    writeJSON(os.path.join(incomingFolder, jobId + ".json"), description)
+    return jobId
+
+
+def readJobResult(spoolFolder, jobId):
+    """Return the result of a job (see SpoolWorker.runJob), or None if it is not done."""
+    resultPath = os.path.join(spoolFolder, DONE_FOLDER_NAME, jobId + ".json")
+    if not os.path.exists(resultPath):
+        return None
+    with open(resultPath) as resultFile:
+        return json.load(resultFile)
+
+
+def waitForJob(spoolFolder, jobId, timeout=None, pollingInterval=POLLING_INTERVAL):
+    """Wait until a job is done and return its result, or None after timeout seconds."""
+    startTime = time.time()
+    while True:
+        result = readJobResult(spoolFolder, jobId)
+        if result is not None or (timeout is not None and time.time() - startTime > timeout):
+            return result
+        time.sleep(pollingInterval)
+
+
+def preloadTemplates(parameters=None):
+    """Load in the session template cache the templates used by runs with the informed
+  parameters (missing ones use DEFAULT_PARAMETERS).
+  """
+    parameters = completeParameters(parameters)
+    templateSet = parameters["templateDTI"]
+    resolution = parameters["templateDTIResolution"]
+    lsdp = parameters["segmentationApproach"] in ("LSDP", "JointLSDP")
+    templates = templateCache()
+    templates.beginRun()
+    templates.setMaximumMemorySize(parameters["templateCacheSize"])
+    loaders = [lambda: templates.get("T1", templateSet, resolution)]
+    for mapType in TEMPLATE_MAP_TYPES:
+        if mapType != "T1" and (templateSet != "JHU-81" or mapType == "FA"):
+            loaders.append(lambda mapType=mapType: templates.get(mapType, templateSet, resolution))
+    if lsdp:
+        for templateName in STATISTICAL_TEMPLATE_NAMES.values():
+            for statistic in ("mean", "std"):
+                loaders.append(lambda templateName=templateName, statistic=statistic:
+                               templates.getStatistical(templateName, statistic, resolution))
+    if lsdp or parameters["cropToWhiteMatter"]:
+        loaders.append(lambda: templates.getWhiteMatterBoundingBox(resolution))
+    for loader in loaders:
+        # A missing template only fails the jobs that use it
+        try:
+            loader()
+        except IOError as e:
+            logging.warning(str(e))
+    logging.info("%d templates preloaded (%.0f MB)" % (len(templates.nodes), templates.memorySize()))
+
+
+class SpoolWorker(object):
+    """Run the jobs submitted to a spool folder in the current Slicer process.
+
+  A job is claimed by renaming its file from the incoming to the running folder, which
+  only one worker can do, and its result is written in the done folder. Jobs are run
+  in submission order (the job ids start with the submission time).
+  """
+
+    def __init__(self, spoolFolder, pollingInterval=POLLING_INTERVAL):
+        self.spoolFolder = spoolFolder
+        self.pollingInterval = pollingInterval
+        (self.incomingFolder, self.runningFolder, self.doneFolder) = spoolFolders(spoolFolder)
+        self.logic = None
+
+    def claimJob(self):
+        """Move the oldest incoming job to the running folder and return its id, or None
+    if there is no job waiting.
+    """
+        for fileName in sorted(os.listdir(self.incomingFolder)):
+            if not fileName.endswith(".json"):
+                continue
+            try:
+                os.rename(os.path.join(self.incomingFolder, fileName), os.path.join(self.runningFolder, fileName))
+            except OSError:
+                # Claimed by another worker
+                continue
+            return fileName[:-len(".json")]
+        return None
+
+    def runJob(self, jobId):
+        """Run a claimed job and write its result in the done folder: the runSubject result
+    (status, outputLabel or error), the elapsed time and the stage report of the run.
+    """
+        import DTILesionTrack
+
+        if self.logic is None:
+            self.logic = DTILesionTrack.DTILesionTrackLogic()
+        jobPath = os.path.join(self.runningFolder, jobId + ".json")
+        startTime = time.time()
+        try:
+            with open(jobPath) as jobFile:
+                description = json.load(jobFile)
+            logging.info("Job " + jobId + " started for subject " + description["subject"]["id"])
+            result = runDescription(description, self.logic)
+            profile = readProfile(description["outputFolder"])
+            if profile is not None:
+                result["profile"] = profile
+        except Exception as e:
+            logging.exception("Job " + jobId + " could not be run")
+            result = {"status": "failed", "error": str(e)}
+        result["job"] = jobId
+        result["elapsedTime"] = time.time() - startTime
+        writeJSON(os.path.join(self.doneFolder, jobId + ".json"), result)
+        os.remove(jobPath)
+        logging.info("Job %s %s in %.1f s" % (jobId, result["status"], result["elapsedTime"]))
+        return result
+
+    def serve(self, maximumJobs=None):
+        """Run the incoming jobs until the stop file is created or maximumJobs were run.
+    Returns the number of jobs run.
+    """
+        stopPath = os.path.join(self.spoolFolder, STOP_FILE_NAME)
+        numberOfJobs = 0
+        logging.info("DTILesionTrack worker serving " + self.spoolFolder)
+        while not os.path.exists(stopPath) and (maximumJobs is None or numberOfJobs < maximumJobs):
+            jobId = self.claimJob()
+            if jobId is None:
+                slicer.app.processEvents()
+                time.sleep(self.pollingInterval)
+                continue
+            self.runJob(jobId)
+            numberOfJobs += 1
+        logging.info("DTILesionTrack worker stopped after %d jobs" % numberOfJobs)
+        return numberOfJobs
+
+
+def main(argv):
+    if len(argv) not in (1, 2):
+        sys.stderr.write("Usage: Slicer --no-main-window --python-script service.py <spoolFolder> [preload.json]\n")
+        return 2
+    preloadParameters = None
+    if len(argv) == 2:
+        with open(argv[1]) as preloadFile:
+            preloadParameters = json.load(preloadFile)
+    preloadTemplates(preloadParameters)
+    SpoolWorker(argv[0]).serve()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,124 @@
+#
+# DTILesionTrack sparse lesion labels
+#
+
+import numpy
+import vtk
+import slicer
+
+from DTILesionTrackLib.fusion import FUSION_RULES
+
+# Extension of the sparse label files written by writeSparseLabel
+SPARSE_LABEL_EXTENSION = ".npz"
+
+
+class SparseLabel(object):
+    """Lesion label stored as the list of its nonzero voxels plus the reference geometry.
+
+  indices are the flat (C order) indices of the nonzero voxels in the label array,
+  sorted, and values their label values. shape is the shape of the label array (KJI,
+  as returned by slicer.util.arrayFromVolume) and ijkToRAS the 16 elements, row by row,
+  of the IJK to RAS matrix of the label volume.
+  """
+
+    def __init__(self, shape, ijkToRAS, indices, values):
+        self.shape = tuple(int(size) for size in shape)
+        self.ijkToRAS = [float(element) for element in ijkToRAS]
+        self.indices = numpy.asarray(indices, numpy.int64)
+        self.values = numpy.asarray(values)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def sameGeometry(self, other):
+        """Return True if both labels share the same shape and IJK to RAS matrix."""
+        return self.shape == other.shape and all(abs(element1 - element2) < 1e-6 for element1, element2
+                                                 in zip(self.ijkToRAS, other.ijkToRAS))
+
+    def coordinates(self):
+        """Return the (K, J, I) array coordinates of the nonzero voxels, one row per voxel."""
+        return numpy.column_stack(numpy.unravel_index(self.indices, self.shape))
+
+    def toArray(self):
+        """Return the dense label array."""
+        labelArray = numpy.zeros(self.shape, self.values.dtype)
+        labelArray.flat[self.indices] = self.values
+        return labelArray
+
+    def toVolume(self, labelNode=None):
+        """Write the dense label in labelNode (a new label map node is added to the scene when
+    it is None) and return the node.
+    """
+        if labelNode is None:
+            labelNode = slicer.vtkMRMLLabelMapVolumeNode()
+            slicer.mrmlScene.AddNode(labelNode)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        ijkToRAS.DeepCopy(self.ijkToRAS)
+        labelNode.SetIJKToRASMatrix(ijkToRAS)
+        slicer.util.updateVolumeFromArray(labelNode, self.toArray())
+        return labelNode
+
+
+def sparseLabelFromArray(labelArray, ijkToRAS=None):
+    """Return the SparseLabel of a dense label array. ijkToRAS defaults to the identity."""
+    if ijkToRAS is None:
+        ijkToRAS = numpy.identity(4).flatten()
+    flatLabel = labelArray.ravel()
+    indices = numpy.flatnonzero(flatLabel)
+    return SparseLabel(labelArray.shape, ijkToRAS, indices, flatLabel[indices])
+
+
+def sparseLabelFromVolume(labelNode):
+    """Return the SparseLabel of a label volume node."""
+    ijkToRAS = vtk.vtkMatrix4x4()
+    labelNode.GetIJKToRASMatrix(ijkToRAS)
+    return sparseLabelFromArray(slicer.util.arrayFromVolume(labelNode),
+                                [ijkToRAS.GetElement(i, j) for i in range(4) for j in range(4)])
+
+
+def fuseSparseLabels(labels, rule="Sum"):
+    """Fuse sparse labels with the same geometry following one of the FUSION_RULES, with the
+  same result as fusion.fuseLabelArrays on the dense labels. Only the nonzero voxels are
+  visited. Returns a SparseLabel with the dtype of the first label.
+  """
+    if rule not in FUSION_RULES:
+        raise ValueError("Unknown label fusion rule: " + str(rule) + " (options: " + ", ".join(FUSION_RULES) + ")")
+    if not labels:
+        raise ValueError("No label to fuse")
+    for label in labels[1:]:
+        if not labels[0].sameGeometry(label):
+            raise ValueError("Sparse labels defined on different grids can not be fused")
+
+    outputType = labels[0].values.dtype
+    (indices, voxels) = numpy.unique(numpy.concatenate([label.indices for label in labels]), return_inverse=True)
+    if rule == "Sum":
+        values = numpy.bincount(voxels, numpy.concatenate([label.values for label in labels]).astype(numpy.float64),
+                                len(indices)).astype(numpy.int32)
+    else:
+        votes = numpy.bincount(voxels, numpy.concatenate([label.values > 0 for label in labels]), len(indices))
+        if rule == "Union":
+            values = (votes > 0).astype(numpy.int32)
+        else:
+            values = (2 * votes > len(labels)).astype(numpy.int32)
+    # Voxels whose values cancel out (Sum) or that are not voted (Majority) are not kept
+    kept = values != 0
+    return SparseLabel(labels[0].shape, labels[0].ijkToRAS, indices[kept], values[kept].astype(outputType))
+
+
+def writeSparseLabel(label, filePath, useCompression=True):
+    """Write a SparseLabel in a numpy archive, compressed unless useCompression is False.
+  The voxel indices are stored as the differences between consecutive indices, which
+  compress much better.
+  """
+    indexSteps = numpy.diff(numpy.concatenate([[0], label.indices]))
+    save = numpy.savez_compressed if useCompression else numpy.savez
+    with open(filePath, "wb") as labelFile:
+        save(labelFile, shape=numpy.array(label.shape, numpy.int64), ijkToRAS=numpy.array(label.ijkToRAS, numpy.float64),
+             indexSteps=indexSteps.astype(numpy.int64), values=label.values)
+
+
+def readSparseLabel(filePath):
+    """Read a SparseLabel written by writeSparseLabel."""
+    with numpy.load(filePath) as archive:
+        return SparseLabel(archive["shape"], archive["ijkToRAS"], numpy.cumsum(archive["indexSteps"]),
+                           archive["values"])
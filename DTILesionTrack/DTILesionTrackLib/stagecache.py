@@ -0,0 +1,139 @@
+#
+# DTILesionTrack stage result cache
+#
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+import vtk
+import slicer
+
+STAGE_CACHE_FOLDER_NAME = "StageCache"
+ENTRY_MANIFEST_NAME = "entry.json"
+
+
+def volumeDigest(volumeNode):
+    """Return the SHA-1 digest of the voxel data and geometry of a volume node."""
+    digest = hashlib.sha1()
+    array = numpy.ascontiguousarray(slicer.util.arrayFromVolume(volumeNode))
+    digest.update((str(array.dtype) + str(array.shape)).encode("utf-8"))
+    digest.update(array.tobytes())
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    digest.update(repr([ijkToRAS.GetElement(i, j) for i in range(4) for j in range(4)]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class StageCache(object):
+    """Content-addressed store of pipeline stage results.
+
+  Each entry is keyed by the stage name, the digest of the stage input volumes
+  and the stage parameters, so a stage is only computed again when its inputs or
+  parameters change. Entries are folders holding the result files; they are
+  written in a temporary folder and renamed, so concurrent workers sharing the
+  cache never see partial entries.
+  """
+
+    def __init__(self, cacheFolder):
+        self.cacheFolder = cacheFolder
+        if not os.path.isdir(cacheFolder):
+            os.makedirs(cacheFolder)
+
+    def key(self, stageName, inputNodes, parameters=None):
+        """Return the cache key of a stage run on inputNodes with the given parameters."""
+        digest = hashlib.sha1(stageName.encode("utf-8"))
+        for node in inputNodes:
+            digest.update(volumeDigest(node).encode("utf-8"))
+        digest.update(json.dumps(parameters or {}, sort_keys=True).encode("utf-8"))
+        return stageName + "-" + digest.hexdigest()
+
+    def entryFolder(self, key):
+        return os.path.join(self.cacheFolder, key)
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self.entryFolder(key), ENTRY_MANIFEST_NAME))
+
+    def storeFiles(self, key, filePaths):
+        """Copy the result files of a stage into the cache."""
+        if self.contains(key):
+            return
+        temporaryFolder = tempfile.mkdtemp(prefix=key + ".", dir=self.cacheFolder)
+        for filePath in filePaths:
+            shutil.copy2(filePath, temporaryFolder)
+        self._commit(key, temporaryFolder, [os.path.basename(filePath) for filePath in filePaths])
+
+    def restoreFiles(self, key, destinationFolder):
+        """Copy the cached result files of a stage into destinationFolder.
+    Returns False if the stage is not in the cache.
+    """
+        if not self.contains(key):
+            return False
+        for fileName in self._manifest(key)["files"]:
+            shutil.copy2(os.path.join(self.entryFolder(key), fileName), destinationFolder)
+        logging.info("Stage cache hit: " + key)
+        return True
+
+    def storeNodes(self, key, nodes):
+        """Save the result nodes of a stage (dictionary name -> volume or transform node) in the cache."""
+        if self.contains(key):
+            return
+        temporaryFolder = tempfile.mkdtemp(prefix=key + ".", dir=self.cacheFolder)
+        fileNames = []
+        for name, node in nodes.items():
+            fileName = name + (".h5" if node.IsA("vtkMRMLTransformNode") else ".nrrd")
+            if not slicer.util.saveNode(node, os.path.join(temporaryFolder, fileName)):
+                shutil.rmtree(temporaryFolder, True)
+                return
+            fileNames.append(fileName)
+        self._commit(key, temporaryFolder, fileNames)
+
+    def loadNodes(self, key):
+        """Load the cached result nodes of a stage in the scene.
+    Returns a dictionary name -> node, or None if the stage is not in the cache.
+    """
+        if not self.contains(key):
+            return None
+        nodes = {}
+        for fileName in self._manifest(key)["files"]:
+            filePath = os.path.join(self.entryFolder(key), fileName)
+            if fileName.endswith(".h5"):
+                (read, node) = slicer.util.loadTransform(filePath, True)
+            else:
+                (read, node) = slicer.util.loadVolume(filePath, {}, True)
+            if not read:
+                return None
+            nodes[os.path.splitext(fileName)[0]] = node
+        logging.info("Stage cache hit: " + key)
+        return nodes
+
+    def restoreVolumes(self, key, volumeNodes):
+        """Replace the voxels of the informed volumes (dictionary name -> volume node) by
+    the cached ones, keeping the nodes. Returns False if the stage is not in the cache.
+    """
+        cachedNodes = self.loadNodes(key)
+        if cachedNodes is None:
+            return False
+        for name, volumeNode in volumeNodes.items():
+            slicer.util.updateVolumeFromArray(volumeNode, slicer.util.arrayFromVolume(cachedNodes[name]))
+        for node in cachedNodes.values():
+            slicer.mrmlScene.RemoveNode(node)
+        return True
+
+    def _manifest(self, key):
+        with open(os.path.join(self.entryFolder(key), ENTRY_MANIFEST_NAME)) as manifest:
+            return json.load(manifest)
+
+    def _commit(self, key, temporaryFolder, fileNames):
+        with open(os.path.join(temporaryFolder, ENTRY_MANIFEST_NAME), "w") as manifest:
+            json.dump({"key": key, "files": fileNames, "created": time.time()}, manifest, indent=2)
+        try:
+            os.rename(temporaryFolder, self.entryFolder(key))
+        except OSError:
+            # Another worker stored the same entry meanwhile
+            shutil.rmtree(temporaryFolder, True)
@@ -0,0 +1,267 @@
+#
+# DTILesionTrack brain templates
+#
+
+import collections
+import logging
+import os
+import re
+
+import numpy
+import slicer
+
+from DTILesionTrackLib.stagecache import volumeDigest
+
+# Folder, inside the user home, where the extension data is installed
+DATA_FOLDER_NAME = "MSLesionTrack-Data"
+
+# Folder, inside the data folder, of the histogram matching quantiles of the templates
+# (see referenceQuantilesFilePath)
+REFERENCE_QUANTILES_FOLDER_NAME = "Reference-Quantiles"
+
+# Folder, inside the data folder, of the compact copies of the MS lesion priors
+# (see compactPriorsFilePath)
+COMPACT_PRIORS_FOLDER_NAME = "Compact-Priors"
+
+# Template map types available in the DTI-Templates folder ("T1" refers to the MNI152 structural template)
+TEMPLATE_MAP_TYPES = ["FA", "MD", "RA", "PerpDiff", "VR", "T1"]
+
+
+def dataFolder():
+    """Return the MSLesionTrack-Data folder installed in the user home."""
+    return os.path.join(os.path.expanduser("~"), DATA_FOLDER_NAME)
+
+
+def templateFilePath(mapType, templateSet, resolution):
+    """Return the file of a brain template.
+
+  mapType is one of TEMPLATE_MAP_TYPES, templateSet is USP-20, USP-131 or JHU-81
+  (ignored for the T1 template, which is always MNI152) and resolution is 1mm or 2mm.
+  """
+    if mapType == "T1":
+        return os.path.join(dataFolder(), "Structural-Templates", "MNI152_T1_" + resolution + "_brain.nii.gz")
+    if templateSet == "JHU-81":
+        if mapType != "FA":
+            raise ValueError("The JHU-81 template set only provides the FA map.")
+        return os.path.join(dataFolder(), "DTI-Templates", "JHU-ICBM-FA-" + resolution + ".nii.gz")
+    if templateSet not in ("USP-20", "USP-131"):
+        raise ValueError("Unknown DTI template set: " + str(templateSet))
+    return os.path.join(dataFolder(), "DTI-Templates",
+                        "USP-ICBM-" + mapType + "-" + templateSet.split("-")[1] + "-" + resolution + ".nii.gz")
+
+
+def statisticalTemplateFilePath(mapType, statistic, resolution):
+    """Return the USP-ICBM-131 statistical template (statistic is mean or std) of a
+  DTI map type (FA, MD, RA, PerpDiff or VR) used by the LSDP segmentation.
+  """
+    if statistic not in ("mean", "std"):
+        raise ValueError("Unknown statistical template: " + str(statistic))
+    return os.path.join(dataFolder(), "StatisticalBrainSegmentation-Templates",
+                        "USP-ICBM-" + mapType + statistic + "-131-" + resolution + ".nii.gz")
+
+
+def whiteMatterMaskFilePath(resolution):
+    """Return the MNI152 white matter mask."""
+    return os.path.join(dataFolder(), "Structural-Templates", "MNI152_T1_" + resolution + "_brain_wm.nii.gz")
+
+
+def referenceQuantilesFilePath(templateNode, cropToWhiteMatter=False):
+    """Return the file where the Clustering and Bayesian CLIs keep the histogram matching
+  quantiles of a template (their referenceQuantiles parameter), or "" when the template
+  was not read by the session template cache. The CLIs only check the quantiles against
+  the number of template voxels, so the file is named after the template file (see
+  templateFilePath) and the digest of the template voxels: quantiles of another template
+  set with the same grid, or of an earlier version of the template file, are never read,
+  and the ones of earlier versions are removed. The quantiles of the white matter
+  bounding box, used when the CLIs crop the volumes, are kept in another file.
+  """
+    cache = templateCache()
+    templatePath = cache.filePath(templateNode)
+    if not templatePath:
+        return ""
+    quantilesFolder = os.path.join(dataFolder(), REFERENCE_QUANTILES_FOLDER_NAME)
+    try:
+        if not os.path.isdir(quantilesFolder):
+            os.makedirs(quantilesFolder)
+    except OSError:
+        logging.warning("Could not create the reference quantiles folder " + quantilesFolder)
+        return ""
+    templateName = os.path.basename(templatePath).split(".")[0] + ("-wm" if cropToWhiteMatter else "")
+    quantilesName = templateName + "-" + cache.digest(templateNode)[:16] + "-quantiles.txt"
+    stalePattern = re.compile(re.escape(templateName) + "-[0-9a-f]{16}-quantiles\\.txt$")
+    for fileName in os.listdir(quantilesFolder):
+        if fileName != quantilesName and stalePattern.match(fileName):
+            try:
+                os.remove(os.path.join(quantilesFolder, fileName))
+            except OSError:
+                pass
+    return os.path.join(quantilesFolder, quantilesName)
+
+
+def lesionPriorsFilePath(resolution):
+    """Return the USP-ICBM-46 MS lesion priors used by the Bayesian segmentation."""
+    return os.path.join(dataFolder(), "StatisticalBrainSegmentation-Templates",
+                        "USP-ICBM-MSLesionPriors-46-" + resolution + ".nii.gz")
+
+
+def compactPriorsFilePath(resolution):
+    """Return the file where the Bayesian CLI keeps the compact copy of the MS lesion
+  priors (its compactPriors parameter), or "" when it can not be kept. A copy older
+  than the priors file is removed, so it is written again.
+  """
+    priorsFolder = os.path.join(dataFolder(), COMPACT_PRIORS_FOLDER_NAME)
+    try:
+        if not os.path.isdir(priorsFolder):
+            os.makedirs(priorsFolder)
+    except OSError:
+        logging.warning("Could not create the compact priors folder " + priorsFolder)
+        return ""
+    priorsPath = lesionPriorsFilePath(resolution)
+    compactPath = os.path.join(priorsFolder, "USP-ICBM-MSLesionPriors-46-" + resolution + ".priors")
+    if (os.path.exists(compactPath) and os.path.exists(priorsPath) and
+            os.path.getmtime(compactPath) < os.path.getmtime(priorsPath)):
+        os.remove(compactPath)
+    return compactPath
+
+
+def maskBoundingBox(maskArray, margin=2):
+    """Return the bounding box of the nonzero voxels of a mask array, grown by margin
+  voxels, as a tuple of slices of the array (KJI order). The whole array is returned
+  when the mask is empty.
+  """
+    region = []
+    for axis in range(maskArray.ndim):
+        otherAxes = tuple(other for other in range(maskArray.ndim) if other != axis)
+        indices = numpy.nonzero(numpy.any(maskArray != 0, axis=otherAxes))[0]
+        if len(indices) == 0:
+            return tuple(slice(0, size) for size in maskArray.shape)
+        region.append(slice(max(int(indices[0]) - margin, 0), min(int(indices[-1]) + margin + 1, maskArray.shape[axis])))
+    return tuple(region)
+
+
+class TemplateCache(object):
+    """Keep the brain templates loaded in the scene across consecutive runs.
+
+  Templates are keyed by (map type, template set, resolution). When the memory
+  used by the cached volumes goes above maximumMemorySize (MB), the least
+  recently used templates are removed from the scene. Templates requested
+  since the last beginRun() call are never evicted, since the current run may
+  still be using them.
+  """
+
+    def __init__(self, maximumMemorySize=1024):
+        self.maximumMemorySize = maximumMemorySize
+        self.nodes = collections.OrderedDict()
+        self.inUse = set()
+        self.boundingBoxes = {}
+        # Template file and voxel digest of the cached templates, by key
+        self.filePaths = {}
+        self.digests = {}
+
+    def beginRun(self):
+        """Inform that a new pipeline run started."""
+        self.inUse = set()
+
+    def setMaximumMemorySize(self, maximumMemorySize):
+        """Set the memory cap (MB), evicting the templates above it."""
+        self.maximumMemorySize = maximumMemorySize
+        self.evict()
+
+    def get(self, mapType, templateSet, resolution):
+        """Return the template volume node, loading it only if it is not cached yet."""
+        if mapType == "T1":
+            templateSet = "MNI152"
+        return self._get((mapType, templateSet, resolution), templateFilePath(mapType, templateSet, resolution))
+
+    def getStatistical(self, mapType, statistic, resolution):
+        """Return the LSDP statistical template (see statisticalTemplateFilePath)."""
+        return self._get((mapType, statistic, resolution), statisticalTemplateFilePath(mapType, statistic, resolution))
+
+    def getWhiteMatterMask(self, resolution):
+        """Return the MNI152 white matter mask."""
+        return self._get(("WM", "MNI152", resolution), whiteMatterMaskFilePath(resolution))
+
+    def getWhiteMatterBoundingBox(self, resolution):
+        """Return the bounding box of the MNI152 white matter mask (see maskBoundingBox).
+    It is computed once per resolution and kept even if the mask is evicted.
+    """
+        if resolution not in self.boundingBoxes:
+            self.boundingBoxes[resolution] = maskBoundingBox(slicer.util.arrayFromVolume(self.getWhiteMatterMask(resolution)))
+        return self.boundingBoxes[resolution]
+
+    def _get(self, key, filePath):
+        node = self.nodes.pop(key, None)
+        if node is not None and not slicer.mrmlScene.IsNodePresent(node):
+            # The scene was cleared after the template was loaded
+            node = None
+        if node is None:
+            (read, node) = slicer.util.loadVolume(filePath, {}, True)
+            if not read:
+                raise IOError("Could not read the brain template " + filePath)
+            logging.info("Template %s %s %s loaded" % key)
+            self.digests.pop(key, None)
+        self.nodes[key] = node
+        self.filePaths[key] = filePath
+        self.inUse.add(key)
+        self.evict()
+        return node
+
+    def filePath(self, node):
+        """Return the file a cached template was read from, or None if the node is not cached."""
+        key = self._key(node)
+        return self.filePaths[key] if key is not None else None
+
+    def digest(self, node):
+        """Return the voxel digest of a cached template (see stagecache.volumeDigest),
+    computed once per loaded template.
+    """
+        key = self._key(node)
+        if key is None:
+            return volumeDigest(node)
+        if key not in self.digests:
+            self.digests[key] = volumeDigest(node)
+        return self.digests[key]
+
+    def _key(self, node):
+        for key, cachedNode in self.nodes.items():
+            if cachedNode is node:
+                return key
+        return None
+
+    def memorySize(self):
+        """Memory used by the cached templates, in MB."""
+        size = 0
+        for node in self.nodes.values():
+            if node.GetImageData() is not None:
+                size += node.GetImageData().GetActualMemorySize()
+        return size / 1024.0
+
+    def evict(self):
+        """Remove least recently used templates until the memory cap is respected."""
+        for key in list(self.nodes.keys()):
+            if self.memorySize() <= self.maximumMemorySize:
+                break
+            if key in self.inUse:
+                continue
+            node = self.nodes.pop(key)
+            self.digests.pop(key, None)
+            if slicer.mrmlScene.IsNodePresent(node):
+                slicer.mrmlScene.RemoveNode(node)
+            logging.info("Template %s %s %s evicted from the cache" % key)
+
+    def clear(self):
+        """Remove all cached templates from the scene."""
+        for node in self.nodes.values():
+            if slicer.mrmlScene.IsNodePresent(node):
+                slicer.mrmlScene.RemoveNode(node)
+        self.nodes.clear()
+        self.digests.clear()
+        self.inUse = set()
+
+
+_templateCache = TemplateCache()
+
+
+def templateCache():
+    """Return the template cache shared by all DTILesionTrackLogic instances of the session."""
+    return _templateCache
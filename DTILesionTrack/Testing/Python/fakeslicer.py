@@ -0,0 +1,20 @@
+#
+# DTILesionTrack test support
+#
+# The DTILesionTrackLib modules import vtk and slicer at the top, but their array and file
+# logic does not use them. Importing this module puts DTILesionTrackLib on the path and, when
+# the tests do not run in the Slicer Python, adds empty vtk and slicer modules so the
+# DTILesionTrackLib modules can be imported.
+#
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+for moduleName in ("vtk", "slicer"):
+    try:
+        __import__(moduleName)
+    except ImportError:
+        sys.modules[moduleName] = types.ModuleType(moduleName)
@@ -0,0 +1,104 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import fakeslicer  # noqa: F401
+from DTILesionTrackLib.checkpoint import CHECKPOINT_FILE_NAME, PipelineCheckpoint, decompressFile
+
+
+class CheckpointTest(unittest.TestCase):
+    """Stage manifest of a work folder and its invalidation when resuming."""
+
+    def setUp(self):
+        self.workFolder = tempfile.mkdtemp()
+        self.parameters = {"segmentationApproach": "Bayesian", "templateDTIResolution": "2mm", "filterQ": 1.2}
+
+    def tearDown(self):
+        shutil.rmtree(self.workFolder)
+
+    def runStages(self, stageNames, parameters=None):
+        """Run stages writing one output file each, as a first (not resumed) run."""
+        checkpoint = PipelineCheckpoint(self.workFolder, {}, parameters or self.parameters)
+        for stageName in stageNames:
+            self.assertFalse(checkpoint.isCompleted(stageName))
+            with open(os.path.join(self.workFolder, stageName + ".txt"), "w") as output:
+                output.write(stageName)
+            checkpoint.complete(stageName, files=[stageName + ".txt"])
+        return checkpoint
+
+    def manifestStages(self):
+        with open(os.path.join(self.workFolder, CHECKPOINT_FILE_NAME)) as manifest:
+            return [stage["name"] for stage in json.load(manifest)["stages"]]
+
+    def test_resume_restores_the_completed_stages(self):
+        self.runStages(["preprocessing", "linearRegistration", "DTISyN"])
+        checkpoint = PipelineCheckpoint(self.workFolder, {}, dict(self.parameters), resume=True)
+        self.assertTrue(checkpoint.hasCompleted("DTISyN"))
+        for stageName in ["preprocessing", "linearRegistration", "DTISyN"]:
+            self.assertTrue(checkpoint.isCompleted(stageName))
+        self.assertFalse(checkpoint.isCompleted("segmentation"))
+
+    def test_without_resume_everything_runs_again(self):
+        self.runStages(["preprocessing"])
+        checkpoint = PipelineCheckpoint(self.workFolder, {}, self.parameters)
+        self.assertFalse(checkpoint.hasCompleted("preprocessing"))
+        self.assertFalse(checkpoint.isCompleted("preprocessing"))
+        self.assertEqual(self.manifestStages(), [])
+
+    def test_parameter_change_invalidates_the_checkpoint(self):
+        self.runStages(["preprocessing", "linearRegistration"])
+        changed = dict(self.parameters, templateDTIResolution="1mm")
+        checkpoint = PipelineCheckpoint(self.workFolder, {}, changed, resume=True)
+        self.assertFalse(checkpoint.hasCompleted("preprocessing"))
+        self.assertFalse(checkpoint.isCompleted("preprocessing"))
+        self.assertEqual(self.manifestStages(), [])
+
+    def test_missing_output_discards_the_following_stages(self):
+        self.runStages(["preprocessing", "linearRegistration", "DTISyN"])
+        os.remove(os.path.join(self.workFolder, "linearRegistration.txt"))
+        checkpoint = PipelineCheckpoint(self.workFolder, {}, self.parameters, resume=True)
+        self.assertTrue(checkpoint.isCompleted("preprocessing"))
+        self.assertFalse(checkpoint.isCompleted("linearRegistration"))
+        # DTISyN ran after a stage that is computed again, so it is not restored either
+        self.assertFalse(checkpoint.isCompleted("DTISyN"))
+        self.assertEqual(self.manifestStages(), ["preprocessing"])
+
+    def test_unrecorded_stage_ends_the_resume(self):
+        self.runStages(["preprocessing", "linearRegistration"])
+        checkpoint = PipelineCheckpoint(self.workFolder, {}, self.parameters, resume=True)
+        self.assertTrue(checkpoint.isCompleted("preprocessing"))
+        self.assertFalse(checkpoint.isCompleted("templates"))
+        # The stages after one that runs again are computed again too
+        self.assertFalse(checkpoint.isCompleted("linearRegistration"))
+
+    def test_resume_after_a_failed_structural_segmentation(self):
+        # The structural segmentation reads an uncompressed copy of an output of the structural
+        # SyN; when it fails the resumed run must restore the SyN and only run the segmentation
+        checkpoint = PipelineCheckpoint(self.workFolder, {}, self.parameters)
+        inverseWarped = os.path.join(self.workFolder, "regStructInverseWarped.nii.gz")
+        compressed = gzip.open(inverseWarped, "wb")
+        compressed.write(b"inverse warped T1")
+        compressed.close()
+        checkpoint.complete("structuralSyN", files=["regStructInverseWarped.nii.gz"])
+        self.assertEqual(decompressFile(inverseWarped), inverseWarped[:-len(".gz")])
+        with open(inverseWarped[:-len(".gz")], "rb") as uncompressed:
+            self.assertEqual(uncompressed.read(), b"inverse warped T1")
+
+        checkpoint = PipelineCheckpoint(self.workFolder, {}, self.parameters, resume=True)
+        self.assertTrue(checkpoint.hasCompleted("structuralSyN"))
+        self.assertTrue(checkpoint.isCompleted("structuralSyN"))
+        self.assertFalse(checkpoint.isCompleted("structuralSegmentation"))
+        self.assertEqual(self.manifestStages(), ["structuralSyN"])
+
+    def test_unreadable_manifest(self):
+        with open(os.path.join(self.workFolder, CHECKPOINT_FILE_NAME), "w") as manifest:
+            manifest.write("{truncated")
+        checkpoint = PipelineCheckpoint(self.workFolder, {}, self.parameters, resume=True)
+        self.assertFalse(checkpoint.isCompleted("preprocessing"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+import numpy
+
+import fakeslicer  # noqa: F401
+from DTILesionTrackLib.fusion import fuseLabelArrays, fusedLesionLabel
+
+
+class FusionTest(unittest.TestCase):
+    """Voxelwise fusion of the lesion labels of the DTI maps."""
+
+    def setUp(self):
+        # Voxel i is flagged by the maps whose label has a 1 at position i
+        self.labels = [numpy.array([0, 1, 1, 1, 0], numpy.uint8),
+                       numpy.array([0, 0, 1, 1, 0], numpy.uint8),
+                       numpy.array([0, 0, 0, 1, 1], numpy.uint8),
+                       numpy.array([0, 0, 0, 1, 0], numpy.uint8)]
+
+    def test_sum(self):
+        fused = fuseLabelArrays(self.labels, "Sum")
+        self.assertEqual(fused.tolist(), [0, 1, 2, 4, 1])
+        self.assertEqual(fused.dtype, numpy.uint8)
+        self.assertEqual(fusedLesionLabel("Sum", len(self.labels)), 4)
+
+    def test_sum_of_fused_labels(self):
+        # A label that was already fused (values above 1) adds its value
+        fused = fuseLabelArrays([numpy.array([0, 2, 3], numpy.int16), numpy.array([1, 1, 1], numpy.int16)], "Sum")
+        self.assertEqual(fused.tolist(), [1, 3, 4])
+
+    def test_union(self):
+        self.assertEqual(fuseLabelArrays(self.labels, "Union").tolist(), [0, 1, 1, 1, 1])
+        self.assertEqual(fusedLesionLabel("Union", len(self.labels)), 1)
+
+    def test_majority(self):
+        # Two votes out of four are not a majority
+        self.assertEqual(fuseLabelArrays(self.labels, "Majority").tolist(), [0, 0, 0, 1, 0])
+        self.assertEqual(fuseLabelArrays(self.labels[:3], "Majority").tolist(), [0, 0, 1, 1, 0])
+
+    def test_votes_ignore_label_values(self):
+        labels = [numpy.array([0, 5], numpy.uint8), numpy.array([0, 1], numpy.uint8), numpy.array([3, 0], numpy.uint8)]
+        self.assertEqual(fuseLabelArrays(labels, "Majority").tolist(), [0, 1])
+        self.assertEqual(fuseLabelArrays(labels, "Union").tolist(), [1, 1])
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, fuseLabelArrays, self.labels, "Intersection")
+        self.assertRaises(ValueError, fuseLabelArrays, [], "Sum")
+
+
+if __name__ == "__main__":
+    unittest.main()
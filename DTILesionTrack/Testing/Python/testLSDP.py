@@ -0,0 +1,96 @@
+import math
+import unittest
+
+import numpy
+
+import fakeslicer  # noqa: F401
+from DTILesionTrackLib.lsdp import (HIGH_TAIL_MAP_TYPES, LOW_TAIL_MAP_TYPES, directionalTScore, jointLSDPLabels,
+                                    lsdpLabels, tScoreLabel)
+
+
+def scalarLabel(mapArray, meanArray, stdArray, tThreshold, mapType, wmMaskArray=None):
+    """Voxel by voxel LSDP decision of the original LSDPBrainSegmentation CLI (LocalDecision)."""
+    label = numpy.zeros(mapArray.shape, numpy.uint8)
+    for index in numpy.ndindex(mapArray.shape):
+        if meanArray[index] == 0:
+            continue
+        tScore = (numpy.float32(mapArray[index]) - numpy.float32(meanArray[index])) / numpy.float32(stdArray[index])
+        if mapType in LOW_TAIL_MAP_TYPES:
+            lesion = tScore <= -tThreshold
+        else:
+            lesion = tScore >= tThreshold
+        if lesion and (wmMaskArray is None or wmMaskArray[index] != 0):
+            label[index] = 1
+    return label
+
+
+class LSDPTest(unittest.TestCase):
+    """Vectorized LSDP T-Score segmentation against the voxelwise formula."""
+
+    def setUp(self):
+        randomState = numpy.random.RandomState(5)
+        shape = (5, 6, 7)
+        self.meanArray = randomState.uniform(0.2, 1.0, shape).astype(numpy.float32)
+        self.meanArray[0, :, :] = 0
+        self.stdArray = randomState.uniform(0.05, 0.2, shape).astype(numpy.float32)
+        self.mapArray = (self.meanArray + randomState.normal(0.0, 0.3, shape)).astype(numpy.float32)
+        self.wmMaskArray = (randomState.random_sample(shape) < 0.7).astype(numpy.uint8)
+        self.tThreshold = 1.5
+
+    def test_labels_match_the_voxelwise_formula(self):
+        for mapType in LOW_TAIL_MAP_TYPES + HIGH_TAIL_MAP_TYPES:
+            for wmMaskArray in (None, self.wmMaskArray):
+                expected = scalarLabel(self.mapArray, self.meanArray, self.stdArray, self.tThreshold, mapType, wmMaskArray)
+                label = tScoreLabel(self.mapArray, self.meanArray, self.stdArray, self.tThreshold, mapType, wmMaskArray)
+                numpy.testing.assert_array_equal(label, expected, mapType)
+                self.assertEqual(label.dtype, numpy.uint8)
+                self.assertTrue(expected.any() and not expected.all())
+
+    def test_labels_of_several_maps(self):
+        mapArrays = {"FractionalAnisotropy": self.mapArray, "MeanDiffusivity": self.mapArray[::-1].copy()}
+        statisticalArrays = dict((mapType, (self.meanArray, self.stdArray)) for mapType in mapArrays)
+        labels = lsdpLabels(mapArrays, statisticalArrays, self.tThreshold, self.wmMaskArray)
+        for mapType, mapArray in mapArrays.items():
+            numpy.testing.assert_array_equal(labels[mapType], scalarLabel(mapArray, self.meanArray, self.stdArray,
+                                                                          self.tThreshold, mapType, self.wmMaskArray))
+
+    def test_directional_t_score(self):
+        tScore = directionalTScore(self.mapArray, self.meanArray, self.stdArray, "FractionalAnisotropy")
+        self.assertTrue(numpy.isnan(tScore[0]).all())
+        index = (2, 3, 4)
+        expected = -(self.mapArray[index] - self.meanArray[index]) / self.stdArray[index]
+        self.assertAlmostEqual(float(tScore[index]), float(expected), places=5)
+        self.assertRaises(ValueError, directionalTScore, self.mapArray, self.meanArray, self.stdArray, "T1")
+        self.assertRaises(ValueError, directionalTScore, self.mapArray[1:], self.meanArray, self.stdArray,
+                          "FractionalAnisotropy")
+
+    def test_joint_labels_match_the_stouffer_rule(self):
+        mapTypes = ["FractionalAnisotropy", "MeanDiffusivity", "VolumeRatio"]
+        mapArrays = dict((mapType, numpy.roll(self.mapArray, shift, axis=2)) for shift, mapType in enumerate(mapTypes))
+        meanArrays = dict((mapType, self.meanArray.copy()) for mapType in mapTypes)
+        # A map without statistics in some voxels leaves them to the other maps
+        meanArrays["VolumeRatio"][:, 0, :] = 0
+        statisticalArrays = dict((mapType, (meanArrays[mapType], self.stdArray)) for mapType in mapTypes)
+
+        expected = numpy.zeros(self.mapArray.shape, numpy.uint8)
+        for index in numpy.ndindex(self.mapArray.shape):
+            scores = []
+            for mapType in mapTypes:
+                if meanArrays[mapType][index] == 0:
+                    continue
+                tScore = (mapArrays[mapType][index] - meanArrays[mapType][index]) / self.stdArray[index]
+                scores.append(-tScore if mapType in LOW_TAIL_MAP_TYPES else tScore)
+            if scores and sum(scores) / math.sqrt(len(scores)) >= self.tThreshold and self.wmMaskArray[index]:
+                expected[index] = 1
+
+        for slabSize in (1, 2, 16):
+            (jointLabel, labels) = jointLSDPLabels(mapArrays, statisticalArrays, self.tThreshold, self.wmMaskArray,
+                                                   slabSize)
+            numpy.testing.assert_array_equal(jointLabel, expected)
+            for mapType in mapTypes:
+                numpy.testing.assert_array_equal(labels[mapType], scalarLabel(
+                    mapArrays[mapType], meanArrays[mapType], self.stdArray, self.tThreshold, mapType, self.wmMaskArray))
+
+
+if __name__ == "__main__":
+    unittest.main()
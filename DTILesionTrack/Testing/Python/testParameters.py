@@ -0,0 +1,59 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import fakeslicer  # noqa: F401
+from DTILesionTrackLib.parameters import DEFAULT_PARAMETERS, completeParameters, readParameterFile
+
+
+class ParametersTest(unittest.TestCase):
+    """Validation of the processing parameters and of the headless parameter files."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_defaults(self):
+        self.assertEqual(completeParameters(), DEFAULT_PARAMETERS)
+        parameters = completeParameters({"segmentationApproach": "LSDP"})
+        self.assertEqual(parameters["segmentationApproach"], "LSDP")
+        self.assertEqual(parameters["templateDTIResolution"], DEFAULT_PARAMETERS["templateDTIResolution"])
+
+    def test_numbers_are_converted(self):
+        parameters = completeParameters({"lsdpTScoreThreshold": "3", "clusterNumberOfClasses": 3.0})
+        self.assertEqual(parameters["lsdpTScoreThreshold"], 3.0)
+        self.assertIsInstance(parameters["lsdpTScoreThreshold"], float)
+        self.assertIsInstance(parameters["clusterNumberOfClasses"], int)
+        self.assertEqual(completeParameters({"templateCacheSize": "2048"})["templateCacheSize"], 2048)
+
+    def test_invalid_parameters(self):
+        self.assertRaises(ValueError, completeParameters, {"templateResolution": "1mm"})
+        self.assertRaises(ValueError, completeParameters, {"templateDTIResolution": "3mm"})
+        self.assertRaises(ValueError, completeParameters, {"applyBET": "yes"})
+
+    def test_parameter_file(self):
+        parameterFile = os.path.join(self.folder, "patient01.json")
+        with open(parameterFile, "w") as description:
+            json.dump({"subject": {"id": "patient01", "FLAIR": "flair.nii.gz", "T1": "t1.nii.gz", "FA": "fa.nii.gz",
+                                   "MD": ""},
+                       "outputFolder": "output",
+                       "parameters": {"segmentationApproach": "JointLSDP"}}, description)
+        description = readParameterFile(parameterFile)
+        self.assertEqual(description["subject"]["FLAIR"], os.path.join(self.folder, "flair.nii.gz"))
+        self.assertNotIn("MD", description["subject"])
+        self.assertEqual(description["outputFolder"], os.path.join(self.folder, "output"))
+        self.assertEqual(description["parameters"]["segmentationApproach"], "JointLSDP")
+
+    def test_parameter_file_without_subject(self):
+        parameterFile = os.path.join(self.folder, "empty.json")
+        with open(parameterFile, "w") as description:
+            json.dump({"outputFolder": "output"}, description)
+        self.assertRaises(ValueError, readParameterFile, parameterFile)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import unittest
+
+import fakeslicer  # noqa: F401
+from DTILesionTrackLib import scheduler
+from DTILesionTrackLib.scheduler import StageScheduler
+
+
+class FakeCLINode(object):
+    """CLI module node that stays running for a number of event loop iterations."""
+
+    BusyMask = 0x1
+
+    def __init__(self, title, iterations, status="Completed"):
+        self.title = title
+        self.iterations = iterations
+        self.finalStatus = status
+
+    def GetStatus(self):
+        return self.BusyMask if self.iterations > 0 else 0
+
+    def GetStatusString(self):
+        return "Running" if self.iterations > 0 else self.finalStatus
+
+    def GetModuleTitle(self):
+        return self.title
+
+
+class FakeSlicer(object):
+    """Stand-in for the slicer module: the event loop advances the fake CLI nodes."""
+
+    def __init__(self):
+        self.nodes = []
+        self.cancelled = []
+        fake = self
+
+        class App(object):
+            def processEvents(self):
+                for node in fake.nodes:
+                    node.iterations = max(0, node.iterations - 1)
+
+        class CLI(object):
+            def cancel(self, node):
+                fake.cancelled.append(node.title)
+                node.iterations = 0
+                node.finalStatus = "Cancelled"
+
+        self.app = App()
+        self.cli = CLI()
+
+    def start(self, title, iterations, status="Completed"):
+        node = FakeCLINode(title, iterations, status)
+        self.nodes.append(node)
+        return node
+
+
+class SchedulerTest(unittest.TestCase):
+    """Stage ordering, concurrency and failure propagation of the StageScheduler."""
+
+    def setUp(self):
+        self.slicer = FakeSlicer()
+        self.events = []
+        (self.moduleSlicer, self.pollingInterval) = (scheduler.slicer, scheduler.POLLING_INTERVAL)
+        scheduler.slicer = self.slicer
+        scheduler.POLLING_INTERVAL = 0
+
+    def tearDown(self):
+        (scheduler.slicer, scheduler.POLLING_INTERVAL) = (self.moduleSlicer, self.pollingInterval)
+
+    def stage(self, name):
+        return lambda: self.events.append(name)
+
+    def cliStage(self, name, iterations, status="Completed"):
+        def run():
+            self.events.append("start " + name)
+            yield self.slicer.start(name, iterations, status)
+            self.events.append("end " + name)
+        return run
+
+    def test_dependencies_set_the_order(self):
+        stages = StageScheduler()
+        stages.add("merge", self.stage("merge"), ["segmentation", "registration"])
+        stages.add("segmentation", self.stage("segmentation"), ["registration"])
+        stages.add("registration", self.stage("registration"))
+        stages.add("report", self.stage("report"))
+        stages.run()
+        # Among the ready stages, the ones added first start first
+        self.assertEqual(self.events, ["registration", "report", "segmentation", "merge"])
+
+    def test_missing_dependencies_are_ignored(self):
+        stages = StageScheduler()
+        stages.add("segmentation", self.stage("segmentation"), ["restoredFromCheckpoint"])
+        stages.run()
+        self.assertEqual(self.events, ["segmentation"])
+
+    def test_concurrent_stages(self):
+        stages = StageScheduler(maxConcurrentStages=2)
+        stages.add("FA", self.cliStage("FA", 3))
+        stages.add("MD", self.cliStage("MD", 1))
+        stages.add("RA", self.cliStage("RA", 1))
+        stages.add("fusion", self.stage("fusion"), ["FA", "MD", "RA"])
+        stages.run()
+        # FA and MD run together, RA takes the place of MD and the fusion waits for all of them
+        self.assertEqual(self.events, ["start FA", "start MD", "end MD", "start RA", "end RA", "end FA", "fusion"])
+
+    def test_sequential_stages(self):
+        stages = StageScheduler(maxConcurrentStages=1)
+        stages.add("FA", self.cliStage("FA", 3))
+        stages.add("MD", self.cliStage("MD", 1))
+        stages.run()
+        self.assertEqual(self.events, ["start FA", "end FA", "start MD", "end MD"])
+
+    def test_failed_cli_cancels_the_running_stages(self):
+        stages = StageScheduler(maxConcurrentStages=2)
+        stages.add("FA", self.cliStage("FA", 1, "Completed with errors"))
+        stages.add("MD", self.cliStage("MD", 10))
+        stages.add("fusion", self.stage("fusion"), ["FA", "MD"])
+        with self.assertRaises(RuntimeError):
+            stages.run()
+        self.assertEqual(self.slicer.cancelled, ["MD"])
+        self.assertNotIn("fusion", self.events)
+        self.assertNotIn("end FA", self.events)
+
+    def test_stage_exception_is_raised(self):
+        def failingStage():
+            raise IOError("disk full")
+        stages = StageScheduler(maxConcurrentStages=2)
+        stages.add("MD", self.cliStage("MD", 10))
+        stages.add("FA", failingStage)
+        with self.assertRaises(IOError):
+            stages.run()
+        self.assertEqual(self.slicer.cancelled, ["MD"])
+
+    def test_circular_dependencies(self):
+        stages = StageScheduler()
+        stages.add("a", self.stage("a"), ["b"])
+        stages.add("b", self.stage("b"), ["a"])
+        self.assertRaises(ValueError, stages.run)
+        self.assertRaises(ValueError, stages.add, "a", self.stage("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
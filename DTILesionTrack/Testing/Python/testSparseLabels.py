@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import fakeslicer  # noqa: F401
+from DTILesionTrackLib.fusion import FUSION_RULES, fuseLabelArrays
+from DTILesionTrackLib.sparselabels import (SPARSE_LABEL_EXTENSION, fuseSparseLabels, readSparseLabel,
+                                            sparseLabelFromArray, writeSparseLabel)
+
+
+def randomLabel(randomState, shape=(6, 7, 8), lesionFraction=0.05, maximumValue=1):
+    label = numpy.zeros(shape, numpy.uint8)
+    lesion = randomState.random_sample(shape) < lesionFraction
+    label[lesion] = randomState.randint(1, maximumValue + 1, lesion.sum())
+    return label
+
+
+class SparseLabelsTest(unittest.TestCase):
+    """Sparse lesion labels: conversion, .npz round trip and fusion."""
+
+    def setUp(self):
+        self.randomState = numpy.random.RandomState(17)
+        self.folder = tempfile.mkdtemp()
+        self.ijkToRAS = [-2.0, 0.0, 0.0, 90.0, 0.0, 2.0, 0.0, -126.0, 0.0, 0.0, 2.0, -72.0, 0.0, 0.0, 0.0, 1.0]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_array_conversion(self):
+        labelArray = randomLabel(self.randomState, maximumValue=3)
+        label = sparseLabelFromArray(labelArray, self.ijkToRAS)
+        self.assertEqual(len(label), numpy.count_nonzero(labelArray))
+        self.assertTrue(numpy.all(numpy.diff(label.indices) > 0))
+        numpy.testing.assert_array_equal(label.toArray(), labelArray)
+        self.assertEqual(label.toArray().dtype, labelArray.dtype)
+        numpy.testing.assert_array_equal(label.coordinates(), numpy.argwhere(labelArray))
+
+    def test_round_trip(self):
+        for useCompression in (True, False):
+            labelArray = randomLabel(self.randomState, maximumValue=3)
+            label = sparseLabelFromArray(labelArray, self.ijkToRAS)
+            filePath = os.path.join(self.folder, "label-%d%s" % (useCompression, SPARSE_LABEL_EXTENSION))
+            writeSparseLabel(label, filePath, useCompression)
+            read = readSparseLabel(filePath)
+            self.assertEqual(read.shape, label.shape)
+            self.assertTrue(read.sameGeometry(label))
+            numpy.testing.assert_array_equal(read.indices, label.indices)
+            numpy.testing.assert_array_equal(read.toArray(), labelArray)
+            self.assertEqual(read.values.dtype, labelArray.dtype)
+
+    def test_round_trip_of_an_empty_label(self):
+        labelArray = numpy.zeros((3, 4, 5), numpy.uint8)
+        filePath = os.path.join(self.folder, "empty" + SPARSE_LABEL_EXTENSION)
+        writeSparseLabel(sparseLabelFromArray(labelArray), filePath)
+        read = readSparseLabel(filePath)
+        self.assertEqual(len(read), 0)
+        numpy.testing.assert_array_equal(read.toArray(), labelArray)
+
+    def test_fusion_matches_the_dense_fusion(self):
+        labelArrays = [randomLabel(self.randomState, lesionFraction=0.3) for index in range(3)]
+        labels = [sparseLabelFromArray(labelArray, self.ijkToRAS) for labelArray in labelArrays]
+        for rule in FUSION_RULES:
+            fused = fuseSparseLabels(labels, rule)
+            numpy.testing.assert_array_equal(fused.toArray(), fuseLabelArrays(labelArrays, rule), rule)
+            self.assertEqual(numpy.count_nonzero(fused.values), len(fused))
+
+    def test_fusion_of_different_grids(self):
+        labelArray = randomLabel(self.randomState)
+        shifted = list(self.ijkToRAS)
+        shifted[3] += 1.0
+        self.assertRaises(ValueError, fuseSparseLabels, [sparseLabelFromArray(labelArray, self.ijkToRAS),
+                                                         sparseLabelFromArray(labelArray, shifted)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import fakeslicer  # noqa: F401
+from DTILesionTrackLib import templates
+
+
+class FakeVolumeNode(object):
+    """Template volume whose voxel digest is its content."""
+
+    def __init__(self, content):
+        self.content = content
+
+
+class ReferenceQuantilesTest(unittest.TestCase):
+    """Naming of the reference quantiles files of the template cache."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.digests = []
+        (self.moduleDataFolder, self.moduleVolumeDigest, self.moduleCache) = \
+            (templates.dataFolder, templates.volumeDigest, templates._templateCache)
+        templates.dataFolder = lambda: self.folder
+        templates.volumeDigest = self.volumeDigest
+        templates._templateCache = templates.TemplateCache()
+
+    def tearDown(self):
+        (templates.dataFolder, templates.volumeDigest, templates._templateCache) = \
+            (self.moduleDataFolder, self.moduleVolumeDigest, self.moduleCache)
+        shutil.rmtree(self.folder)
+
+    def volumeDigest(self, node):
+        self.digests.append(node)
+        return node.content * 40
+
+    def cache(self, key, content):
+        # Adds a template as TemplateCache._get does, without loading a file
+        node = FakeVolumeNode(content)
+        cache = templates.templateCache()
+        cache.nodes[key] = node
+        cache.filePaths[key] = templates.templateFilePath(*key)
+        return node
+
+    def test_uncached_template(self):
+        self.assertEqual(templates.referenceQuantilesFilePath(FakeVolumeNode("a")), "")
+
+    def test_keyed_on_template_file_and_content(self):
+        fa = self.cache(("FA", "USP-131", "1mm"), "a")
+        # Another template set on the same grid, even with the same voxels
+        usp20 = self.cache(("FA", "USP-20", "1mm"), "a")
+        faPath = templates.referenceQuantilesFilePath(fa)
+        self.assertEqual(os.path.dirname(faPath), os.path.join(self.folder, templates.REFERENCE_QUANTILES_FOLDER_NAME))
+        self.assertTrue(os.path.basename(faPath).startswith("USP-ICBM-FA-131-1mm-"))
+        self.assertTrue(faPath.endswith("-" + "a" * 16 + "-quantiles.txt"))
+        self.assertNotEqual(templates.referenceQuantilesFilePath(usp20), faPath)
+        self.assertNotEqual(templates.referenceQuantilesFilePath(fa, True), faPath)
+        # The digest is computed once per loaded template
+        self.assertEqual(templates.referenceQuantilesFilePath(fa), faPath)
+        self.assertEqual(self.digests.count(fa), 1)
+
+    def test_quantiles_of_a_changed_template_are_removed(self):
+        key = ("FA", "USP-131", "1mm")
+        oldPath = templates.referenceQuantilesFilePath(self.cache(key, "a"))
+        with open(oldPath, "w") as quantilesFile:
+            quantilesFile.write("0 1\n")
+        wmPath = templates.referenceQuantilesFilePath(templates.templateCache().nodes[key], True)
+        with open(wmPath, "w") as quantilesFile:
+            quantilesFile.write("0 1\n")
+        # The template file was replaced, so it is loaded again with another content
+        templates.templateCache().digests.clear()
+        newPath = templates.referenceQuantilesFilePath(self.cache(key, "b"))
+        self.assertNotEqual(newPath, oldPath)
+        self.assertFalse(os.path.exists(oldPath))
+        # The white matter quantiles are only checked when they are requested
+        self.assertTrue(os.path.exists(wmPath))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -258,6 +258,7 @@ FIXEDIMAGES=()
 MOVINGIMAGES=()
 OUTPUTNAME=output
 NUMBEROFTHREADS=1
+WARPEDEXTENSION=${WARPED_IMAGE_EXTENSION:-nii.gz}
 SPLINEDISTANCE=26
 TRANSFORMTYPE='s'
 PRECISIONTYPE='d'
@@ -535,7 +536,7 @@ esac
 
 COMMAND="${ANTS} --verbose 1 \
                  --dimensionality $DIM $PRECISION \
-                 --output [$OUTPUTNAME,${OUTPUTNAME}Warped.nii.gz,${OUTPUTNAME}InverseWarped.nii.gz] \
+                 --output [$OUTPUTNAME,${OUTPUTNAME}Warped.${WARPEDEXTENSION},${OUTPUTNAME}InverseWarped.${WARPEDEXTENSION}] \
                  --interpolation Linear \
                  --use-histogram-matching ${USEHISTOGRAMMATCHING} \
                  --winsorize-image-intensities [0.005,0.995] \
@@ -2,11 +2,12 @@
 
 usage(){
   echo "This script is intended to call the ANTs registration procedure in order to perform diffeomorphic SyN registration on DTI scalar maps."
-  echo "(basename $0) <Main folder> <Quick registration [Y/N]> <Structural Registration [Y/N]>"
+  echo "(basename $0) <Main folder> <Quick registration [Y/N]> <Structural Registration [Y/N]> [Image extension]"
   echo ""
   echo  "Main folder = The location where is found the input files for ANTs registration."
   echo  "Quick registration = Choose if use the fast ANTs registration script. Default = N"
   echo  "Structural Registration = Do registration on structural images. Default = N"
+  echo  "Image extension = Extension of the input and warped images (nii.gz or nii). Default = nii.gz"
 }
 
 if [[ $# -lt 3 ]]; then
@@ -17,21 +18,24 @@ fi
 MAIN_FOLDER=$1
 USE_QUICK=$2
 STRUCTURAL_REGISTRATION=$3
+IMAGE_EXTENSION=${4:-nii.gz}
+# Extension of the warped images written by the ANTs scripts
+export WARPED_IMAGE_EXTENSION=$IMAGE_EXTENSION
 
 if [[ -d "$MAIN_FOLDER" ]]; then
   #Performing registration
   if [[ $USE_QUICK == "Y" && $STRUCTURAL_REGISTRATION == "N" ]]; then
     cd ${MAIN_FOLDER}
-    ~/MSLesionTrack-Data/antsRegistrationSyNQuick.sh -d 3 -f patient-FA.nii.gz -m DTI-Template-FA.nii.gz -o regTemplate
+    ~/MSLesionTrack-Data/antsRegistrationSyNQuick.sh -d 3 -f patient-FA.${IMAGE_EXTENSION} -m DTI-Template-FA.${IMAGE_EXTENSION} -o regTemplate
   elif [[ $USE_QUICK == "N" && $STRUCTURAL_REGISTRATION == "N" ]]; then
     cd ${MAIN_FOLDER}
-    ~/MSLesionTrack-Data/antsRegistrationSyN.sh -d 3 -f patient-FA.nii.gz -m DTI-Template-FA.nii.gz -o regTemplate
+    ~/MSLesionTrack-Data/antsRegistrationSyN.sh -d 3 -f patient-FA.${IMAGE_EXTENSION} -m DTI-Template-FA.${IMAGE_EXTENSION} -o regTemplate
   elif [[ $USE_QUICK == "Y" && $STRUCTURAL_REGISTRATION == "Y" ]]; then
     cd ${MAIN_FOLDER}
-    ~/MSLesionTrack-Data/antsRegistrationSyNQuick.sh -d 3 -f patient-FLAIR.nii.gz -m MNI-Template-T1.nii.gz -o regStruct
+    ~/MSLesionTrack-Data/antsRegistrationSyNQuick.sh -d 3 -f patient-FLAIR.${IMAGE_EXTENSION} -m MNI-Template-T1.${IMAGE_EXTENSION} -o regStruct
   elif [[ $USE_QUICK == "N" && $STRUCTURAL_REGISTRATION == "Y" ]]; then
     cd ${MAIN_FOLDER}
-    ~/MSLesionTrack-Data/antsRegistrationSyN.sh -d 3 -f patient-FLAIR.nii.gz -m MNI-Template-T1.nii.gz -o regStruct
+    ~/MSLesionTrack-Data/antsRegistrationSyN.sh -d 3 -f patient-FLAIR.${IMAGE_EXTENSION} -m MNI-Template-T1.${IMAGE_EXTENSION} -o regStruct
   else
     echo "Quick registration is Y or N."
     exit
@@ -1,5 +1,6 @@
 //ITK
 #include "itkImageFileWriter.h"
+#include "itkImageIOFactory.h"
 #include "itkVectorImage.h"
 #include "itkRescaleIntensityImageFilter.h"
 #include "itkCastImageFilter.h"
@@ -8,6 +9,8 @@
 //Utils
 #include "itkHistogramMatchingImageFilter.h"
 #include "itkMaskImageFilter.h"
+#include "itkStreamingImageFilter.h"
+#include "itkTScoreLesionImageFilter.h"
 
 //System
 #include "stdlib.h"
@@ -45,25 +48,6 @@ using namespace  std;
 //
 namespace
 {
-bool LocalDecision(float tScore, float tThr, string mapType){
-    if (mapType == "FractionalAnisotropy") {
-        return (tScore <= (-1)*tThr);
-    }
-    if (mapType == "MeanDiffusivity") {
-        return (tScore >= tThr);
-    }
-    if (mapType == "RelativeAnisotropy") {
-        return (tScore <= (-1)*tThr);
-    }
-    if (mapType == "PerpendicularDiffusivity") {
-        return (tScore >= tThr);
-    }
-    if (mapType == "VolumeRatio") {
-        return (tScore >= tThr);
-    }
-    return false;
-}
-
 template <class T>
 int DoIt( int argc, char * argv[], T )
 {
@@ -86,7 +70,6 @@ int DoIt( int argc, char * argv[], T )
 
     typename ReaderType::Pointer inputReader = ReaderType::New();
     inputReader->SetFileName( inputVolume.c_str() );
-    inputReader->Update();
 
     typename ReaderType::Pointer meanStatReader = ReaderType::New();
     typename ReaderType::Pointer stdStatReader = ReaderType::New();
@@ -125,6 +108,9 @@ int DoIt( int argc, char * argv[], T )
     }else if ((mapType == "VolumeRatio") & (mapResolution == "2mm")) {
         meanStatTemplate="USP-ICBM-VRmean-131-2mm.nii.gz";
         stdStatTemplate="USP-ICBM-VRstd-131-2mm.nii.gz";
+    }else{
+        std::cerr<<"ERROR: Unknown diffusion map type or resolution: "<<mapType<<" "<<mapResolution<<std::endl;
+        return EXIT_FAILURE;
     }
 
     //    Read the DTI Statistical Template
@@ -133,47 +119,22 @@ int DoIt( int argc, char * argv[], T )
     stdTEMPLATE_path<<HOME_DIR<<STATISTICALTEMPLATESFOLDER<<PATH_SEPARATOR<<stdStatTemplate;
     meanStatReader->SetFileName(meanTEMPLATE_path.str().c_str());
     stdStatReader->SetFileName(stdTEMPLATE_path.str().c_str());
-    meanStatReader->Update();
-    stdStatReader->Update();
 
-    //    Start brain statistical segmentation
-    //    Create the Probability Image
-    typename InputImageType::Pointer probabilityVolume = InputImageType::New();
-    probabilityVolume->CopyInformation( inputReader->GetOutput() );
-    probabilityVolume->SetBufferedRegion( inputReader->GetOutput()->GetBufferedRegion() );
-    probabilityVolume->SetRequestedRegion( inputReader->GetOutput()->GetRequestedRegion() );
-    probabilityVolume->Allocate();
-
-    //     Set iterators
-    typedef itk::ImageRegionIterator<InputImageType>        RegionIterator;
-    RegionIterator      meanStatIt(meanStatReader->GetOutput(), meanStatReader->GetOutput()->GetRequestedRegion());
-    RegionIterator      stdStatIt(stdStatReader->GetOutput(), stdStatReader->GetOutput()->GetRequestedRegion());
-    RegionIterator      probIt(probabilityVolume, probabilityVolume->GetRequestedRegion());
-    RegionIterator      inputIt(inputReader->GetOutput(), inputReader->GetOutput()->GetRequestedRegion());
-
-    meanStatIt.GoToBegin();
-    stdStatIt.GoToBegin();
-    probIt.GoToBegin();
-    inputIt.GoToBegin();
-    float tScore=0.0;
-    while (!meanStatIt.IsAtEnd()) {
-        //Jump voxels with zero values
-        if (meanStatIt.Get()!=static_cast<InputPixelType>(0)) {
-            tScore=((inputIt.Get()-meanStatIt.Get())/stdStatIt.Get());
-            //Calculate the threshold based on the type of diffusivity map
-            if (LocalDecision(tScore,tThreshold, mapType)) {
-                probIt.Set(1);
-            }
-            ++meanStatIt;
-            ++stdStatIt;
-            ++probIt;
-            ++inputIt;
-        }else{
-            ++meanStatIt;
-            ++stdStatIt;
-            ++probIt;
-            ++inputIt;
-        }
+    //    Start brain statistical segmentation (multi-threaded T-Score inference)
+    typedef itk::TScoreLesionImageFilter<InputImageType, OutputImageType> TScoreFilterType;
+    typename TScoreFilterType::Pointer tScoreFilter = TScoreFilterType::New();
+    tScoreFilter->SetInput(inputReader->GetOutput());
+    tScoreFilter->SetMeanImage(meanStatReader->GetOutput());
+    tScoreFilter->SetStdImage(stdStatReader->GetOutput());
+    tScoreFilter->SetTScoreThreshold(tThreshold);
+    //Choose the lesion tail based on the type of diffusivity map, once for the whole image
+    if ((mapType == "FractionalAnisotropy") | (mapType == "RelativeAnisotropy")) {
+        tScoreFilter->SetLesionTail(TScoreFilterType::LOWTAIL);
+    }else if ((mapType == "MeanDiffusivity") | (mapType == "PerpendicularDiffusivity") | (mapType == "VolumeRatio")) {
+        tScoreFilter->SetLesionTail(TScoreFilterType::HIGHTAIL);
+    }else{
+        std::cerr<<"ERROR: Unknown diffusion map type: "<<mapType<<std::endl;
+        return EXIT_FAILURE;
     }
 
     //Mask the whole white matter
@@ -184,24 +145,37 @@ int DoIt( int argc, char * argv[], T )
         wmFile_path<<HOME_DIR<<WHITEMATTERTEMPLATESFOLDER<<PATH_SEPARATOR<<"MNI152_T1_2mm_brain_wm.nii.gz";
     }
     wmReader->SetFileName(wmFile_path.str().c_str());
-    wmReader->Update();
 
     //Apply whole white matter mask
-    typedef itk::MaskImageFilter<InputImageType, InputImageType>    MaskFilterType;
+    typedef itk::MaskImageFilter<OutputImageType, InputImageType, OutputImageType>    MaskFilterType;
     typename MaskFilterType::Pointer maskWM = MaskFilterType::New();
-    maskWM->SetInput(probabilityVolume);
+    maskWM->SetInput(tScoreFilter->GetOutput());
     maskWM->SetMaskImage(wmReader->GetOutput());
 
-    //    Cast the probability volume to Label type
-    typedef itk::CastImageFilter<InputImageType, OutputImageType> CastType;
-    typename CastType::Pointer caster = CastType::New();
-    caster->SetInput(maskWM->GetOutput());
-
     typedef itk::ImageFileWriter<OutputImageType> WriterType;
     typename WriterType::Pointer writer = WriterType::New();
     writer->SetFileName( outputLabel.c_str() );
-    writer->SetInput( caster->GetOutput() );
-    writer->SetUseCompression(1);
+    writer->SetUseCompression(useCompression);
+
+    //The T-Score and the mask run slab by slab. Each slab is written when the output format
+    //supports streamed writing, otherwise the label is buffered by a StreamingImageFilter (e.g.
+    //for compressed files and the scene volumes of a CLI loaded in the application). The readers
+    //only load the slabs when the input format supports streamed reading
+    itk::ImageIOBase::Pointer outputIO = itk::ImageIOFactory::CreateImageIO(outputLabel.c_str(), itk::ImageIOFactory::WriteMode);
+    if (outputIO.IsNotNull()) {
+        outputIO->SetUseCompression(useCompression);
+    }
+    typedef itk::StreamingImageFilter<OutputImageType, OutputImageType> StreamingType;
+    typename StreamingType::Pointer streamer = StreamingType::New();
+    if (outputIO.IsNotNull() && outputIO->CanStreamWrite()) {
+        writer->SetImageIO(outputIO);
+        writer->SetInput( maskWM->GetOutput() );
+        writer->SetNumberOfStreamDivisions(streamDivisions);
+    }else{
+        streamer->SetInput(maskWM->GetOutput());
+        streamer->SetNumberOfStreamDivisions(streamDivisions);
+        writer->SetInput( streamer->GetOutput() );
+    }
     writer->Update();
 
 
@@ -0,0 +1,152 @@
+#if defined(_MSC_VER)
+#pragma warning ( disable : 4786 )
+#endif
+
+#include "itkTScoreLesionImageFilter.h"
+#include "itkImageRegionConstIterator.h"
+#include "itkImageRegionIterator.h"
+#include "itkMersenneTwisterRandomVariateGenerator.h"
+
+// STD includes
+#include <cstdlib>
+#include <iostream>
+
+namespace
+{
+
+typedef itk::Image<float, 3>                    InputImageType;
+typedef itk::Image<unsigned char, 3>            LabelImageType;
+
+/** Image of uniform noise between minimum and maximum. */
+InputImageType::Pointer RandomImage(float minimum, float maximum, unsigned int seed)
+{
+    typedef itk::Statistics::MersenneTwisterRandomVariateGenerator GeneratorType;
+    GeneratorType::Pointer generator = GeneratorType::New();
+    generator->Initialize(seed);
+
+    InputImageType::RegionType region;
+    region.SetSize(0, 40);
+    region.SetSize(1, 48);
+    region.SetSize(2, 36);
+    InputImageType::Pointer image = InputImageType::New();
+    image->SetRegions(region);
+    image->Allocate();
+    itk::ImageRegionIterator<InputImageType> it(image, region);
+    for (it.GoToBegin(); !it.IsAtEnd(); ++it) {
+        it.Set(minimum + static_cast<float>(generator->GetVariateWithClosedRange(maximum - minimum)));
+    }
+    return image;
+}
+
+/** Voxel loop of the LSDP CLI replaced by the TScoreLesionImageFilter. */
+LabelImageType::Pointer LoopLabel(const InputImageType* input, const InputImageType* mean,
+                                  const InputImageType* stdImage, float tThr, bool lowTail)
+{
+    LabelImageType::Pointer label = LabelImageType::New();
+    label->CopyInformation(input);
+    label->SetRegions(input->GetBufferedRegion());
+    label->Allocate();
+    label->FillBuffer(0);
+
+    typedef itk::ImageRegionConstIterator<InputImageType>   InputIterator;
+    InputIterator   inputIt(input, input->GetBufferedRegion());
+    InputIterator   meanStatIt(mean, mean->GetBufferedRegion());
+    InputIterator   stdStatIt(stdImage, stdImage->GetBufferedRegion());
+    itk::ImageRegionIterator<LabelImageType>  labelIt(label, label->GetBufferedRegion());
+    float tScore=0.0;
+    while (!meanStatIt.IsAtEnd()) {
+        //Jump voxels with zero values
+        if (meanStatIt.Get()!=0.0f) {
+            tScore=((inputIt.Get()-meanStatIt.Get())/stdStatIt.Get());
+            if (lowTail ? (tScore <= (-1)*tThr) : (tScore >= tThr)) {
+                labelIt.Set(1);
+            }
+        }
+        ++meanStatIt;
+        ++stdStatIt;
+        ++labelIt;
+        ++inputIt;
+    }
+    return label;
+}
+
+/** Number of voxels where the labels differ. */
+unsigned long CountDifferences(const LabelImageType* label, const LabelImageType* baseline)
+{
+    itk::ImageRegionConstIterator<LabelImageType> labelIt(label, label->GetBufferedRegion());
+    itk::ImageRegionConstIterator<LabelImageType> baselineIt(baseline, baseline->GetBufferedRegion());
+    unsigned long differences = 0;
+    unsigned long lesionVoxels = 0;
+    for (; !labelIt.IsAtEnd(); ++labelIt, ++baselineIt) {
+        if (labelIt.Get() != baselineIt.Get()) {
+            differences++;
+        }
+        if (baselineIt.Get() != 0) {
+            lesionVoxels++;
+        }
+    }
+    std::cout<<"  "<<lesionVoxels<<" lesion voxels, "<<differences<<" different voxels"<<std::endl;
+    return differences;
+}
+
+} // end of anonymous namespace
+
+int main(int, char* [])
+{
+    typedef itk::TScoreLesionImageFilter<InputImageType, LabelImageType> TScoreFilterType;
+
+    //Random map and template, with a zero mean slab as the background of the template
+    InputImageType::Pointer input = RandomImage(0.0f, 1.0f, 1);
+    InputImageType::Pointer mean = RandomImage(0.2f, 0.8f, 2);
+    InputImageType::Pointer stdImage = RandomImage(0.05f, 0.2f, 3);
+    InputImageType::RegionType background = mean->GetLargestPossibleRegion();
+    background.SetSize(2, 4);
+    itk::ImageRegionIterator<InputImageType> backgroundIt(mean, background);
+    for (; !backgroundIt.IsAtEnd(); ++backgroundIt) {
+        backgroundIt.Set(0.0f);
+    }
+
+    const float thresholds[3] = { 1.5f, 2.5f, 4.0f };
+    const unsigned char tails[2] = { TScoreFilterType::LOWTAIL, TScoreFilterType::HIGHTAIL };
+    int status = EXIT_SUCCESS;
+    for (unsigned int t = 0; t < 2; t++) {
+        for (unsigned int i = 0; i < 3; i++) {
+            std::cout<<"Lesion tail "<<static_cast<int>(tails[t])<<", T-Score threshold "<<thresholds[i]<<std::endl;
+            TScoreFilterType::Pointer tScoreFilter = TScoreFilterType::New();
+            tScoreFilter->SetInput(input);
+            tScoreFilter->SetMeanImage(mean);
+            tScoreFilter->SetStdImage(stdImage);
+            tScoreFilter->SetTScoreThreshold(thresholds[i]);
+            tScoreFilter->SetLesionTail(tails[t]);
+            try {
+                tScoreFilter->Update();
+            } catch (itk::ExceptionObject & error) {
+                std::cerr<<error<<std::endl;
+                return EXIT_FAILURE;
+            }
+
+            LabelImageType::Pointer baseline = LoopLabel(input, mean, stdImage, thresholds[i],
+                                                         tails[t] == TScoreFilterType::LOWTAIL);
+            if (CountDifferences(tScoreFilter->GetOutput(), baseline) != 0) {
+                std::cerr<<"ERROR: The filter label differs from the voxel loop label"<<std::endl;
+                status = EXIT_FAILURE;
+            }
+        }
+    }
+
+    //An unknown lesion tail must be rejected
+    TScoreFilterType::Pointer invalidFilter = TScoreFilterType::New();
+    invalidFilter->SetInput(input);
+    invalidFilter->SetMeanImage(mean);
+    invalidFilter->SetStdImage(stdImage);
+    invalidFilter->SetLesionTail(0);
+    try {
+        invalidFilter->Update();
+        std::cerr<<"ERROR: An invalid lesion tail was accepted"<<std::endl;
+        status = EXIT_FAILURE;
+    } catch (itk::ExceptionObject &) {
+        std::cout<<"Invalid lesion tail rejected"<<std::endl;
+    }
+
+    return status;
+}
@@ -0,0 +1,97 @@
+#ifndef __itkTScoreLesionImageFilter_h
+#define __itkTScoreLesionImageFilter_h
+#include "itkImageToImageFilter.h"
+#include "itkImage.h"
+#include "itkNumericTraits.h"
+
+namespace itk
+{
+
+/** Voxel-wise T-Score lesion detection against a statistical DTI template.
+ *
+ * Input 0 is the DTI map, inputs 1 and 2 are the template mean and standard deviation
+ * images. A voxel is labeled as lesion (1) when its T-Score, (x - mean)/std, lies on the
+ * lesion tail of the map distribution beyond the T-Score threshold. Voxels where the
+ * template mean is zero are left as background. The output region is split among the
+ * threads.
+ */
+template< typename TInputImage , typename TOutputImage>
+class ITK_EXPORT TScoreLesionImageFilter:
+        public ImageToImageFilter< TInputImage, TOutputImage >
+{
+public:
+    /** Extract dimension from inputs images, where it is assumed there are with the same type. */
+    itkStaticConstMacro(InputImageDimension, unsigned int,
+                        TInputImage::ImageDimension);
+    itkStaticConstMacro(OutputImageDimension, unsigned int,
+                        TOutputImage::ImageDimension);
+
+    /** Convenient typedefs for simplifying declarations. */
+    typedef TInputImage  InputImageType;
+    typedef TOutputImage OutputImageType;
+
+
+    /** Standard class typedefs. */
+    typedef TScoreLesionImageFilter                               Self;
+    typedef ImageToImageFilter< TInputImage, TOutputImage >       Superclass;
+    typedef SmartPointer< Self >                                  Pointer;
+    typedef SmartPointer< const Self >                            ConstPointer;
+
+    /** Method for creation through the object factory. */
+    itkNewMacro(Self)
+
+    /** Run-time type information (and related methods). */
+    itkTypeMacro(TScoreLesionImageFilter, ImageToImageFilter)
+
+    typedef typename InputImageType::PixelType                 InputPixelType;
+    typedef typename OutputImageType::PixelType                OutputPixelType;
+    typedef typename OutputImageType::RegionType               OutputImageRegionType;
+
+    /** Set the template mean image. */
+    void SetMeanImage(const InputImageType* mean);
+
+    /** Set the template standard deviation image. */
+    void SetStdImage(const InputImageType* std);
+
+    /** Set the T-Score threshold. */
+    itkSetMacro(TScoreThreshold, float)
+
+    /** Set the tail of the T-Score distribution where the lesions are found. */
+    itkSetMacro(LesionTail, unsigned char)
+
+    itkGetMacro(TScoreThreshold, float)
+    itkGetMacro(LesionTail, unsigned char)
+
+#ifdef ITK_USE_CONCEPT_CHECKING
+    // Begin concept checking
+    itkConceptMacro( InputHasNumericTraitsCheck,
+                     ( Concept::HasNumericTraits< InputPixelType > ) );
+    itkConceptMacro( SameDimensionCheck,
+                     ( Concept::SameDimension< InputImageDimension, OutputImageDimension > ) );
+#endif
+
+    enum LesionTail {
+        LOWTAIL=1,
+        HIGHTAIL=2
+    };
+
+protected:
+    TScoreLesionImageFilter();
+    virtual ~TScoreLesionImageFilter() {}
+    float m_TScoreThreshold;
+    unsigned char m_LesionTail;
+
+    void BeforeThreadedGenerateData();
+    void ThreadedGenerateData(const OutputImageRegionType & outputRegionForThread, ThreadIdType threadId);
+private:
+    TScoreLesionImageFilter(const Self &); //purposely not implemented
+    void operator=(const Self &);  //purposely not implemented
+};
+
+} // end namespace itk
+
+#ifndef ITK_MANUAL_INSTANTIATION
+#include "itkTScoreLesionImageFilter.hxx"
+#endif
+
+#endif
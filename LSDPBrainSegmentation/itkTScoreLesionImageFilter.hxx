@@ -0,0 +1,80 @@
+#ifndef __itkTScoreLesionImageFilter_hxx
+#define __itkTScoreLesionImageFilter_hxx
+#include "itkTScoreLesionImageFilter.h"
+
+#include <itkImageRegionConstIterator.h>
+#include <itkImageRegionIterator.h>
+
+namespace itk
+{
+template< typename TInput, typename TOutput>
+TScoreLesionImageFilter< TInput, TOutput >
+::TScoreLesionImageFilter()
+{
+    this->SetNumberOfRequiredInputs(3);
+    this->m_TScoreThreshold=2.5;
+    this->m_LesionTail=LOWTAIL;
+}
+
+template< typename TInput, typename TOutput >
+void
+TScoreLesionImageFilter< TInput, TOutput >
+::SetMeanImage(const InputImageType* mean)
+{
+    this->SetNthInput(1, const_cast<InputImageType*>(mean));
+}
+
+template< typename TInput, typename TOutput >
+void
+TScoreLesionImageFilter< TInput, TOutput >
+::SetStdImage(const InputImageType* std)
+{
+    this->SetNthInput(2, const_cast<InputImageType*>(std));
+}
+
+template< typename TInput, typename TOutput >
+void
+TScoreLesionImageFilter< TInput, TOutput >
+::BeforeThreadedGenerateData()
+{
+    if (m_LesionTail != LOWTAIL && m_LesionTail != HIGHTAIL) {
+        itkExceptionMacro(<<"The lesion tail is not valid! Choose the options available in the LesionTail enumeration.");
+    }
+}
+
+template< typename TInput, typename TOutput >
+void
+TScoreLesionImageFilter< TInput, TOutput >
+::ThreadedGenerateData(const OutputImageRegionType & outputRegionForThread, ThreadIdType itkNotUsed(threadId))
+{
+    typedef itk::ImageRegionConstIterator<InputImageType>   InputIterator;
+    typedef itk::ImageRegionIterator<OutputImageType>       OutputIterator;
+    InputIterator   inputIt(this->GetInput(0), outputRegionForThread);
+    InputIterator   meanStatIt(this->GetInput(1), outputRegionForThread);
+    InputIterator   stdStatIt(this->GetInput(2), outputRegionForThread);
+    OutputIterator  outputIt(this->GetOutput(), outputRegionForThread);
+
+    const float lowerThr=(-1)*m_TScoreThreshold;
+    const float upperThr=m_TScoreThreshold;
+    const bool lowTail=(m_LesionTail == LOWTAIL);
+    float tScore=0.0;
+    while (!outputIt.IsAtEnd()) {
+        OutputPixelType label=static_cast<OutputPixelType>(0);
+        //Jump voxels with zero values
+        if (meanStatIt.Get()!=static_cast<InputPixelType>(0)) {
+            tScore=((inputIt.Get()-meanStatIt.Get())/stdStatIt.Get());
+            if (lowTail ? (tScore <= lowerThr) : (tScore >= upperThr)) {
+                label=static_cast<OutputPixelType>(1);
+            }
+        }
+        outputIt.Set(label);
+        ++inputIt;
+        ++meanStatIt;
+        ++stdStatIt;
+        ++outputIt;
+    }
+}
+
+} // end namespace itk
+
+#endif